@@ -0,0 +1,183 @@
+"""Checks the plugin's download cache against a local HTTP stand-in, without network access.
+
+The stand-in serves a single file with an ETag and honors Range, If-Range and If-None-Match, and can cut a
+response short to simulate an interrupted download. The checks cover:
+
+- an interrupted download resuming with a Range request, validated with If-Range
+- an unchanged file being revalidated with If-None-Match, without transferring it again
+- a changed file (new ETag) being fetched again in full
+- a partial download of a file that changed meanwhile being discarded rather than resumed
+
+    python bench/download_cache.py
+"""
+
+import asyncio
+import hashlib
+import http.server
+import os
+import sys
+import tempfile
+import threading
+from typing import Any, Dict, List
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+sys.path.insert(0, SRC_DIR)
+
+from download_cache import DownloadCache
+
+
+FILE_SIZE = 3 * 1024 * 1024
+
+
+class StandIn:
+    """State of the stand-in server: the file it serves, and a log of the requests it answered."""
+
+    def __init__(self) -> None:
+        self.content = b''
+        self.etag = ''
+        self.version = 0
+        # bytes of the body to send before dropping the connection, for the next response only
+        self.cut_after: int | None = None
+        self.requests: List[Dict[str, Any]] = []
+        self.change()
+
+    def change(self) -> None:
+        self.version += 1
+        self.content = bytes((i * 7 + self.version) % 256 for i in range(FILE_SIZE))
+        self.etag = f'"v{self.version}"'
+
+
+def handler_for(state: StandIn) -> type:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            content = state.content
+            start = 0
+            status = 200
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if self.headers.get('If-None-Match') == state.etag:
+                status = 304
+            elif range_header and (if_range is None or if_range == state.etag):
+                start = int(range_header[len('bytes='):].split('-')[0])
+                if start >= len(content):
+                    status = 416
+                else:
+                    status = 206
+
+            body = content[start:] if status in (200, 206) else b''
+            cut_after = state.cut_after
+            state.cut_after = None
+            state.requests.append({
+                "status": status,
+                "range": range_header,
+                "if_range": if_range,
+                "if_none_match": self.headers.get('If-None-Match'),
+                "sent": len(body) if cut_after is None else min(cut_after, len(body)),
+            })
+
+            self.send_response(status)
+            self.send_header('ETag', state.etag)
+            if status in (200, 206):
+                self.send_header('Content-Length', str(len(body)))
+                if status == 206:
+                    self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+            self.end_headers()
+            if cut_after is not None:
+                self.wfile.write(body[:cut_after])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+    return Handler
+
+
+def check(name: str, results: List[bool], condition: bool, detail: str = '') -> None:
+    results.append(condition)
+    print(f"{'PASS' if condition else 'FAIL'} {name}{': ' + detail if detail and not condition else ''}")
+
+
+async def main() -> int:
+    state = StandIn()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler_for(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/btop.tbz"
+    results: List[bool] = []
+
+    with tempfile.TemporaryDirectory(prefix='btop-camera-download-cache-') as root:
+        cache = DownloadCache(root, log=lambda *args: None)
+
+        # interrupted download, then resumed from where it stopped
+        state.cut_after = FILE_SIZE // 2
+        try:
+            await cache.fetch(url)
+            interrupted = False
+        except Exception:
+            interrupted = True
+        check("interrupted download fails and keeps the partial file", results,
+              interrupted and any(name.endswith('.tmp') for name in os.listdir(os.path.join(root, 'partial'))))
+        path = await cache.fetch(url)
+        resumed = state.requests[-1]
+        check("resumes with Range and If-Range", results,
+              resumed['status'] == 206 and resumed['range'] == f"bytes={FILE_SIZE // 2}-" and resumed['if_range'] == state.etag,
+              str(resumed))
+        with open(path, 'rb') as f:
+            check("resumed file matches the original", results, f.read() == state.content)
+        check("resumed file is stored by its hash", results,
+              os.path.basename(path) == hashlib.sha256(state.content).hexdigest())
+
+        # revalidation of an unchanged file
+        cache = DownloadCache(root, log=lambda *args: None)
+        unchanged = await cache.fetch(url)
+        revalidated = state.requests[-1]
+        check("unchanged file is revalidated with If-None-Match", results,
+              revalidated['status'] == 304 and revalidated['if_none_match'] == state.etag and unchanged == path,
+              str(revalidated))
+
+        # revalidation after the file changed
+        state.change()
+        cache = DownloadCache(root, log=lambda *args: None)
+        changed = await cache.fetch(url)
+        refetched = state.requests[-1]
+        check("changed ETag fetches the new file in full", results,
+              refetched['status'] == 200 and refetched['sent'] == FILE_SIZE and changed != path, str(refetched))
+        with open(changed, 'rb') as f:
+            check("new file matches the changed original", results, f.read() == state.content)
+
+        # a partial download is not resumed once the file changed
+        os.remove(os.path.join(root, 'index.json'))
+        cache = DownloadCache(root, log=lambda *args: None)
+        state.cut_after = FILE_SIZE // 3
+        try:
+            await cache.fetch(url)
+        except Exception:
+            pass
+        state.change()
+        fresh = await cache.fetch(url)
+        restarted = state.requests[-1]
+        check("stale partial download is replaced by the full file", results,
+              restarted['status'] == 200 and restarted['if_range'] is not None, str(restarted))
+        with open(fresh, 'rb') as f:
+            check("replaced file matches the changed original", results, f.read() == state.content)
+
+        # a pinned hash mismatch is reported
+        cache = DownloadCache(root, log=lambda *args: None)
+        try:
+            await cache.fetch(f"{url}#sha256={'0' * 64}")
+            mismatch = False
+        except Exception:
+            mismatch = True
+        check("pinned hash mismatch is rejected", results, mismatch)
+
+    server.shutdown()
+    print(f"{sum(results)}/{len(results)} checks passed")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
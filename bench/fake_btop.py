@@ -0,0 +1,60 @@
+"""Stand-in for btop that draws synthetic meters with ANSI escape sequences.
+
+Like btop, it fills the terminal, uses 256-color and box-drawing output, and redraws on a fixed update interval
+(FAKE_BTOP_UPDATE_MS, 2000 by default), so that capture and encode costs are representative."""
+
+import math
+import os
+import random
+import shutil
+import signal
+import sys
+import time
+
+
+COLORS = [34, 40, 46, 82, 118, 154, 190, 226, 220, 214, 208, 202, 196]
+
+
+def meter(width: int, value: float) -> str:
+    filled = int(round(width * value))
+    out = []
+    for i in range(width):
+        if i < filled:
+            color = COLORS[min(len(COLORS) - 1, i * len(COLORS) // max(1, width))]
+            out.append(f"\x1b[38;5;{color}m■")
+        else:
+            out.append("\x1b[38;5;238m■")
+    return ''.join(out) + "\x1b[0m"
+
+
+def draw(columns: int, lines: int, tick: int) -> str:
+    out = ["\x1b[H"]
+    inner = max(1, columns - 2)
+    out.append("\x1b[38;5;67m┌" + " cpu ".center(inner, "─") + "┐\x1b[0m")
+    for row in range(1, lines - 1):
+        value = (math.sin(tick / 3 + row / 2) + 1) / 2 * random.uniform(0.7, 1.0)
+        label = f" core{row - 1:<3} {value * 100:5.1f}% "
+        bar = meter(max(0, inner - len(label) - 1), value)
+        out.append(f"\x1b[{row + 1};1H\x1b[38;5;67m│\x1b[0m{label}{bar} \x1b[38;5;67m│\x1b[0m")
+    out.append(f"\x1b[{lines};1H\x1b[38;5;67m└" + "─" * inner + "┘\x1b[0m")
+    return ''.join(out)
+
+
+def main() -> None:
+    signal.signal(signal.SIGWINCH, lambda *_: None)
+    interval = int(os.environ.get('FAKE_BTOP_UPDATE_MS', '2000')) / 1000
+    sys.stdout.write("\x1b[?1049h\x1b[?25l\x1b[2J")
+    tick = 0
+    while True:
+        columns, lines = shutil.get_terminal_size()
+        sys.stdout.write(draw(columns, lines, tick))
+        sys.stdout.flush()
+        tick += 1
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
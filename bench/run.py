@@ -0,0 +1,428 @@
+"""End-to-end benchmarks of the plugin, without a Scrypted server.
+
+The plugin is loaded against a stand-in scrypted_sdk (bench/scrypted_sdk), with a fake btop (bench/fake_btop.py)
+that draws synthetic meters. For every combination of display engine, display dimensions and frame rate, a fresh
+worker process measures:
+
+- time to first frame: from creating the plugin to the first keyframe received from getVideoStream
+- encode cost: CPU seconds per encoded frame and per second, by process (ffmpeg, btop, Xvfb, xterm, plugin)
+- memory: peak resident memory of the process tree, by process
+- recovery: time from killing btop (and Xvfb) until the display is ready again and the next keyframe arrives
+
+Results are written as JSON. Requires FFmpeg (on the PATH, or --ffmpeg), and Xvfb and xterm for the
+"Xvfb + xterm" engine, which is skipped if they are not installed.
+
+    python bench/run.py --engine headless --dimensions 1024x720,1920x1080 --fps 5,15 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import psutil
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+
+ENGINES = {
+    'xvfb': 'Xvfb + xterm',
+    'headless': 'Headless Terminal',
+}
+
+TS_PACKET_SIZE = 188
+TS_FIRST_STREAM_PID = 0x20
+
+STARTUP_TIMEOUT = 60
+RECOVERY_TIMEOUT = 60
+WARMUP = 2
+SAMPLE_INTERVAL = 0.5
+
+
+def prepare_volume(volume: str) -> None:
+    """Lays out a plugin volume the way Scrypted unpacks the plugin, linking to the working tree."""
+    unzipped = os.path.join(volume, 'zip', 'unzipped')
+    os.makedirs(unzipped, exist_ok=True)
+    for name in os.listdir(SRC_DIR):
+        if name.endswith('.py'):
+            os.symlink(os.path.join(SRC_DIR, name), os.path.join(unzipped, name))
+    os.symlink(os.path.join(REPO_DIR, 'fs'), os.path.join(unzipped, 'fs'))
+
+
+def write_fake_btop(volume: str) -> str:
+    path = os.path.join(volume, 'btop')
+    with open(path, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCH_DIR, "fake_btop.py")}" "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+class FakeBtopPlugin:
+    def __init__(self, exe: str) -> None:
+        self.exe = exe
+
+    async def getDevice(self, nativeId: str) -> Any:
+        if nativeId == 'btop-executable':
+            return self.exe
+        return None
+
+    async def getSettings(self) -> List[Dict[str, Any]]:
+        return [{'key': 'btop_executable', 'value': self.exe}]
+
+    async def putSetting(self, key: str, value: Any) -> None:
+        pass
+
+
+class StreamClient:
+    """Reads an MPEG-TS stream, recording when frames and keyframes arrive."""
+
+    def __init__(self) -> None:
+        self.frames = 0
+        self.bytes = 0
+        self.video_pid: int | None = None
+        self.keyframes: List[float] = []
+        self.keyframe_event = asyncio.Event()
+
+    def on_packet(self, packet: bytes) -> None:
+        pid = ((packet[1] & 0x1f) << 8) | packet[2]
+        if pid < TS_FIRST_STREAM_PID or not packet[1] & 0x40:
+            return
+        adaptation = (packet[3] >> 4) & 0x3
+        keyframe = adaptation & 0x2 and packet[4] > 0 and packet[5] & 0x40
+        if keyframe and self.video_pid is None:
+            # the video stream is the one carrying keyframes, which tells it apart from the PMT
+            self.video_pid = pid
+        if pid != self.video_pid:
+            return
+        self.frames += 1
+        if keyframe:
+            self.keyframes.append(time.monotonic())
+            self.keyframe_event.set()
+
+    async def read(self, reader: asyncio.StreamReader) -> None:
+        pending = b''
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            self.bytes += len(data)
+            data = pending + data
+            start = data.find(b'\x47')
+            if start < 0:
+                pending = b''
+                continue
+            usable = (len(data) - start) // TS_PACKET_SIZE * TS_PACKET_SIZE
+            for offset in range(start, start + usable, TS_PACKET_SIZE):
+                self.on_packet(data[offset:offset + TS_PACKET_SIZE])
+            pending = data[start + usable:]
+
+    async def wait_keyframe(self, after: float, timeout: float) -> float | None:
+        deadline = time.monotonic() + timeout
+        while True:
+            for t in self.keyframes:
+                if t >= after:
+                    return t
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.keyframe_event.clear()
+            try:
+                await asyncio.wait_for(self.keyframe_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+
+async def consume_shared(ffmpeg_input: Dict[str, Any], client: StreamClient) -> None:
+    url = ffmpeg_input['inputArguments'][ffmpeg_input['inputArguments'].index('-i') + 1]
+    host, port = url[len('tcp://'):].rsplit(':', 1)
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(host, int(port))
+        except OSError:
+            await asyncio.sleep(0.5)
+            continue
+        await client.read(reader)
+        writer.close()
+        await asyncio.sleep(0.5)
+
+
+async def consume_per_session(ffmpeg_input: Dict[str, Any], ffmpeg: str, client: StreamClient) -> None:
+    """Runs the capture the way Rebroadcast would, restarting it if it exits."""
+    args = [ffmpeg, '-hide_banner', '-loglevel', 'error', *ffmpeg_input['inputArguments'], *ffmpeg_input['h264EncoderArguments'],
+            '-pix_fmt', 'yuv420p', '-f', 'mpegts', 'pipe:1']
+    env = dict(os.environ, **ffmpeg_input.get('env', {}))
+    while True:
+        p = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.DEVNULL, env=env)
+        try:
+            await client.read(p.stdout)
+        finally:
+            if p.returncode is None:
+                p.kill()
+            await p.wait()
+        await asyncio.sleep(1)
+
+
+def process_kind(p: psutil.Process) -> str:
+    if p.pid == os.getpid():
+        return 'plugin'
+    name = p.name()
+    if name.startswith('ffmpeg'):
+        return 'ffmpeg'
+    if name in ('Xvfb', 'xterm'):
+        return name
+    if any('fake_btop.py' in arg for arg in p.cmdline()):
+        return 'btop'
+    return 'other'
+
+
+def tree() -> List[psutil.Process]:
+    me = psutil.Process(os.getpid())
+    return [me] + me.children(recursive=True)
+
+
+def tree_usage() -> Dict[str, Dict[str, float]]:
+    """Returns the CPU seconds and RSS of the process tree, by process kind."""
+    usage: Dict[str, Dict[str, float]] = {}
+    for p in tree():
+        try:
+            kind = process_kind(p)
+            cpu = p.cpu_times()
+            rss = p.memory_info().rss if p.is_running() else 0
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            continue
+        entry = usage.setdefault(kind, {'cpu_seconds': 0.0, 'rss_bytes': 0})
+        entry['cpu_seconds'] += cpu.user + cpu.system
+        entry['rss_bytes'] += rss
+    return usage
+
+
+def find_processes(kind: str) -> List[psutil.Process]:
+    found = []
+    for p in tree():
+        try:
+            if process_kind(p) == kind:
+                found.append(p)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return found
+
+
+async def measure_recovery(camera: Any, client: StreamClient, kind: str) -> Dict[str, Any]:
+    targets = find_processes(kind)
+    if not targets:
+        return {'error': f'no {kind} process found'}
+    killed = time.monotonic()
+    for p in targets:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+    # the display is flagged as not ready once the supervisor notices the crash
+    while camera.display_ready.is_set() and time.monotonic() - killed < RECOVERY_TIMEOUT:
+        await asyncio.sleep(0.01)
+    try:
+        await asyncio.wait_for(camera.display_ready.wait(), RECOVERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        return {'error': 'display did not become ready again'}
+    ready = time.monotonic()
+    keyframe = await client.wait_keyframe(ready, RECOVERY_TIMEOUT)
+    return {
+        'display_ready_seconds': round(ready - killed, 3),
+        'first_keyframe_seconds': round(keyframe - killed, 3) if keyframe is not None else None,
+    }
+
+
+async def worker(config: Dict[str, Any]) -> Dict[str, Any]:
+    import scrypted_sdk
+    volume = config['volume']
+    exe = write_fake_btop(volume)
+    scrypted_sdk.systemManager.add_device('btop', FakeBtopPlugin(exe), {
+        'name': '@scrypted/btop',
+        'pluginId': '@scrypted/btop',
+        'interfaces': [scrypted_sdk.ScryptedInterface.ScryptedPlugin.value],
+    })
+    scrypted_sdk.deviceManager.getDeviceStorage(None).items.update({
+        'display_engine': ENGINES[config['engine']],
+        'display_dimensions': config['dimensions'],
+        'virtual_display_num': str(config['display_num']),
+        'max_fps': str(config['fps']),
+        'encoder_mode': config['encoder_mode'],
+        'capture_mode': config['capture_mode'],
+        'display_lifecycle': 'Always On',
+    })
+
+    import main
+    started = time.monotonic()
+    camera = main.create_scrypted_plugin()
+    media = await camera.getVideoStream({'id': 'default'})
+    ffmpeg_input = media.data
+
+    client = StreamClient()
+    if config['encoder_mode'] == 'Shared' or config['engine'] == 'headless':
+        consumer = asyncio.create_task(consume_shared(ffmpeg_input, client))
+    else:
+        consumer = asyncio.create_task(consume_per_session(ffmpeg_input, await camera.get_capture_ffmpeg_path(), client))
+
+    result: Dict[str, Any] = {}
+    first = await client.wait_keyframe(started, STARTUP_TIMEOUT)
+    if first is None:
+        result['error'] = 'no frame received'
+        return result
+    result['time_to_first_frame_seconds'] = round(first - started, 3)
+
+    await asyncio.sleep(WARMUP)
+    before = tree_usage()
+    frames_before, bytes_before = client.frames, client.bytes
+    peak_rss: Dict[str, float] = {}
+    measure_started = time.monotonic()
+    while time.monotonic() - measure_started < config['duration']:
+        await asyncio.sleep(SAMPLE_INTERVAL)
+        for kind, usage in tree_usage().items():
+            peak_rss[kind] = max(peak_rss.get(kind, 0), usage['rss_bytes'])
+    elapsed = time.monotonic() - measure_started
+    after = tree_usage()
+    frames = client.frames - frames_before
+
+    cpu = {kind: after[kind]['cpu_seconds'] - before.get(kind, {}).get('cpu_seconds', 0) for kind in after}
+    result['encoded_fps'] = round(frames / elapsed, 3)
+    result['bitrate_bps'] = round((client.bytes - bytes_before) * 8 / elapsed)
+    result['cpu_seconds_per_second'] = {kind: round(value / elapsed, 4) for kind, value in cpu.items()}
+    result['cpu_seconds_per_frame'] = {kind: round(value / frames, 5) for kind, value in cpu.items()} if frames else None
+    result['peak_rss_bytes'] = peak_rss
+    result['peak_rss_bytes_total'] = sum(peak_rss.values())
+
+    recovery = {'btop': await measure_recovery(camera, client, 'btop')}
+    if config['engine'] == 'xvfb':
+        recovery['Xvfb'] = await measure_recovery(camera, client, 'Xvfb')
+    result['recovery'] = recovery
+    result['plugin_restart_requests'] = scrypted_sdk.deviceManager.restart_requests
+
+    consumer.cancel()
+    return result
+
+
+def run_worker(config: Dict[str, Any]) -> None:
+    os.environ['SCRYPTED_PLUGIN_VOLUME'] = config['volume']
+    os.environ.pop('SCRYPTED_INSTALL_ENVIRONMENT', None)
+    os.environ['FAKE_BTOP_UPDATE_MS'] = str(config['btop_update_ms'])
+    if config.get('ffmpeg'):
+        os.environ['SCRYPTED_FFMPEG_PATH'] = config['ffmpeg']
+    sys.path.insert(0, BENCH_DIR)
+    sys.path.insert(0, os.path.join(config['volume'], 'zip', 'unzipped'))
+
+    try:
+        result = asyncio.run(asyncio.wait_for(worker(config), STARTUP_TIMEOUT + config['duration'] + 3 * RECOVERY_TIMEOUT))
+    except Exception as e:
+        result = {'error': repr(e)}
+    with open(config['result'], 'w') as f:
+        json.dump(result, f)
+
+    # take down everything the plugin started
+    for p in psutil.Process(os.getpid()).children(recursive=True):
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+    os._exit(0)
+
+
+def ffmpeg_version(ffmpeg: str) -> str | None:
+    try:
+        return subprocess.check_output([ffmpeg, '-version']).decode().splitlines()[0]
+    except:
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks display startup, capture cost and recovery time.")
+    parser.add_argument('--engine', default='all', choices=['all', *ENGINES.keys()])
+    parser.add_argument('--dimensions', default='1024x720', help="Comma separated display dimensions, such as 1024x720,1920x1080.")
+    parser.add_argument('--fps', default='5', help="Comma separated frame rates.")
+    parser.add_argument('--encoder-mode', default='Shared', choices=['Shared', 'Per-Session'])
+    parser.add_argument('--capture-mode', default='Fixed Rate', choices=['Fixed Rate', 'Damage-Driven'])
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to measure encode cost for.")
+    parser.add_argument('--btop-update-ms', type=int, default=2000, help="Redraw interval of the fake btop.")
+    parser.add_argument('--ffmpeg', default=os.environ.get('SCRYPTED_FFMPEG_PATH') or shutil.which('ffmpeg'))
+    parser.add_argument('--output', help="File to write the JSON results to, instead of stdout.")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(json.loads(args.worker))
+        return
+
+    if not args.ffmpeg:
+        parser.error("FFmpeg not found, pass --ffmpeg")
+
+    engines = list(ENGINES.keys()) if args.engine == 'all' else [args.engine]
+    results = []
+    display_num = 90
+    for engine in engines:
+        for dimensions in args.dimensions.split(','):
+            for fps in args.fps.split(','):
+                config = {
+                    'engine': engine,
+                    'dimensions': dimensions.strip(),
+                    'fps': int(fps),
+                    'encoder_mode': args.encoder_mode,
+                    'capture_mode': args.capture_mode,
+                    'duration': args.duration,
+                    'btop_update_ms': args.btop_update_ms,
+                    'ffmpeg': args.ffmpeg,
+                    'display_num': display_num,
+                }
+                display_num += 1
+                entry = {key: config[key] for key in ('engine', 'dimensions', 'fps', 'encoder_mode', 'capture_mode')}
+                print(f"Running {entry}", file=sys.stderr)
+
+                if engine == 'xvfb' and not (shutil.which('Xvfb') and shutil.which('xterm')):
+                    entry['skipped'] = "Xvfb or xterm not installed"
+                    results.append(entry)
+                    continue
+
+                with tempfile.TemporaryDirectory(prefix='btop-camera-bench-') as volume:
+                    prepare_volume(volume)
+                    config['volume'] = volume
+                    config['result'] = os.path.join(volume, 'result.json')
+                    log = os.path.join(volume, 'worker.log')
+                    with open(log, 'w') as f:
+                        code = subprocess.call([sys.executable, os.path.abspath(__file__), '--worker', json.dumps(config)],
+                                               stdout=f, stderr=subprocess.STDOUT, start_new_session=True)
+                    try:
+                        with open(config['result']) as f:
+                            entry.update(json.load(f))
+                    except (OSError, ValueError):
+                        entry['error'] = f"worker exited with code {code}"
+                    if 'error' in entry:
+                        with open(log) as f:
+                            entry['log_tail'] = f.read()[-4000:]
+                results.append(entry)
+
+    output = json.dumps({
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'ffmpeg': ffmpeg_version(args.ffmpeg),
+        },
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Stand-in for the parts of scrypted_sdk used by the plugin, so that it can be benchmarked without a Scrypted server.
+
+Storage is kept in memory and can be seeded through deviceManager.storage before the plugin is created. Media
+objects returned by mediaManager expose the FFmpeg input that Scrypted would otherwise consume."""
+
+import enum
+import os
+import shutil
+from typing import Any, Callable, Dict, List
+
+
+class ScryptedInterface(enum.Enum):
+    Camera = 'Camera'
+    DeviceProvider = 'DeviceProvider'
+    HttpRequestHandler = 'HttpRequestHandler'
+    Readme = 'Readme'
+    Scriptable = 'Scriptable'
+    ScryptedDevice = 'ScryptedDevice'
+    ScryptedPlugin = 'ScryptedPlugin'
+    Settings = 'Settings'
+    VideoCamera = 'VideoCamera'
+
+
+class ScryptedDeviceType(enum.Enum):
+    API = 'API'
+    Camera = 'Camera'
+
+
+class ScryptedMimeTypes(enum.Enum):
+    FFmpegInput = 'x-scrypted/x-ffmpeg-input'
+
+
+# interfaces are plain mixins, and the option/result types are dictionaries
+class VideoCamera: pass
+class Camera: pass
+class Settings: pass
+class DeviceProvider: pass
+class Scriptable: pass
+class Readme: pass
+class HttpRequestHandler: pass
+
+
+ResponseMediaStreamOptions = Dict[str, Any]
+RequestMediaStreamOptions = Dict[str, Any]
+RequestPictureOptions = Dict[str, Any]
+ResponsePictureOptions = Dict[str, Any]
+Setting = Dict[str, Any]
+ScriptSource = Dict[str, Any]
+HttpRequest = Dict[str, Any]
+ScryptedDevice = Any
+
+
+class MediaObject:
+    def __init__(self, data: Any, mimeType: str) -> None:
+        self.data = data
+        self.mimeType = mimeType
+
+
+class HttpResponse:
+    def __init__(self) -> None:
+        self.body = None
+        self.options = None
+
+    def send(self, body: Any, options: Dict[str, Any] = None) -> None:
+        self.body = body
+        self.options = options
+
+    def sendStream(self, stream: Any, options: Dict[str, Any] = None) -> None:
+        self.body = stream
+        self.options = options
+
+
+class Storage:
+    def __init__(self) -> None:
+        self.items: Dict[str, str] = {}
+
+    def getItem(self, key: str) -> str | None:
+        return self.items.get(key)
+
+    def setItem(self, key: str, value: str) -> None:
+        self.items[key] = value
+
+    def removeItem(self, key: str) -> None:
+        self.items.pop(key, None)
+
+
+class DeviceManager:
+    def __init__(self) -> None:
+        self.storage: Dict[str | None, Storage] = {}
+        self.discovered: List[Dict[str, Any]] = []
+        self.restart_requests = 0
+
+    def getDeviceStorage(self, nativeId: str | None = None) -> Storage:
+        return self.storage.setdefault(nativeId, Storage())
+
+    async def onDeviceDiscovered(self, device: Dict[str, Any]) -> str:
+        self.discovered.append(device)
+        return device['nativeId']
+
+    async def onDeviceRemoved(self, nativeId: str) -> None:
+        self.discovered = [device for device in self.discovered if device['nativeId'] != nativeId]
+
+    async def requestRestart(self) -> None:
+        self.restart_requests += 1
+        print("Plugin restart requested")
+
+
+class Logger:
+    async def log(self, level: str, message: str) -> None:
+        print(f"[{level}]", message)
+
+
+class ScryptedApi:
+    async def getLogger(self, nativeId: str | None) -> Logger:
+        return Logger()
+
+
+class EventListenerRegister:
+    def __init__(self, listeners: List, callback: Callable) -> None:
+        self.listeners = listeners
+        self.callback = callback
+
+    def removeListener(self) -> None:
+        if self.callback in self.listeners:
+            self.listeners.remove(self.callback)
+
+
+class SystemManager:
+    def __init__(self) -> None:
+        self.systemState: Dict[str, Dict[str, Any]] = {}
+        self.devices: Dict[str, Any] = {}
+        self.listeners: List[Callable] = []
+        self.api = ScryptedApi()
+
+    def add_device(self, id: str, device: Any, state: Dict[str, Any]) -> None:
+        self.devices[id] = device
+        self.systemState[id] = {key: {'value': value} for key, value in state.items()}
+
+    def getDeviceById(self, id: str) -> Any:
+        return self.devices.get(id)
+
+    def getDeviceByName(self, name: str) -> Any:
+        for id, state in self.systemState.items():
+            if state.get('name', {}).get('value') == name or state.get('pluginId', {}).get('value') == name:
+                return self.devices.get(id)
+        return None
+
+    def listen(self, callback: Callable) -> EventListenerRegister:
+        self.listeners.append(callback)
+        return EventListenerRegister(self.listeners, callback)
+
+
+class MediaManager:
+    async def createFFmpegMediaObject(self, ffmpegInput: Dict[str, Any], options: Dict[str, Any] = None) -> MediaObject:
+        return MediaObject(ffmpegInput, ScryptedMimeTypes.FFmpegInput.value)
+
+    async def createMediaObject(self, data: Any, mimeType: str, options: Dict[str, Any] = None) -> MediaObject:
+        return MediaObject(data, mimeType)
+
+    async def getFFmpegPath(self) -> str:
+        return os.environ.get('SCRYPTED_FFMPEG_PATH') or shutil.which('ffmpeg') or 'ffmpeg'
+
+
+class EndpointManager:
+    async def getPath(self, nativeId: str | None = None, options: Dict[str, Any] = None) -> str:
+        return f"/endpoint/bench/{nativeId or ''}"
+
+
+class ScryptedDeviceBase:
+    def __init__(self, nativeId: str | None = None) -> None:
+        self.nativeId = nativeId
+        self.storage = deviceManager.getDeviceStorage(nativeId)
+
+    def print(self, *args: Any) -> None:
+        print(*args)
+
+    async def onDeviceEvent(self, eventInterface: str, eventData: Any) -> None:
+        pass
+
+
+deviceManager = DeviceManager()
+systemManager = SystemManager()
+mediaManager = MediaManager()
+endpointManager = EndpointManager()
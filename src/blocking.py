@@ -0,0 +1,103 @@
+import asyncio
+import concurrent.futures
+import functools
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable, Tuple
+
+
+# downloads hold up to DownloaderBase.MAX_PARALLEL_DOWNLOADS of these threads, the rest are left for short calls
+MAX_WORKERS = 8
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='btop-blocking')
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Runs a blocking call, such as file I/O or a process scan, on the plugin's executor so that the
+    event loop keeps serving streams in the meantime."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+class LoopLagMonitor:
+    """Detects stalls of the event loop, which delay every stream and request the plugin serves.
+
+    A heartbeat task measures how late its timer fires. While the heartbeat is overdue, a watchdog thread
+    captures the stack of the event loop thread, so that each stall is logged along with the code that
+    caused it. The full stack is only logged the first time a call site stalls the loop."""
+
+    INTERVAL = 0.05
+    THRESHOLD = 0.2
+
+    def __init__(self, threshold: float = THRESHOLD, log: Callable[..., None] = print) -> None:
+        self.threshold = threshold
+        self.log = log
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.heartbeat = time.monotonic()
+        # (heartbeat, stack) of the loop thread, taken by the watchdog during the current stall
+        self.stall_stack: Tuple[float, traceback.StackSummary] | None = None
+        self.reported_sites = set()
+        self.loop_thread = None
+        self.task = None
+
+    def start(self) -> None:
+        if self.task is not None:
+            return
+        self.loop_thread = threading.get_ident()
+        self.task = asyncio.ensure_future(self.run())
+        threading.Thread(target=self.watch, name='loop-lag-monitor', daemon=True).start()
+
+    async def run(self) -> None:
+        while True:
+            heartbeat = time.monotonic()
+            self.heartbeat = heartbeat
+            await asyncio.sleep(LoopLagMonitor.INTERVAL)
+            lag = max(0.0, time.monotonic() - heartbeat - LoopLagMonitor.INTERVAL)
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            if lag < self.threshold:
+                continue
+
+            self.stalls += 1
+            self.stalled_seconds += lag
+            stall_stack, self.stall_stack = self.stall_stack, None
+            stack = stall_stack[1] if stall_stack and stall_stack[0] == heartbeat else None
+            self.report(lag, stack)
+
+    def watch(self) -> None:
+        # runs on its own thread, since the event loop cannot observe itself while it is stalled
+        while True:
+            time.sleep(LoopLagMonitor.INTERVAL)
+            heartbeat = self.heartbeat
+            if time.monotonic() - heartbeat < self.threshold:
+                continue
+            if self.stall_stack is not None and self.stall_stack[0] == heartbeat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                self.stall_stack = (heartbeat, traceback.extract_stack(frame))
+
+    def report(self, lag: float, stack: traceback.StackSummary | None) -> None:
+        if not stack:
+            self.log(f"Event loop stalled for {lag * 1000:.0f} ms")
+            return
+        # name the innermost frame in the plugin's own code, rather than the library call that blocked
+        site = next((frame for frame in reversed(stack) if frame.filename.startswith(PLUGIN_DIR)), stack[-1])
+        key = (site.filename, site.lineno)
+        self.log(f"Event loop stalled for {lag * 1000:.0f} ms in {site.name} ({site.filename}:{site.lineno})")
+        if key not in self.reported_sites:
+            self.reported_sites.add(key)
+            # the frames of the event loop itself are the same for every stall
+            start = max((i + 1 for i, frame in enumerate(stack) if frame.filename.startswith(ASYNCIO_DIR)), default=0)
+            if start >= len(stack):
+                start = 0
+            self.log(''.join(traceback.format_list(stack[start:])).rstrip())
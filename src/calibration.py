@@ -0,0 +1,117 @@
+import asyncio
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, List
+
+from blocking import run_blocking
+from resources import governor
+from tracing import tracer
+
+
+# printed by FFmpeg's -benchmark option when it exits
+BENCHMARK = re.compile(r'bench: utime=([\d.]+)s stime=([\d.]+)s')
+PSNR = re.compile(r'PSNR .*average:([\d.]+|inf)')
+SSIM = re.compile(r'SSIM .*All:([\d.]+)')
+
+# both sides are compared at full chroma resolution, so that the loss from subsampling counts against a profile
+QUALITY_FILTER = '[0:v]setpts=PTS-STARTPTS,format=yuv444p[encoded];' \
+                 '[1:v]setpts=PTS-STARTPTS,format=yuv444p,split[reference1][reference2];' \
+                 '[encoded][reference1]psnr[measured];[measured][reference2]ssim'
+
+
+def discard(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+
+
+async def run_ffmpeg(args: List[str], feeder: Callable[[asyncio.StreamWriter], Awaitable[None]] | None = None, env: Dict[str, str] | None = None) -> str:
+    """Runs FFmpeg to completion, returning its log output."""
+    p = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.PIPE if feeder else asyncio.subprocess.DEVNULL,
+                                             stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE, env=env)
+    await run_blocking(governor.apply, p.pid, 'calibration')
+
+    async def feed():
+        try:
+            await feeder(p.stdin)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            p.stdin.close()
+
+    feeder_task = asyncio.create_task(feed()) if feeder else None
+    try:
+        stderr = (await p.stderr.read()).decode('utf-8', errors='replace')
+        await p.wait()
+    finally:
+        if p.returncode is None:
+            try:
+                p.kill()
+            except ProcessLookupError:
+                pass
+            await p.wait()
+        if feeder_task is not None:
+            feeder_task.cancel()
+    if p.returncode != 0:
+        raise Exception(f"FFmpeg exited with code {p.returncode}: {stderr.strip()[-500:]}")
+    return stderr
+
+
+def cpu_seconds(log: str) -> float:
+    match = BENCHMARK.search(log)
+    if match is None:
+        raise Exception("FFmpeg did not report its CPU time.")
+    return float(match.group(1)) + float(match.group(2))
+
+
+async def record_sample(ffmpeg: str, input_arguments: List[str], path: str, seconds: float, fps: float, env: Dict[str, str] | None = None,
+                        feeder: Callable[[asyncio.StreamWriter], Awaitable[None]] | None = None) -> None:
+    """Records the display losslessly and at a constant frame rate, as the reference every profile is encoded from."""
+    with tracer.span('calibration sample', seconds=seconds):
+        await run_ffmpeg([ffmpeg, '-hide_banner', '-loglevel', 'error', *input_arguments, '-t', str(seconds),
+                          '-r', str(fps), '-c:v', 'ffv1', '-y', path], feeder, env)
+
+
+async def calibrate(ffmpeg: str, sample: str, seconds: float, profiles: Dict[str, List[str]], workdir: str) -> List[Dict[str, Any]]:
+    """Encodes the sample with the encoder arguments of each profile, measuring bitrate, encode CPU time and
+    quality against the sample."""
+    # decoding the sample costs the same for every profile, and is not counted against them
+    baseline = cpu_seconds(await run_ffmpeg([ffmpeg, '-hide_banner', '-benchmark', '-i', sample, '-f', 'null', '-']))
+
+    results = []
+    for name, encoder_arguments in profiles.items():
+        # Matroska adds little overhead, so the bitrate is close to that of the video itself
+        encoded = os.path.join(workdir, 'encoded.mkv')
+        try:
+            with tracer.span('calibration encode', profile=name):
+                log = await run_ffmpeg([ffmpeg, '-hide_banner', '-benchmark', '-i', sample, *encoder_arguments, '-f', 'matroska', '-y', encoded])
+            size = await run_blocking(os.path.getsize, encoded)
+            log_quality = await run_ffmpeg([ffmpeg, '-hide_banner', '-i', encoded, '-i', sample, '-lavfi', QUALITY_FILTER, '-f', 'null', '-'])
+        except Exception as e:
+            results.append({"profile": name, "error": str(e)})
+            continue
+        finally:
+            await run_blocking(discard, encoded)
+
+        psnr = PSNR.search(log_quality)
+        ssim = SSIM.search(log_quality)
+        results.append({
+            "profile": name,
+            "bitrate_kbps": round(size * 8 / seconds / 1000, 1),
+            "cpu_seconds_per_second": round(max(0.0, cpu_seconds(log) - baseline) / seconds, 4),
+            "psnr_db": float(psnr.group(1)) if psnr else None,
+            "ssim": float(ssim.group(1)) if ssim else None,
+        })
+    return results
+
+
+def format_results(results: List[Dict[str, Any]]) -> str:
+    lines = [f"{'Profile':<15} {'Bitrate':>12} {'CPU':>6} {'PSNR':>10} {'SSIM':>9}"]
+    for result in results:
+        if 'error' in result:
+            lines.append(f"{result['profile']:<15} failed: {result['error']}")
+            continue
+        psnr = f"{result['psnr_db']:.2f} dB" if result['psnr_db'] is not None else '-'
+        ssim = f"{result['ssim']:.4f}" if result['ssim'] is not None else '-'
+        lines.append(f"{result['profile']:<15} {result['bitrate_kbps']:>7.0f} kbps "
+                     f"{result['cpu_seconds_per_second'] * 100:>5.1f}% {psnr:>10} {ssim:>9}")
+    return "\n".join(lines)
@@ -0,0 +1,106 @@
+from typing import Any, Dict
+
+import scrypted_sdk
+from scrypted_sdk import ScryptedInterface
+
+
+# properties of the ScryptedDevice interface that the index is keyed on
+INDEXED_PROPERTIES = ('name', 'pluginId', 'interfaces')
+
+
+class DeviceIndex:
+    """Index of the system's devices by name, and of plugins by plugin id, for SystemManager.getDeviceByName.
+
+    The index is built from systemState on first use and kept current from device events. Lookups check the
+    indexed device's state before returning it, and a miss or a stale entry rebuilds the index, so events
+    that are missed or arrive late cannot cause a wrong result."""
+
+    def __init__(self, system_manager: Any) -> None:
+        self.system_manager = system_manager
+        self.by_name: Dict[str, str] = {}
+        self.by_plugin_id: Dict[str, str] = {}
+        # the keys each device is indexed under, so that they can be dropped when it changes
+        self.keys: Dict[str, Dict[str, str | None]] = {}
+        self.built = False
+        self.listener = None
+
+    @staticmethod
+    def value(state: Dict[str, Any], property: str) -> Any:
+        entry = state.get(property, None)
+        if not entry:
+            return None
+        return entry.get('value', None)
+
+    def keys_of(self, state: Dict[str, Any] | None) -> Dict[str, str | None]:
+        if not state:
+            return {'name': None, 'pluginId': None}
+        plugin_id = None
+        interfaces = self.value(state, 'interfaces') or []
+        if ScryptedInterface.ScryptedPlugin.value in interfaces:
+            plugin_id = self.value(state, 'pluginId')
+        return {'name': self.value(state, 'name'), 'pluginId': plugin_id}
+
+    def build(self) -> None:
+        self.by_name.clear()
+        self.by_plugin_id.clear()
+        self.keys.clear()
+        for id in list(self.system_manager.systemState):
+            self.update(id)
+        self.built = True
+        if self.listener is None:
+            self.listener = self.system_manager.listen(self.on_event)
+
+    def update(self, id: str) -> None:
+        old = self.keys.pop(id, None)
+        if old:
+            if old['name'] is not None and self.by_name.get(old['name']) == id:
+                del self.by_name[old['name']]
+            if old['pluginId'] is not None and self.by_plugin_id.get(old['pluginId']) == id:
+                del self.by_plugin_id[old['pluginId']]
+
+        keys = self.keys_of(self.system_manager.systemState.get(id, None))
+        if keys['name'] is None and keys['pluginId'] is None:
+            return
+        self.keys[id] = keys
+        # like the linear scan this replaces, the first device with a given name wins
+        if keys['name'] is not None:
+            self.by_name.setdefault(keys['name'], id)
+        if keys['pluginId'] is not None:
+            self.by_plugin_id.setdefault(keys['pluginId'], id)
+
+    def on_event(self, eventSource: Any, eventDetails: Any, eventData: Any) -> None:
+        try:
+            if eventDetails.get('eventInterface', None) != ScryptedInterface.ScryptedDevice.value:
+                return
+            property = eventDetails.get('property', None)
+            if property is not None and property not in INDEXED_PROPERTIES:
+                return
+            id = getattr(eventSource, 'id', None)
+        except:
+            return
+        if id is None:
+            # a device was added or removed without saying which
+            self.built = False
+        elif self.built:
+            self.update(id)
+
+    def lookup(self, name: str) -> str | None:
+        id = self.by_plugin_id.get(name, None) or self.by_name.get(name, None)
+        if id is None:
+            return None
+        keys = self.keys_of(self.system_manager.systemState.get(id, None))
+        if name not in (keys['name'], keys['pluginId']):
+            return None
+        return id
+
+    def getDeviceByName(self, name: str) -> scrypted_sdk.ScryptedDevice:
+        if not self.built:
+            self.build()
+        id = self.lookup(name)
+        if id is None:
+            # the device may have been added or renamed without an event reaching us yet
+            self.build()
+            id = self.lookup(name)
+        if id is None:
+            return None
+        return self.system_manager.getDeviceById(id)
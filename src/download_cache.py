@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import json
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Any, Callable, Dict, List
+
+from blocking import run_blocking
+
+
+class DownloadCache:
+    """Content-addressed cache of downloaded files.
+
+    Completed downloads are stored under objects/ by their SHA-256, and index.json maps each URL to
+    its object along with the ETag and Last-Modified validators used to revalidate it. Interrupted
+    downloads are kept under partial/ and resumed with a Range request. A URL may declare the
+    expected hash of its contents with a #sha256=<hex> fragment."""
+
+    CHUNK_SIZE = 1024 * 1024
+    TIMEOUT = 60
+
+    def __init__(self, root: str, max_parallel: int = 4, log: Callable[..., None] = print) -> None:
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.partial_dir = os.path.join(root, 'partial')
+        self.index_path = os.path.join(root, 'index.json')
+        self.semaphore = asyncio.Semaphore(max_parallel)
+        self.log = log
+        self.index: Dict[str, Dict[str, Any]] | None = None
+        # in-flight fetches keyed by URL, so concurrent requests for the same file share one download
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    def load_index(self) -> Dict[str, Dict[str, Any]]:
+        if self.index is None:
+            try:
+                with open(self.index_path) as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+        return self.index
+
+    def save_index(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp, self.index_path)
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256)
+
+    async def fetch_all(self, urls: List[str]) -> List[str]:
+        """Downloads all of the URLs concurrently, bounded by max_parallel, returning their cached paths."""
+        return await asyncio.gather(*[self.fetch(url) for url in urls])
+
+    async def fetch(self, url: str) -> str:
+        """Returns the path of the cached contents of the URL, downloading or revalidating as needed."""
+        url, fragment = urllib.parse.urldefrag(url)
+        expected = None
+        if fragment.startswith('sha256='):
+            expected = fragment[len('sha256='):].lower()
+
+        pending = self.pending.get(url)
+        if pending is None:
+            pending = asyncio.ensure_future(self.refresh(url, expected))
+            self.pending[url] = pending
+            pending.add_done_callback(lambda _: self.pending.pop(url, None))
+        sha256 = await asyncio.shield(pending)
+        if expected and sha256 != expected:
+            raise Exception(f"Hash mismatch for {url}: expected {expected}, got {sha256}")
+        return self.object_path(sha256)
+
+    async def refresh(self, url: str, expected: str | None) -> str:
+        index = self.load_index()
+        entry = index.get(url)
+        if entry and not os.path.isfile(self.object_path(entry['sha256'])):
+            entry = None
+        if entry and expected and entry['sha256'] == expected:
+            # content is pinned by hash, so there is nothing to revalidate
+            return entry['sha256']
+
+        async with self.semaphore:
+            try:
+                result = await run_blocking(self.download, url, entry, expected)
+            except Exception as e:
+                if entry and not expected:
+                    self.log("Could not revalidate", url, "using cached copy:", e)
+                    return entry['sha256']
+                raise
+
+        index[url] = result
+        await run_blocking(self.save_index)
+        return result['sha256']
+
+    def download(self, url: str, entry: Dict[str, Any] | None, expected: str | None) -> Dict[str, Any]:
+        """Blocking download of the URL into the cache. Returns the new index entry."""
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+        url_key = hashlib.sha256(url.encode()).hexdigest()
+        tmp = os.path.join(self.partial_dir, url_key + '.tmp')
+        tmp_meta = tmp + '.json'
+
+        headers = {}
+        partial_size = 0
+        partial_meta = {}
+        if os.path.isfile(tmp):
+            try:
+                with open(tmp_meta) as f:
+                    partial_meta = json.load(f)
+            except (OSError, ValueError):
+                partial_meta = {}
+            validator = partial_meta.get('etag') or partial_meta.get('last_modified')
+            if validator:
+                partial_size = os.path.getsize(tmp)
+                headers['Range'] = f'bytes={partial_size}-'
+                headers['If-Range'] = validator
+        if not partial_size and entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            response = urllib.request.urlopen(request, timeout=DownloadCache.TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry:
+                self.log("Not modified", url)
+                return entry
+            if e.code == 416 and partial_size:
+                # the partial download is no longer valid for this resource, start over
+                os.remove(tmp)
+                return self.download(url, entry, expected)
+            raise
+
+        with response:
+            status = response.getcode()
+            if status is not None and (status < 200 or status >= 300):
+                raise Exception(f"Error downloading {url}: HTTP {status}")
+
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            length = response.headers.get('Content-Length')
+
+            hasher = hashlib.sha256()
+            if status == 206 and partial_size:
+                self.log("Resuming", url, "at", partial_size, "bytes")
+                with open(tmp, 'rb') as f:
+                    while True:
+                        data = f.read(DownloadCache.CHUNK_SIZE)
+                        if not data:
+                            break
+                        hasher.update(data)
+                mode = 'ab'
+                read = partial_size
+                total = partial_size + int(length) if length else None
+            else:
+                self.log("Downloading", url)
+                mode = 'wb'
+                read = 0
+                total = int(length) if length else None
+
+            with open(tmp_meta, 'w') as f:
+                json.dump({'etag': etag, 'last_modified': last_modified}, f)
+
+            with open(tmp, mode) as f:
+                while True:
+                    data = response.read(DownloadCache.CHUNK_SIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    f.write(data)
+                    read += len(data)
+                    self.log("Downloaded", read, "bytes of", url)
+
+        # a connection dropped mid-body ends the reads without an error, keep what arrived for resuming
+        if total is not None and read < total:
+            raise Exception(f"Download of {url} interrupted after {read} of {total} bytes")
+
+        sha256 = hasher.hexdigest()
+        if expected and sha256 != expected:
+            os.remove(tmp)
+            os.remove(tmp_meta)
+            raise Exception(f"Hash mismatch for {url}: expected {expected}, got {sha256}")
+
+        os.replace(tmp, self.object_path(sha256))
+        os.remove(tmp_meta)
+        return {
+            'sha256': sha256,
+            'size': read,
+            'etag': etag,
+            'last_modified': last_modified,
+            'filename': urllib.parse.unquote(urllib.parse.urlparse(url).path.split('/')[-1]),
+        }
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+from typing import Any, Awaitable, Callable, Dict, List
+
+from blocking import run_blocking
+from tracing import trace_phase, tracer
+
+
+# fontconfig spacing values for monospace (100), dual width (90) and character cell (110) fonts
+MONOSPACE_SPACINGS = ('90', '100', '110')
+REGULAR_STYLES = ('Regular', 'Book', 'Normal', 'Roman', 'Medium')
+FONT_FORMAT = r'%{family}\t%{style}\t%{spacing}\t%{file}\n'
+
+INDEX_VERSION = 1
+
+
+def parse_fc_output(out: str) -> Dict[str, Dict[str, Any]]:
+    """Parses fc-list/fc-query output in FONT_FORMAT into index entries keyed by font file."""
+    files = {}
+    for line in out.splitlines():
+        parts = line.split('\t')
+        if len(parts) != 4:
+            continue
+        family, style, spacing, file = [part.strip() for part in parts]
+        if not family or not file:
+            continue
+        files[file] = {
+            'family': family,
+            'style': style,
+            'monospace': spacing in MONOSPACE_SPACINGS,
+        }
+    return files
+
+
+class FontIndex:
+    """Persistent index of the installed font families.
+
+    Families are enumerated with fc-list once and stored alongside the modification times of the font
+    and fontconfig cache directories. As long as those are unchanged, later loads are served from the
+    stored index without running fontconfig. Fonts installed at runtime are added with fc-query."""
+
+    def __init__(self, path: str, run: Callable[[List[str]], Awaitable[str]], state: Callable[[], Awaitable[Dict[str, float]]]) -> None:
+        """run executes a fontconfig command and returns its output. state returns the modification times
+        of the directories whose changes invalidate the index."""
+        self.path = path
+        self.run = run
+        self.state = state
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.loaded: asyncio.Future | None = None
+
+    def ensure_loaded(self) -> asyncio.Future:
+        if self.loaded is None:
+            self.track(asyncio.ensure_future(trace_phase('font index', self.load())))
+        return self.loaded
+
+    def reload(self) -> asyncio.Future:
+        """Loads the index again, enumerating fonts if the directories changed since it was stored."""
+        self.track(asyncio.ensure_future(self.load()))
+        return self.loaded
+
+    def track(self, loading: asyncio.Future) -> None:
+        self.loaded = loading
+
+        def on_done(future: asyncio.Future) -> None:
+            # fontconfig may not be installed yet, such as while the Docker packages install, so a failed
+            # load is not kept and the next caller tries again
+            if self.loaded is future and (future.cancelled() or future.exception() is not None or future.result() is False):
+                self.loaded = None
+
+        loading.add_done_callback(on_done)
+
+    async def load(self) -> bool:
+        """Returns False if fonts could not be enumerated."""
+        state = await self.state()
+        try:
+            index = await run_blocking(self.read)
+            if index.get('version') == INDEX_VERSION and index.get('state') == state:
+                self.files = index['files']
+                print("Loaded", len(self.families()), "font families from index")
+                return True
+        except (OSError, ValueError, KeyError):
+            pass
+
+        try:
+            with tracer.span('fc-list'):
+                self.files = parse_fc_output(await self.run(['fc-list', '--format', FONT_FORMAT]))
+        except:
+            print("Could not enumerate fonts with fc-list")
+            import traceback
+            traceback.print_exc()
+            return False
+        print("Indexed", len(self.families()), "font families")
+        await self.save(state)
+        return True
+
+    async def add_files(self, paths: List[str]) -> None:
+        """Indexes newly installed font files without enumerating every font again."""
+        await self.ensure_loaded()
+        paths = [path for path in paths if path not in self.files]
+        if not paths:
+            return
+        try:
+            with tracer.span('fc-query', files=len(paths)):
+                self.files.update(parse_fc_output(await self.run(['fc-query', '--format', FONT_FORMAT, *paths])))
+        except:
+            print("Could not index fonts with fc-query")
+            import traceback
+            traceback.print_exc()
+            return
+        await self.save(await self.state())
+
+    def read(self) -> Dict[str, Any]:
+        with open(self.path) as f:
+            return json.load(f)
+
+    def write(self, index: Dict[str, Any]) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, self.path)
+
+    async def save(self, state: Dict[str, float]) -> None:
+        try:
+            await run_blocking(self.write, {'version': INDEX_VERSION, 'state': state, 'files': dict(self.files)})
+        except OSError:
+            print("Could not save font index")
+
+    def families(self) -> List[str]:
+        return sorted(set(entry['family'] for entry in self.files.values()))
+
+    def monospace_families(self) -> List[str]:
+        return sorted(set(entry['family'] for entry in self.files.values() if entry['monospace']))
+
+    def font_file(self, family: str) -> str | None:
+        """Returns a font file for the family, preferring its regular style."""
+        candidates = [(file, entry) for file, entry in self.files.items() if entry['family'] == family]
+        if not candidates:
+            return None
+        for file, entry in candidates:
+            if any(style in REGULAR_STYLES for style in entry['style'].split(',')):
+                return file
+        return candidates[0][0]
+
+
+def directory_state(roots: List[str]) -> Dict[str, float]:
+    """Returns the modification times of the given directories and their subdirectories."""
+    state = {}
+    for root in roots:
+        for dirpath, _, _ in os.walk(os.path.expanduser(root)):
+            try:
+                state[dirpath] = os.stat(dirpath).st_mtime
+            except OSError:
+                pass
+    return state
@@ -0,0 +1,129 @@
+import mmap
+import os
+import struct
+import time
+from typing import Tuple
+
+from PIL import Image
+
+
+# the XWD file header, 25 big-endian CARD32 fields
+XWD_HEADER = struct.Struct('>25I')
+XWD_VERSION = 7
+XWD_COLOR_SIZE = 12
+Z_PIXMAP = 2
+LSB_FIRST = 0
+
+# FFmpeg pixel format and PIL raw mode of 32-bit pixels, by (red mask, byte order)
+PIXEL_FORMATS = {
+    (0xff0000, LSB_FIRST): ('bgr0', 'BGRX'),
+    (0xff0000, 1): ('0rgb', 'XRGB'),
+    (0x0000ff, LSB_FIRST): ('rgb0', 'RGBX'),
+    (0x0000ff, 1): ('0bgr', 'XBGR'),
+}
+
+SCREEN_FILE = 'Xvfb_screen0'
+
+
+class XwdFramebuffer:
+    """The screen of an Xvfb server started with -fbdir, which keeps its framebuffer in a memory-mapped XWD file.
+
+    Frames are read straight from the shared mapping, without X requests or intermediate copies. The file is
+    created anew whenever the X server restarts, so it is checked periodically and mapped again if replaced."""
+
+    CHECK_INTERVAL = 1
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.map: mmap.mmap | None = None
+        self.inode = None
+        self.checked = 0
+        self.width = 0
+        self.height = 0
+        self.stride = 0
+        self.offset = 0
+        self.pix_fmt: str | None = None
+        self.raw_mode: str | None = None
+
+    def open(self) -> bool:
+        """Maps the framebuffer, returning False if the X server has not created it yet or is still writing
+        its header. Raises ValueError for a pixel format that cannot be read."""
+        self.close()
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            st = os.fstat(fd)
+            if st.st_size < XWD_HEADER.size:
+                return False
+            m = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+        (header_size, version, pixmap_format, depth, width, height, xoffset, byte_order, bitmap_unit, bitmap_bit_order,
+         bitmap_pad, bits_per_pixel, bytes_per_line, visual_class, red_mask, green_mask, blue_mask, bits_per_rgb,
+         colormap_entries, ncolors, *window) = XWD_HEADER.unpack_from(m, 0)
+        formats = PIXEL_FORMATS.get((red_mask, byte_order))
+        offset = header_size + ncolors * XWD_COLOR_SIZE
+        if version != XWD_VERSION or header_size < XWD_HEADER.size or not width or not height \
+                or offset + bytes_per_line * height > len(m):
+            # created but not written out yet, such as while the X server restarts
+            m.close()
+            return False
+        if pixmap_format != Z_PIXMAP or bits_per_pixel != 32 or formats is None or bytes_per_line != width * 4:
+            m.close()
+            raise ValueError(f"Unsupported framebuffer format in {self.path}: {bits_per_pixel} bits per pixel, depth {depth}, "
+                             f"red mask {red_mask:#x}")
+
+        self.map = m
+        self.inode = st.st_ino
+        self.width = width
+        self.height = height
+        self.stride = bytes_per_line
+        self.offset = offset
+        self.pix_fmt, self.raw_mode = formats
+        return True
+
+    def replaced(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    def frame(self) -> memoryview | None:
+        """Returns a view of the pixels currently on screen, or None if the framebuffer is not available.
+        Raises ValueError if its pixel format cannot be read.
+
+        The view reads the live framebuffer, so it should be released as soon as it has been written out."""
+        now = time.monotonic()
+        if self.map is None or now - self.checked >= XwdFramebuffer.CHECK_INTERVAL:
+            self.checked = now
+            if (self.map is None or self.replaced()) and not self.open():
+                return None
+        return memoryview(self.map)[self.offset:self.offset + self.stride * self.height]
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+    def image(self, rect: Tuple[int, int, int, int] = None) -> Image.Image | None:
+        """Copies the screen, or a rectangle of it, into an RGB image."""
+        view = self.frame()
+        if view is None:
+            return None
+        with view:
+            image = Image.frombytes('RGB', self.size, view, 'raw', self.raw_mode, self.stride, 1)
+        if rect:
+            x, y, w, h = rect
+            image = image.crop((x, y, x + w, y + h))
+        return image
+
+    def close(self) -> None:
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # a frame is still being written out, the mapping is closed once it is released
+                pass
+            self.map = None
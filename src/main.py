@@ -1,45 +1,44 @@
 import asyncio
 import hashlib
+import io
 import json
+import math
 import os
 import pathlib
 import platform
+import shlex
 import shutil
 import subprocess
-import sys
-import types
-from typing import Any, Dict, Tuple
-import urllib.request
+from typing import Any, Awaitable, Callable, Dict, Tuple
+import urllib.parse
+import zlib
 
+import psutil
 import scrypted_sdk
-from scrypted_sdk import ScryptedDeviceBase, VideoCamera, ResponseMediaStreamOptions, RequestMediaStreamOptions, Settings, Setting, ScryptedInterface, ScryptedDeviceType, ScryptedMimeTypes, DeviceProvider, Scriptable, ScriptSource, Readme
+from scrypted_sdk import ScryptedDeviceBase, VideoCamera, ResponseMediaStreamOptions, RequestMediaStreamOptions, Settings, Setting, ScryptedInterface, ScryptedDeviceType, ScryptedMimeTypes, DeviceProvider, Scriptable, ScriptSource, Readme, Camera, RequestPictureOptions, ResponsePictureOptions, HttpRequestHandler, HttpRequest, HttpResponse
+
+from blocking import LoopLagMonitor, run_blocking
+from calibration import calibrate, format_results, record_sample
+from device_index import DeviceIndex
+from download_cache import DownloadCache
+from font_index import FontIndex, directory_state
+from metrics import Metrics, PipelineStats, format_prometheus
+from regions import BTOP_PANELS, DEFAULT_PANEL_LAYOUT, RawCapture, clip_rect, crop_frame, find_panel_boxes, parse_custom_region
+from resources import IO_PRIORITIES, ResourcePolicy, format_cpu_list, governor, parse_cpu_list
+from snapshot_cache import SnapshotCache
+from stream_hub import StreamHub
+from supervisor import Supervisor
+from tracing import trace_phase, tracer
+from x11_probe import probe_display
+if platform.system() != 'Windows':
+    from framebuffer import SCREEN_FILE, XwdFramebuffer
+    from terminal_engine import TerminalRenderer, TerminalSession, resolve_font_file
+    from text_frames import TEXT_FORMATS, ScreenCells, format_screen, stream_text_frames
 
 
 # patch SystemManager.getDeviceByName
-def getDeviceByName(self, name: str) -> scrypted_sdk.ScryptedDevice:
-    for check in self.systemState:
-        state = self.systemState.get(check, None)
-        if not state:
-            continue
-        checkInterfaces = state.get('interfaces', None)
-        if not checkInterfaces:
-            continue
-        interfaces = checkInterfaces.get('value', [])
-        if ScryptedInterface.ScryptedPlugin.value in interfaces:
-            checkPluginId = state.get('pluginId', None)
-            if not checkPluginId:
-                continue
-            pluginId = checkPluginId.get('value', None)
-            if not pluginId:
-                continue
-            if pluginId == name:
-                return self.getDeviceById(check)
-        checkName = state.get('name', None)
-        if not checkName:
-            continue
-        if checkName.get('value', None) == name:
-            return self.getDeviceById(check)
-scrypted_sdk.systemManager.getDeviceByName = types.MethodType(getDeviceByName, scrypted_sdk.systemManager)
+device_index = DeviceIndex(scrypted_sdk.systemManager)
+scrypted_sdk.systemManager.getDeviceByName = device_index.getDeviceByName
 
 
 async def run_and_stream_output(cmd: str, env: Dict[str, str] = {}, return_pid: bool = False) -> Tuple[asyncio.Future, int] | None:
@@ -60,84 +59,42 @@ async def run_and_stream_output(cmd: str, env: Dict[str, str] = {}, return_pid:
     await read_streams()
 
 
-async def run_self_cleanup_subprocess(cmd: str, env: Dict[str, str] = {}, kill_proc: str = None) -> None:
-    """Launch an instance of Python which monitors the subprocess and kills it if the parent process dies."""
-    exe = sys.executable
-
-    if platform.system() == 'Windows':
-        cmd = f"\"{BtopCamera.CYGWIN_LAUNCHER}\" \"{cmd}\""
-
-    args = [
-        BtopCamera.RUN_SEPARATELY_SCRIPT,
-        cmd,
-        json.dumps(env),
-        kill_proc or 'None',
-        BtopCamera.MONITOR_FILE if platform.system() == 'Windows' else 'None'
-    ]
-
-    script_env = os.environ.copy()
-    script_env['SCRYPTED_BTOP_PIDFILE_DIR'] = BtopCamera.VOLUME_FILES
-    p = await asyncio.create_subprocess_exec(exe, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True, env=script_env)
-
-    async def read_streams():
-        async def stream_stdout():
-            async for line in p.stdout:
-                print(line.decode('utf-8'))
-        async def stream_stderr():
-            async for line in p.stderr:
-                print(line.decode('utf-8'))
-
-        await asyncio.gather(stream_stdout(), stream_stderr(), p.wait())
-
-    await read_streams()
-
-
-async def run_cleanup_subprocess(kill_proc: str) -> None:
-    """Launches an instance of Python to clean up dangling processes from a previous plugin instance."""
-    exe = sys.executable
-    args = [
-        BtopCamera.CLEANUP_SEPARATELY_SCRIPT,
-        kill_proc,
-    ]
-
-    script_env = os.environ.copy()
-    script_env['SCRYPTED_BTOP_PIDFILE_DIR'] = BtopCamera.VOLUME_FILES
-    p = await asyncio.create_subprocess_exec(exe, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True, env=script_env)
-
-    async def read_streams():
-        async def stream_stdout():
-            async for line in p.stdout:
-                print(line.decode('utf-8'))
-        async def stream_stderr():
-            async for line in p.stderr:
-                print(line.decode('utf-8'))
-
-        await asyncio.gather(stream_stdout(), stream_stderr(), p.wait())
-
-    await read_streams()
+async def run_in_cygwin(command: str, input: bytes | None = None, check: bool = True) -> bytes:
+    """Runs a shell command inside Cygwin and returns its output. Raises if it fails, unless check is False."""
+    p = await asyncio.create_subprocess_shell(f'"{BtopCamera.CYGWIN_LAUNCHER}" "{command}"',
+                                              stdin=asyncio.subprocess.PIPE if input is not None else None,
+                                              stdout=asyncio.subprocess.PIPE)
+    out, _ = await p.communicate(input)
+    if check and p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, command, out)
+    return out
 
 
-def copy_file_to(path: str, dest: str, make_executable: bool = False) -> None:
+async def copy_file_to(path: str, dest: str, make_executable: bool = False) -> None:
     if platform.system() != "Windows":
-        shutil.copyfile(path, dest)
-        if make_executable:
-            os.chmod(dest, 0o755)
+        def copy():
+            shutil.copyfile(path, dest)
+            if make_executable:
+                os.chmod(dest, 0o755)
+        await run_blocking(copy)
     else:
         # read file
-        with open(path, 'rb') as f:
-            data = f.read()
+        data = await run_blocking(pathlib.Path(path).read_bytes)
 
         # launch tee as subprocess
-        subprocess.Popen(f'"{BtopCamera.CYGWIN_LAUNCHER}" "tee {dest}"', stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=True).communicate(data)
+        await run_in_cygwin(f"tee {dest}", input=data, check=False)
 
         if make_executable:
             # make executable
-            subprocess.Popen(f'"{BtopCamera.CYGWIN_LAUNCHER}" "chmod 755 {dest}"', shell=True).communicate()
+            await run_in_cygwin(f"chmod 755 {dest}", check=False)
 
 
-class BtopCamera(ScryptedDeviceBase, VideoCamera, Settings, DeviceProvider):
+class BtopCamera(ScryptedDeviceBase, VideoCamera, Camera, Settings, DeviceProvider, HttpRequestHandler):
     VOLUME_FILES = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'files')
     CYGWIN_INSTALL_DONE = os.path.join(VOLUME_FILES, 'cygwin_install_done')
+    APT_INSTALL_DONE = os.path.join(VOLUME_FILES, 'apt_install_done')
+    FONT_INDEX = os.path.join(VOLUME_FILES, 'font_index.json')
+    STARTUP_TRACE = os.path.join(VOLUME_FILES, 'startup_trace.json')
     CYGWIN_PORTABLE_INSTALLER = os.path.join(VOLUME_FILES, 'cygwin-portable-installer.cmd')
     CYGWIN_LAUNCHER = os.path.join(VOLUME_FILES, 'cygwin-portable.cmd')
     MONITOR_FILE = os.path.join(VOLUME_FILES, f"monitor.{os.getpid()}")
@@ -145,24 +102,182 @@ class BtopCamera(ScryptedDeviceBase, VideoCamera, Settings, DeviceProvider):
     FILES = "/tmp/.scrypted_btop" if platform.system() == "Windows" else VOLUME_FILES
     XAUTH = f"{FILES}/Xauthority"
     XVFB_RUN = f"{FILES}/xvfb-run"
+    # Xvfb's memory-mapped screen is kept in RAM where possible, rather than written back to disk
+    FRAMEBUFFER_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else FILES
 
     FFMPEG_IN_CYGWIN = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'zip', 'unzipped', 'fs', 'ffmpeg_in_cygwin.com')
     CYGWIN_PORTABLE_INSTALLER_SRC = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'zip', 'unzipped', 'fs', 'cygwin-portable-installer.cmd')
     XVFB_RUN_SRC = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'zip', 'unzipped', 'fs', 'xvfb-run')
-    RUN_SEPARATELY_SCRIPT = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'zip', 'unzipped', 'run_separately.py')
-    CLEANUP_SEPARATELY_SCRIPT = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'zip', 'unzipped', 'cleanup_separately.py')
+    SUPERVISOR_SCRIPT = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'zip', 'unzipped', 'supervisor.py')
+
+    ENCODER_MODES = ["Shared", "Per-Session"]
+    CAPTURE_MODES = ["Fixed Rate", "Damage-Driven"]
+    CAPTURE_SOURCES = ["X11 Grab", "Framebuffer"]
+    DISPLAY_ENGINES = ["Xvfb + xterm", "Headless Terminal"]
+    DISPLAY_LIFECYCLES = ["Always On", "On Demand", "Warm Standby"]
+    IDLE_CHECK_INTERVAL = 10
+    # directories whose changes invalidate the font index
+    FONT_STATE_DIRS = {
+        'Linux': ['/usr/share/fonts', '/usr/local/share/fonts', '~/.local/share/fonts', '~/.fonts', '/var/cache/fontconfig', '~/.cache/fontconfig'],
+        'Darwin': ['/opt/X11/share/fonts', '/Library/Fonts', '/System/Library/Fonts', '~/Library/Fonts', '~/.fonts', '~/.cache/fontconfig'],
+        'Windows': ['~/.local/share/fonts', '/usr/share/fonts', '/var/cache/fontconfig'],
+    }
+    STREAM_PROFILES = [
+        {
+            "id": "default",
+            "name": "Virtual Display",
+            "scale": 1,
+            "fps": None,
+            "keyframe_interval": 4,
+            "bitrate": None,
+            "destinations": ["local", "local-recorder"],
+        },
+        {
+            "id": "substream",
+            "name": "Substream",
+            "scale": 0.5,
+            "fps": 5,
+            "keyframe_interval": 4,
+            "bitrate": None,
+            "destinations": ["remote", "medium-resolution", "remote-recorder"],
+        },
+        {
+            "id": "lowbandwidth",
+            "name": "Low Bandwidth",
+            "scale": 0.5,
+            "fps": 1,
+            "keyframe_interval": 10,
+            "bitrate": 64,
+            "destinations": ["low-resolution"],
+        },
+    ]
+    # the stream of region cameras, sized to the region
+    REGION_PROFILE = {
+        "id": "region",
+        "name": "Region",
+        "scale": 1,
+        "fps": 5,
+        "keyframe_interval": 4,
+        "bitrate": None,
+        "destinations": ["local", "remote", "medium-resolution", "low-resolution", "local-recorder", "remote-recorder"],
+    }
+    # x264 settings of the encoders. Terminal output is mostly static text with sharp edges and flat colors, which
+    # the stillimage and animation tunes preserve better than the defaults, and CRF with a VBV cap spends few bits
+    # on frames that barely change. maxrate is in kbps.
+    ENCODER_PROFILES = [
+        {
+            "name": "Fast",
+            "preset": "ultrafast",
+            "tune": None,
+            "crf": None,
+            "maxrate": None,
+            "pix_fmt": "yuv420p",
+            "intra_refresh": False,
+            "keyframe_scale": 1,
+        },
+        {
+            "name": "Screen Text",
+            "preset": "superfast",
+            "tune": "stillimage",
+            "crf": 26,
+            "maxrate": 1500,
+            "pix_fmt": "yuv420p",
+            "intra_refresh": False,
+            "keyframe_scale": 1,
+        },
+        {
+            "name": "Crisp Color",
+            "preset": "superfast",
+            "tune": "stillimage",
+            "crf": 24,
+            "maxrate": 3000,
+            "pix_fmt": "yuv444p",
+            "intra_refresh": False,
+            "keyframe_scale": 1,
+        },
+        {
+            "name": "Long GOP",
+            "preset": "superfast",
+            "tune": "animation",
+            "crf": 28,
+            "maxrate": 800,
+            "pix_fmt": "yuv420p",
+            "intra_refresh": True,
+            "keyframe_scale": 4,
+        },
+    ]
+    CALIBRATION_DIR = os.path.join(VOLUME_FILES, 'calibration')
+    CALIBRATION_SECONDS = 20
+    SNAPSHOT_CACHE_BYTES = 8 * 1024 * 1024
+    TEXT_STREAM_INTERVAL = 1
+    MIN_TEXT_STREAM_INTERVAL = 0.1
+    # how often region cameras of btop panels check whether the panel moved on the headless screen
+    PANEL_CHECK_INTERVAL = 1
+    READY_TIMEOUT = 30
+    READY_POLL_INTERVAL = 0.1
+    WINDOWS_SETTLE_TIME = 3
+    DISPLAY_RELEASE_TIMEOUT = 3
+    # phases reported in the startup summary, in the order they are listed
+    STARTUP_PHASES = ['load_btop_exe', 'install_system_packages', 'cleanup_previous_processes', 'prepare_files', 'discover_devices',
+                      'install_dependencies', 'font index', 'load_fonts', 'xvfb-run', 'xterm', 'btop']
 
     def __init__(self, nativeId: str = None) -> None:
         super().__init__(nativeId)
 
-        self.btop = asyncio.ensure_future(self.load_btop_exe())
+        self.btop = asyncio.ensure_future(trace_phase('load_btop_exe', self.load_btop_exe()))
         self.btop_config = None
         self.fontmanager = None
         self.thememanager = None
-        self.fonts_cache = None
-        self.dependencies_installed = asyncio.ensure_future(self.install_dependencies())
-        self.stream_initialized = asyncio.ensure_future(self.init_stream())
-        self.cygwin_ffmpeg = asyncio.ensure_future(self.get_cygwin_ffmpeg())
+        self.fonts_supported_cache = None
+        self.font_index = FontIndex(BtopCamera.FONT_INDEX, self.run_fontconfig, self.font_state)
+        self.metrics = Metrics()
+        self.metrics_device = None
+        self.loop_monitor = LoopLagMonitor()
+        self.loop_monitor.start()
+        governor.configure(self.resource_policy)
+        if platform.system() == 'Windows':
+            self.supervisor = Supervisor(BtopCamera.SUPERVISOR_SCRIPT, BtopCamera.VOLUME_FILES, BtopCamera.MONITOR_FILE, BtopCamera.CYGWIN_LAUNCHER)
+        else:
+            self.supervisor = Supervisor(BtopCamera.SUPERVISOR_SCRIPT, BtopCamera.VOLUME_FILES)
+        self.stream_hubs: Dict[str, StreamHub] = {}
+        self.region_devices: Dict[str, BtopRegionCamera] = {}
+        self.raw_capture = None
+        self.framebuffer = None
+        # why the framebuffer could not be read, after which X11 Grab is used until the display restarts
+        self.framebuffer_error: str | None = None
+        self.calibration_task = None
+        self.terminal_session = None
+        self.terminal_renderer = None
+        self.screen_cells = None
+        self.text_viewers = 0
+        self.snapshot_cache = SnapshotCache(self.snapshot_ttl, BtopCamera.SNAPSHOT_CACHE_BYTES)
+        self.display_ready = asyncio.Event()
+        self.server_ready = asyncio.Event()
+        self.display_stop = None
+        self.client_stop = None
+        # whether the X server and the terminal client should be running, see apply_display_lifecycle
+        self.display_wanted = asyncio.Event()
+        self.client_wanted = asyncio.Event()
+        self.last_activity = 0
+        self.dependencies_installed = asyncio.ensure_future(trace_phase('install_dependencies', self.install_dependencies()))
+        self.stream_initialized = asyncio.ensure_future(trace_phase('init_stream', self.init_stream()))
+        self.cygwin_ffmpeg = None
+        if platform.system() == 'Windows':
+            self.cygwin_ffmpeg = asyncio.ensure_future(trace_phase('get_cygwin_ffmpeg', self.get_cygwin_ffmpeg()))
+        asyncio.ensure_future(self.report_startup())
+
+    async def report_startup(self) -> None:
+        """Logs the duration of each startup phase and writes the startup timeline, once the display is ready
+        and again once the first frame is encoded."""
+        await self.display_ready.wait()
+        tracer.milestone('display ready')
+        ready = tracer.milestones['display ready']
+        print(f"Startup: display ready after {ready:.2f}s ({tracer.summary(BtopCamera.STARTUP_PHASES)})")
+        await run_blocking(tracer.write, BtopCamera.STARTUP_TRACE)
+
+        first_frame = await tracer.wait_milestone('first frame')
+        print(f"Startup: first frame after {first_frame:.2f}s, timeline written to {BtopCamera.STARTUP_TRACE}")
+        await run_blocking(tracer.write, BtopCamera.STARTUP_TRACE)
 
     async def get_logger(self) -> Any:
         return await scrypted_sdk.systemManager.api.getLogger(self.nativeId)
@@ -197,213 +312,573 @@ class BtopCamera(ScryptedDeviceBase, VideoCamera, Settings, DeviceProvider):
 
     async def install_dependencies(self) -> None:
         try:
-            btop = await self.btop
-            print("Using btop executable:", btop)
+            headless = self.display_engine == 'Headless Terminal'
 
-            installation = os.environ.get('SCRYPTED_INSTALL_ENVIRONMENT')
-            if installation in ('docker', 'lxc', 'lxc-docker'):
-                await run_and_stream_output('apt-get update')
-                await run_and_stream_output('apt-get install -y xvfb xterm xfonts-base fontconfig')
-            elif platform.system() == 'Windows':
-                os.makedirs(BtopCamera.VOLUME_FILES, exist_ok=True)
-                shutil.copyfile(BtopCamera.CYGWIN_PORTABLE_INSTALLER_SRC, BtopCamera.CYGWIN_PORTABLE_INSTALLER)
-
-                with open(BtopCamera.CYGWIN_PORTABLE_INSTALLER, 'r') as f:
-                    data = f.read()
-                installer_md5 = hashlib.md5(data.encode()).hexdigest()
-                needs_install = True
-                try:
-                    with open(BtopCamera.CYGWIN_INSTALL_DONE, 'r') as f:
-                        if f.read() == installer_md5:
-                            needs_install = False
-                except:
-                    pass
+            async def log_btop():
+                btop = await self.btop
+                print("Using btop executable:", btop)
 
-                if needs_install:
-                    await run_and_stream_output(f'"{BtopCamera.CYGWIN_PORTABLE_INSTALLER}"')
-                    with open(BtopCamera.CYGWIN_INSTALL_DONE, 'w') as f:
-                        f.write(installer_md5)
+            # the remaining steps do not depend on the system packages and can run while they
+            # install, except for those that go through Cygwin on Windows
+            packages_installed = asyncio.ensure_future(trace_phase('install_system_packages', self.install_system_packages(headless)))
+
+            async def prepare_files():
+                await packages_installed
+                with tracer.span('prepare_files'):
+                    await self.prepare_files(headless)
+
+            async def discover_devices():
+                if platform.system() == 'Windows':
+                    # checking for font support goes through Cygwin
+                    await packages_installed
+                with tracer.span('discover_devices'):
+                    await self.discover_devices()
+                await asyncio.gather(
+                    (await self.getDevice('config')).forward_config(),
+                    (await self.getDevice('thememanager')).forward_themes(),
+                )
+
+            await asyncio.gather(
+                log_btop(),
+                packages_installed,
+                trace_phase('cleanup_previous_processes', self.cleanup_previous_processes()),
+                prepare_files(),
+                discover_devices(),
+            )
+        except:
+            import traceback
+            traceback.print_exc()
+            await asyncio.sleep(3600)
+            os._exit(1)
+
+    async def install_system_packages(self, headless: bool) -> None:
+        installation = os.environ.get('SCRYPTED_INSTALL_ENVIRONMENT')
+        if installation in ('docker', 'lxc', 'lxc-docker'):
+            if headless:
+                packages = ['fontconfig', 'fonts-dejavu-core']
+                executables = ['fc-list']
             else:
-                if platform.system() == 'Linux':
-                    needed = []
-                    if shutil.which('Xvfb') is None:
-                        needed.append('xvfb')
-                    if shutil.which('xterm') is None:
-                        needed.append('xterm')
-                        needed.append('xfonts-base')
-
-                    if not self.fonts_supported:
-                        print("Warning: fc-list not found. Changing fonts will not be enabled.")
-
-                    if needed:
-                        needed.sort()
-                        await self.alert(f"Please manually install the following and restart the plugin: {needed}")
-                        raise Exception(f"Please manually install the following and restart the plugin: {needed}")
-                elif platform.system() == 'Darwin':
-                    needed = []
-                    if not os.path.exists('/usr/local/bin/ffmpeg') and \
-                        not os.path.exists('/opt/homebrew/bin/ffmpeg'):
-                        needed.append('ffmpeg')
-                    if shutil.which('xterm') is None and not os.path.exists('/opt/X11/bin/xterm'):
-                        needed.append('xquartz')
-                    if not os.path.exists('/opt/homebrew/opt/gnu-getopt/bin/getopt') and \
-                        not os.path.exists('/usr/local/opt/gnu-getopt/bin/getopt'):
-                        needed.append('gnu-getopt')
-
-                    if needed:
-                        needed.sort()
-                        await self.alert(f"Please manually install the following and restart the plugin: {needed}")
-                        raise Exception(f"Please manually install the following and restart the plugin: {needed}")
-                else:
-                    raise Exception("This plugin only supports Linux, MacOS, and Windows.")
+                packages = ['xvfb', 'xterm', 'xfonts-base', 'fontconfig']
+                executables = ['Xvfb', 'xterm', 'fc-list']
+
+            try:
+                os_release = await run_blocking(pathlib.Path('/etc/os-release').read_text)
+            except OSError:
+                os_release = ''
+            install_key = hashlib.sha256(json.dumps([packages, installation, os_release]).encode()).hexdigest()
 
             try:
-                await run_cleanup_subprocess('Xvfb')
+                previous_key = await run_blocking(pathlib.Path(BtopCamera.APT_INSTALL_DONE).read_text)
             except:
-                import traceback
-                traceback.print_exc()
-                pass
+                previous_key = None
+
+            # the container may have been recreated since the last install, so also check the executables
+            if previous_key == install_key and all(shutil.which(exe) for exe in executables):
+                print("System packages already installed, skipping apt-get")
+                return
+
+            with tracer.span('apt-get update'):
+                await run_and_stream_output('apt-get update')
+            with tracer.span('apt-get install', packages=packages):
+                await run_and_stream_output(f'apt-get install -y {" ".join(packages)}')
+            await run_blocking(os.makedirs, BtopCamera.VOLUME_FILES, exist_ok=True)
+            await run_blocking(pathlib.Path(BtopCamera.APT_INSTALL_DONE).write_text, install_key)
+        elif platform.system() == 'Windows':
+            await run_blocking(os.makedirs, BtopCamera.VOLUME_FILES, exist_ok=True)
+            await run_blocking(shutil.copyfile, BtopCamera.CYGWIN_PORTABLE_INSTALLER_SRC, BtopCamera.CYGWIN_PORTABLE_INSTALLER)
+
+            data = await run_blocking(pathlib.Path(BtopCamera.CYGWIN_PORTABLE_INSTALLER).read_text)
+            installer_md5 = hashlib.md5(data.encode()).hexdigest()
+            needs_install = True
             try:
-                await run_cleanup_subprocess('ffmpeg')
+                if await run_blocking(pathlib.Path(BtopCamera.CYGWIN_INSTALL_DONE).read_text) == installer_md5:
+                    needs_install = False
             except:
                 pass
-            if platform.system() == "Windows":
-                try:
-                    await run_cleanup_subprocess('cygserver')
-                except:
-                    pass
 
-            if platform.system() != "Windows":
-                pathlib.Path(BtopCamera.XAUTH).unlink(missing_ok=True)
-                pathlib.Path(BtopCamera.FILES).mkdir(parents=True, exist_ok=True)
+            if needs_install:
+                with tracer.span('cygwin install'):
+                    await run_and_stream_output(f'"{BtopCamera.CYGWIN_PORTABLE_INSTALLER}"')
+                await run_blocking(pathlib.Path(BtopCamera.CYGWIN_INSTALL_DONE).write_text, installer_md5)
+        else:
+            if platform.system() == 'Linux':
+                needed = []
+                if not headless and shutil.which('Xvfb') is None:
+                    needed.append('xvfb')
+                if not headless and shutil.which('xterm') is None:
+                    needed.append('xterm')
+                    needed.append('xfonts-base')
+
+                if not self.fonts_supported:
+                    print("Warning: fc-list not found. Changing fonts will not be enabled.")
+
+                if needed:
+                    needed.sort()
+                    await self.alert(f"Please manually install the following and restart the plugin: {needed}")
+                    raise Exception(f"Please manually install the following and restart the plugin: {needed}")
+            elif platform.system() == 'Darwin':
+                needed = []
+                if not os.path.exists('/usr/local/bin/ffmpeg') and \
+                    not os.path.exists('/opt/homebrew/bin/ffmpeg'):
+                    needed.append('ffmpeg')
+                if not headless and shutil.which('xterm') is None and not os.path.exists('/opt/X11/bin/xterm'):
+                    needed.append('xquartz')
+                if not headless and not os.path.exists('/opt/homebrew/opt/gnu-getopt/bin/getopt') and \
+                    not os.path.exists('/usr/local/opt/gnu-getopt/bin/getopt'):
+                    needed.append('gnu-getopt')
+
+                if needed:
+                    needed.sort()
+                    await self.alert(f"Please manually install the following and restart the plugin: {needed}")
+                    raise Exception(f"Please manually install the following and restart the plugin: {needed}")
             else:
-                subprocess.Popen(f'"{BtopCamera.CYGWIN_LAUNCHER}" "rm -rf {BtopCamera.FILES}"', shell=True).communicate()
-                subprocess.Popen(f'"{BtopCamera.CYGWIN_LAUNCHER}" "mkdir -p {BtopCamera.FILES}"', shell=True).communicate()
-            copy_file_to(BtopCamera.XVFB_RUN_SRC, BtopCamera.XVFB_RUN, make_executable=True)
+                raise Exception("This plugin only supports Linux, MacOS, and Windows.")
+
+    async def cleanup_previous_processes(self) -> None:
+        """Kills processes left behind by a previous plugin instance, all at once."""
+        try:
+            with tracer.span('cleanup'):
+                results = await self.supervisor.cleanup()
+        except Exception as e:
+            print(f"Could not clean up previous processes: {e}")
+            return
+        for result in results:
+            if result['killed']:
+                print(f"{result['name']} (pid {result['pid']}) left by a previous instance stopped")
+
+    async def prepare_files(self, headless: bool) -> None:
+        if platform.system() != "Windows":
+            pathlib.Path(BtopCamera.XAUTH).unlink(missing_ok=True)
+            pathlib.Path(BtopCamera.FILES).mkdir(parents=True, exist_ok=True)
+        else:
+            await run_in_cygwin(f"rm -rf {BtopCamera.FILES}", check=False)
+            await run_in_cygwin(f"mkdir -p {BtopCamera.FILES}", check=False)
+        if not headless:
+            await copy_file_to(BtopCamera.XVFB_RUN_SRC, BtopCamera.XVFB_RUN, make_executable=True)
+
+        if platform.system() == "Windows":
+            # clean up old monitors
+            def remove_monitors():
+                for file in os.listdir(BtopCamera.VOLUME_FILES):
+                    if file.startswith('monitor.'):
+                        os.remove(os.path.join(BtopCamera.VOLUME_FILES, file))
+            try:
+                await run_blocking(remove_monitors)
+            except:
+                pass
 
-            await scrypted_sdk.deviceManager.onDeviceDiscovered({
+            # the supervisor stops everything once this file is no longer refreshed
+            async def periodic_monitor():
+                while True:
+                    try:
+                        await run_blocking(pathlib.Path(BtopCamera.MONITOR_FILE).write_text, '')
+                    except:
+                        pass
+                    await asyncio.sleep(3)
+            asyncio.create_task(periodic_monitor())
+
+    async def discover_devices(self) -> None:
+        await self.check_fonts_supported()
+        devices = [
+            {
                 "nativeId": "config",
                 "name": "btop Configuration",
                 "type": ScryptedDeviceType.API.value,
                 "interfaces": [
                     ScryptedInterface.Readme.value,
                 ],
-            })
-            await scrypted_sdk.deviceManager.onDeviceDiscovered({
+            },
+            {
                 "nativeId": "thememanager",
                 "name": "Theme Manager",
                 "type": ScryptedDeviceType.API.value,
                 "interfaces": [
                     ScryptedInterface.Readme.value,
                 ],
+            },
+        ]
+        devices.append({
+            "nativeId": "metrics",
+            "name": "Metrics",
+            "type": ScryptedDeviceType.API.value,
+            "interfaces": [
+                ScryptedInterface.HttpRequestHandler.value,
+                ScryptedInterface.Readme.value,
+            ],
+        })
+        if self.fonts_supported:
+            devices.append({
+                "nativeId": "fontmanager",
+                "name": "Font Manager",
+                "type": ScryptedDeviceType.API.value,
+                "interfaces": [
+                    ScryptedInterface.Settings.value,
+                    ScryptedInterface.Readme.value,
+                ],
             })
-            if self.fonts_supported:
-                await scrypted_sdk.deviceManager.onDeviceDiscovered({
-                    "nativeId": "fontmanager",
-                    "name": "Font Manager",
-                    "type": ScryptedDeviceType.API.value,
-                    "interfaces": [
-                        ScryptedInterface.Settings.value,
-                        ScryptedInterface.Readme.value,
-                    ],
-                })
-
-            if platform.system() == "Windows":
-                # clean up old monitors
-                try:
-                    for file in os.listdir(BtopCamera.VOLUME_FILES):
-                        if file.startswith('monitor.'):
-                            os.remove(os.path.join(BtopCamera.VOLUME_FILES, file))
-                except:
-                    pass
-
-                async def periodic_monitor(proc):
-                    while True:
-                        try:
-                            with open(BtopCamera.MONITOR_FILE+f".{proc}", 'w') as f:
-                                f.write('')
-                        except:
-                            pass
-                        await asyncio.sleep(3)
-                asyncio.create_task(periodic_monitor('Xvfb'))
-                asyncio.create_task(periodic_monitor('cygserver'))
-
-            await (await self.getDevice('config')).forward_config()
-            await (await self.getDevice('thememanager')).forward_themes()
-        except:
-            import traceback
-            traceback.print_exc()
-            await asyncio.sleep(3600)
-            os._exit(1)
+        for region in self.regions:
+            devices.append({
+                "nativeId": f"region:{region['id']}",
+                "name": region['name'],
+                "type": ScryptedDeviceType.Camera.value,
+                "interfaces": [
+                    ScryptedInterface.VideoCamera.value,
+                    ScryptedInterface.Camera.value,
+                ],
+            })
+        await asyncio.gather(*[scrypted_sdk.deviceManager.onDeviceDiscovered(device) for device in devices])
 
     async def init_stream(self) -> None:
         await self.dependencies_installed
 
         if self.fonts_supported:
-            fontmanager = await self.getDevice('fontmanager')
-            await fontmanager.fonts_loaded
+            with tracer.span('wait for fonts'):
+                await self.font_index.ensure_loaded()
+                fontmanager = await self.getDevice('fontmanager')
+                await fontmanager.fonts_loaded
 
         async def run_cygserver():
             await run_and_stream_output(f'"{BtopCamera.CYGWIN_LAUNCHER}" "cygserver-config -n"')
-            while True:
-                await run_self_cleanup_subprocess('/usr/sbin/cygserver', kill_proc='cygserver')
+
+            def on_exit(event):
+                self.metrics.record_restart('cygserver', 'crashed', f"exit code {event['returncode']}")
                 print("cygserver crashed, restarting in 5s...")
-                await asyncio.sleep(5)
+            await self.supervisor.keep_running('cygserver', '/usr/sbin/cygserver', restart_delay=5, on_exit=on_exit)
+
+        async def run_display():
+            env = {}
+            if platform.system() == 'Darwin':
+                env['PATH'] = self.darwin_path
+
+            loop = asyncio.get_event_loop()
+            crash_count = 0
+            while True:
+                await self.display_wanted.wait()
+                await self.wait_for_display_release()
+
+                stop = asyncio.Event()
+                self.display_stop = stop
+                started = loop.time()
+                span = tracer.begin('xvfb-run', display=self.virtual_display_num)
+                # Xvfb is kept alive by a placeholder command, so that the terminal client can be restarted on its own
+                subprocess_task = asyncio.create_task(
+                    self.supervisor.run('Xvfb', f'{BtopCamera.XVFB_RUN} -n {self.virtual_display_num} -s \'{await self.xvfb_server_args()}\' -f {BtopCamera.XAUTH} sleep 2147483647',
+                                        env=env, stop=stop)
+                )
+
+                async def probe_ready():
+                    if platform.system() == "Windows":
+                        # the X socket lives inside Cygwin and cannot be probed from here
+                        return loop.time() - started >= BtopCamera.WINDOWS_SETTLE_TIME
+                    return await probe_display(self.virtual_display_num, BtopCamera.XAUTH, require_window=False)
+
+                ready = await self.wait_for_readiness(subprocess_task, probe_ready)
+                span.end(ready=ready)
+                if not subprocess_task.done():
+                    if ready:
+                        print(f"Xvfb ready after {loop.time() - started:.2f}s")
+                    else:
+                        print(f"Xvfb did not pass readiness checks within {BtopCamera.READY_TIMEOUT}s, continuing anyway")
+                    crash_count = 0
+                    self.server_ready.set()
+                    await subprocess_task
+                self.server_ready.clear()
+                self.display_ready.clear()
+
+                if stop.is_set():
+                    print("Xvfb stopped, restarting...")
+                    self.metrics.record_restart('Xvfb', 'requested')
+                    crash_count = 0
+                    continue
 
-        async def run_stream():
-            await asyncio.sleep(3)
+                self.metrics.record_restart('Xvfb', 'crashed', f"exited after {loop.time() - started:.1f}s")
+                crash_count += 1
+                if crash_count > 5:
+                    print(f"Xvfb could not start for {crash_count} times, requesting full plugin restart...")
+                    await scrypted_sdk.deviceManager.requestRestart()
+                    await asyncio.sleep(3600)
 
+                delay = self.restart_delay(crash_count)
+                print(f"Xvfb crashed, restarting in {delay}s...")
+                await asyncio.sleep(delay)
+
+        async def run_client():
             exe = await self.btop
             env = {
                 "LANG": "en_US.UTF-8",
+                "DISPLAY": f":{self.virtual_display_num}",
+                "XAUTHORITY": BtopCamera.XAUTH,
             }
-            xterm_tweaks = ""
 
             if not exe:
                 raise Exception("btop executable not found, cannot start stream.")
 
             if platform.system() == "Windows":
-                exe = subprocess.check_output([BtopCamera.CYGWIN_LAUNCHER, f"cygpath '{exe}'"]).decode().strip()
+                with tracer.span('cygpath'):
+                    exe = (await run_in_cygwin(f"cygpath '{exe}'")).decode().strip()
                 exe = f"'{exe}'"
-                xterm_tweaks = f"+tb +sb -fullscreen -geometry {self.display_dimensions}"
 
             if platform.system() == 'Darwin':
-                path = os.environ.get('PATH')
-                path = f'/opt/X11/bin:/opt/homebrew/opt/gnu-getopt/bin:/usr/local/opt/gnu-getopt/bin:{path}'
-                env['PATH'] = path
-
-            fontselection = ''
-            if self.fonts_supported:
-                font = self.xterm_font
-                if font != 'Default':
-                    fontselection = f'-fa \'{font}\''
+                env['PATH'] = self.darwin_path
 
+            loop = asyncio.get_event_loop()
             crash_count = 0
             while True:
+                await self.client_wanted.wait()
+                await self.server_ready.wait()
+
+                xterm_tweaks = ""
+                if platform.system() == "Windows":
+                    xterm_tweaks = f"+tb +sb -fullscreen -geometry {self.display_dimensions}"
+
+                fontselection = ''
+                if self.fonts_supported:
+                    font = self.xterm_font
+                    if font != 'Default':
+                        fontselection = f'-fa \'{font}\''
+
+                env["DISPLAY"] = f":{self.virtual_display_num}"
+
+                stop = asyncio.Event()
+                self.client_stop = stop
+                started = loop.time()
+                span = tracer.begin('xterm', font=self.xterm_font if self.fonts_supported else None)
                 subprocess_task = asyncio.create_task(
-                    run_self_cleanup_subprocess(f'{BtopCamera.XVFB_RUN} -n {self.virtual_display_num} -s \'-screen 0 {self.display_dimensions}x24\' -f {BtopCamera.XAUTH} xterm {xterm_tweaks} {fontselection} -en UTF-8 -maximized -e {exe} -p {self.btop_preset}',
-                                                env=env, kill_proc='Xvfb')
+                    self.supervisor.run('xterm', f'xterm {xterm_tweaks} {fontselection} -en UTF-8 -maximized -e {exe} -p {self.btop_preset}',
+                                        env=env, stop=stop)
                 )
-                sleep_task = asyncio.create_task(asyncio.sleep(15))
 
-                done, pending = await asyncio.wait([subprocess_task, sleep_task], return_when=asyncio.FIRST_COMPLETED)
-                if sleep_task in done and subprocess_task in pending:
-                    print("Xvfb appears to be running")
+                async def probe_ready():
+                    if platform.system() == "Windows":
+                        return loop.time() - started >= BtopCamera.WINDOWS_SETTLE_TIME
+                    return await probe_display(self.virtual_display_num, BtopCamera.XAUTH)
+
+                ready = await self.wait_for_readiness(subprocess_task, probe_ready)
+                span.end(ready=ready)
+                if not subprocess_task.done():
+                    if ready:
+                        print(f"xterm ready after {loop.time() - started:.2f}s")
+                    else:
+                        print(f"xterm did not pass readiness checks within {BtopCamera.READY_TIMEOUT}s, continuing anyway")
                     crash_count = 0
+                    self.display_ready.set()
                     await subprocess_task
+                self.display_ready.clear()
 
+                if stop.is_set() or not self.server_ready.is_set():
+                    # restarted on request, or the display went away underneath it
+                    self.metrics.record_restart('xterm', 'requested' if stop.is_set() else 'display_stopped')
+                    crash_count = 0
+                    continue
+
+                self.metrics.record_restart('xterm', 'crashed', f"exited after {loop.time() - started:.1f}s")
                 crash_count += 1
                 if crash_count > 5:
-                    print(f"Xvfb could not start for {crash_count} times, requesting full plugin restart...")
+                    print(f"xterm could not start for {crash_count} times, requesting full plugin restart...")
+                    await scrypted_sdk.deviceManager.requestRestart()
+                    await asyncio.sleep(3600)
+
+                delay = self.restart_delay(crash_count)
+                print(f"xterm crashed, restarting in {delay}s...")
+                await asyncio.sleep(delay)
+
+        async def run_terminal():
+            exe = await self.btop
+            if not exe:
+                raise Exception("btop executable not found, cannot start stream.")
+
+            loop = asyncio.get_event_loop()
+            crash_count = 0
+            while True:
+                await self.client_wanted.wait()
+
+                width, height = self.display_size
+                font = self.xterm_font if self.fonts_supported else None
+                font_file = (self.font_index.font_file(font) if font else None) or await run_blocking(resolve_font_file, font)
+                print("Using terminal font:", font_file or "built-in")
+
+                renderer = TerminalRenderer(width, height, font_file, self.terminal_font_size)
+                session = TerminalSession([exe, '-p', str(self.btop_preset)], renderer.columns, renderer.lines, env={"LANG": "en_US.UTF-8"})
+                self.terminal_renderer = renderer
+                self.terminal_session = session
+
+                print(f"btop starting in a {renderer.columns}x{renderer.lines} headless terminal")
+                started = loop.time()
+                span = tracer.begin('btop', columns=renderer.columns, lines=renderer.lines)
+                subprocess_task = asyncio.create_task(session.run())
+
+                async def probe_ready():
+                    return session.updated.is_set()
+
+                ready = await self.wait_for_readiness(subprocess_task, probe_ready)
+                span.end(ready=ready)
+                if not subprocess_task.done():
+                    if ready:
+                        print(f"btop ready after {loop.time() - started:.2f}s")
+                    else:
+                        print(f"btop did not draw within {BtopCamera.READY_TIMEOUT}s, continuing anyway")
+                    crash_count = 0
+                    self.display_ready.set()
+                    await subprocess_task
+                self.display_ready.clear()
+
+                if session.stopped:
+                    self.metrics.record_restart('btop', 'requested')
+                    crash_count = 0
+                    continue
+
+                returncode = session.process.returncode if session.process is not None else None
+                self.metrics.record_restart('btop', 'crashed', f"exit code {returncode} after {loop.time() - started:.1f}s")
+                crash_count += 1
+                if crash_count > 5:
+                    print(f"btop could not start for {crash_count} times, requesting full plugin restart...")
                     await scrypted_sdk.deviceManager.requestRestart()
                     await asyncio.sleep(3600)
 
-                print("Xvfb crashed, restarting in 5s...")
-                await asyncio.sleep(5)
+                delay = self.restart_delay(crash_count)
+                print(f"btop crashed, restarting in {delay}s...")
+                await asyncio.sleep(delay)
+
+        self.apply_display_lifecycle()
+        asyncio.create_task(self.monitor_idle())
+
+        if self.display_engine == 'Headless Terminal':
+            asyncio.create_task(run_terminal(), name='run_terminal')
+            return
+
+        if platform.system() == "Windows":
+            asyncio.create_task(run_cygserver(), name='run_cygserver')
+        asyncio.create_task(run_display(), name='run_display')
+        asyncio.create_task(run_client(), name='run_client')
+
+    def apply_display_lifecycle(self) -> None:
+        lifecycle = self.display_lifecycle
+        if lifecycle == 'Always On':
+            self.display_wanted.set()
+            self.client_wanted.set()
+        elif lifecycle == 'Warm Standby':
+            # keep the X server up so that only btop needs to start on demand
+            self.display_wanted.set()
+
+    async def acquire_display(self) -> None:
+        """Records consumer activity, starting the display on demand, and waits for it to be ready."""
+        self.last_activity = asyncio.get_event_loop().time()
+        if not self.client_wanted.is_set():
+            print("Display requested, starting...")
+        self.display_wanted.set()
+        self.client_wanted.set()
+        await self.wait_display_ready()
+
+    async def consumer_count(self) -> int:
+        count = sum(hub.viewer_count for hub in self.stream_hubs.values()) + self.text_viewers
+        if not self.uses_stream_hub:
+            # Per-Session encodes are run by the Rebroadcast plugin, look for them directly
+            display = f":{self.virtual_display_num}"
+
+            def count_encoders() -> int:
+                found = 0
+                for p in psutil.process_iter(['cmdline']):
+                    try:
+                        cmdline = p.info['cmdline'] or []
+                        if 'x11grab' in cmdline and display in cmdline:
+                            found += 1
+                    except (psutil.NoSuchProcess, psutil.AccessDenied):
+                        pass
+                return found
+
+            count += await run_blocking(count_encoders)
+        return count
+
+    async def monitor_idle(self) -> None:
+        """Stops the display once it has had no consumers for the idle timeout."""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(BtopCamera.IDLE_CHECK_INTERVAL)
+            lifecycle = self.display_lifecycle
+            if lifecycle == 'Always On' or not self.client_wanted.is_set():
+                continue
+            if await self.consumer_count() > 0:
+                self.last_activity = loop.time()
+                continue
+            if loop.time() - self.last_activity < self.idle_timeout:
+                continue
+
+            print(f"No consumers for {self.idle_timeout}s, stopping display...")
+            self.client_wanted.clear()
+            await self.restart_client()
+            if lifecycle == 'On Demand' and self.display_engine != 'Headless Terminal':
+                self.display_wanted.clear()
+                if self.display_stop:
+                    self.display_stop.set()
+
+    @property
+    def darwin_path(self) -> str:
+        path = os.environ.get('PATH')
+        return f'/opt/X11/bin:/opt/homebrew/opt/gnu-getopt/bin:/usr/local/opt/gnu-getopt/bin:{path}'
+
+    async def restart_client(self) -> None:
+        """Restarts btop (and xterm) without touching the X server or the encoders."""
+        if self.display_engine == 'Headless Terminal':
+            if self.terminal_session:
+                self.terminal_session.stop()
+        elif self.client_stop:
+            self.client_stop.set()
+
+    async def restart_display(self) -> None:
+        """Restarts the X server with the current settings. Encoders are restarted since the display changed."""
+        # the new X server may write a framebuffer that can be read
+        self.framebuffer_error = None
+        if self.display_engine == 'Headless Terminal':
+            await self.restart_client()
+        elif self.display_stop:
+            self.display_stop.set()
+        await self.restart_encoders()
+
+    async def restart_encoders(self) -> None:
+        """Closes the shared encoders, viewers will reconnect with the current settings."""
+        hubs = list(self.stream_hubs.values())
+        self.stream_hubs.clear()
+        await asyncio.gather(*[hub.close() for hub in hubs])
+        self.snapshot_cache.clear()
+
+    async def wait_for_readiness(self, process_task: asyncio.Task, probe: Callable[[], Awaitable[bool]]) -> bool:
+        """Polls the readiness probe until it passes, the process exits or the timeout elapses."""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + BtopCamera.READY_TIMEOUT
+        while not process_task.done() and loop.time() < deadline:
+            if await probe():
+                return True
+            await asyncio.wait([process_task], timeout=BtopCamera.READY_POLL_INTERVAL)
+        return False
 
+    async def wait_for_display_release(self) -> None:
+        """Waits for an X server left over from a previous run to release the display number."""
         if platform.system() == "Windows":
-            asyncio.create_task(run_cygserver())
-        asyncio.create_task(run_stream())
+            await asyncio.sleep(BtopCamera.WINDOWS_SETTLE_TIME)
+            return
+
+        lock = pathlib.Path(f"/tmp/.X{self.virtual_display_num}-lock")
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + BtopCamera.DISPLAY_RELEASE_TIMEOUT
+        while loop.time() < deadline:
+            try:
+                pid = int((await run_blocking(lock.read_text)).strip())
+            except (OSError, ValueError):
+                return
+            if not psutil.pid_exists(pid):
+                # stale lock, Xvfb will clean it up
+                return
+            await asyncio.sleep(BtopCamera.READY_POLL_INTERVAL)
+
+    def restart_delay(self, crash_count: int) -> float:
+        return min(5, 0.5 * 2 ** (crash_count - 1))
+
+    async def wait_display_ready(self) -> None:
+        await self.stream_initialized
+        try:
+            await asyncio.wait_for(self.display_ready.wait(), BtopCamera.READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Display is not ready, continuing anyway")
 
     @property
     def virtual_display_num(self) -> int:
@@ -417,12 +892,232 @@ class BtopCamera(ScryptedDeviceBase, VideoCamera, Settings, DeviceProvider):
             return self.storage.getItem('display_dimensions') or '1024x720'
         return '1024x720'
 
+    @property
+    def display_size(self) -> Tuple[int, int]:
+        try:
+            width, height = self.display_dimensions.lower().split('x')
+            return int(width), int(height)
+        except ValueError:
+            return 1024, 720
+
+    @property
+    def display_engine(self) -> str:
+        if platform.system() == 'Windows':
+            return 'Xvfb + xterm'
+        if self.storage:
+            engine = self.storage.getItem('display_engine') or 'Xvfb + xterm'
+            if engine not in BtopCamera.DISPLAY_ENGINES:
+                return 'Xvfb + xterm'
+            return engine
+        return 'Xvfb + xterm'
+
+    @property
+    def display_lifecycle(self) -> str:
+        if self.storage:
+            lifecycle = self.storage.getItem('display_lifecycle') or 'Always On'
+            if lifecycle not in BtopCamera.DISPLAY_LIFECYCLES:
+                return 'Always On'
+            return lifecycle
+        return 'Always On'
+
+    @property
+    def idle_timeout(self) -> float:
+        if self.storage:
+            try:
+                return max(0, float(self.storage.getItem('idle_timeout') or 300))
+            except ValueError:
+                pass
+        return 300
+
+    @property
+    def terminal_font_size(self) -> int:
+        if self.storage:
+            try:
+                return max(6, int(self.storage.getItem('terminal_font_size') or 12))
+            except ValueError:
+                pass
+        return 12
+
+    @property
+    def uses_stream_hub(self) -> bool:
+        # the headless terminal can only be encoded by this plugin, since frames are piped in
+        return self.encoder_mode == 'Shared' or self.display_engine == 'Headless Terminal'
+
     @property
     def btop_preset(self) -> int:
         if self.storage:
             return self.storage.getItem('btop_preset') or 0
         return 0
 
+    @property
+    def encoder_mode(self) -> str:
+        if self.storage:
+            mode = self.storage.getItem('encoder_mode') or 'Shared'
+            if mode not in BtopCamera.ENCODER_MODES:
+                return 'Shared'
+            return mode
+        return 'Shared'
+
+    @property
+    def capture_mode(self) -> str:
+        if self.storage:
+            mode = self.storage.getItem('capture_mode') or 'Fixed Rate'
+            if mode not in BtopCamera.CAPTURE_MODES:
+                return 'Fixed Rate'
+            return mode
+        return 'Fixed Rate'
+
+    @property
+    def encoder_profile(self) -> Dict[str, Any]:
+        # the profiles rely on libx264 options, which the Windows encoder does not have
+        if self.storage and platform.system() != 'Windows':
+            name = self.storage.getItem('encoder_profile')
+            profile = next((p for p in BtopCamera.ENCODER_PROFILES if p['name'] == name), None)
+            if profile is not None:
+                return profile
+        return BtopCamera.ENCODER_PROFILES[0]
+
+    @property
+    def calibration_results(self) -> str:
+        if self.calibration_task is not None and not self.calibration_task.done():
+            return "Calibration is running..."
+        if self.storage:
+            return self.storage.getItem('encoder_calibration') or ''
+        return ''
+
+    @property
+    def capture_source(self) -> str:
+        if platform.system() == 'Windows':
+            return 'X11 Grab'
+        if self.storage:
+            source = self.storage.getItem('capture_source') or 'X11 Grab'
+            if source not in BtopCamera.CAPTURE_SOURCES:
+                return 'X11 Grab'
+            return source
+        return 'X11 Grab'
+
+    @property
+    def uses_framebuffer(self) -> bool:
+        return self.capture_source == 'Framebuffer' and self.display_engine == 'Xvfb + xterm' and self.framebuffer_error is None
+
+    @property
+    def framebuffer_dir(self) -> str:
+        return f"{BtopCamera.FRAMEBUFFER_DIR}/scrypted_btop_fb.{self.virtual_display_num}"
+
+    def get_framebuffer(self) -> Any:
+        path = os.path.join(self.framebuffer_dir, SCREEN_FILE)
+        if self.framebuffer is None or self.framebuffer.path != path:
+            if self.framebuffer is not None:
+                self.framebuffer.close()
+            self.framebuffer = XwdFramebuffer(path)
+        return self.framebuffer
+
+    def framebuffer_unusable(self, e: ValueError) -> None:
+        """Falls back to X11 Grab capture once the framebuffer turns out to be in a format that cannot be read.
+        Encoders are restarted, so that viewers reconnect to encoders that capture with x11grab."""
+        if self.framebuffer_error is not None:
+            return
+        self.framebuffer_error = str(e)
+        print(f"{e}, falling back to X11 Grab capture")
+        asyncio.ensure_future(self.restart_encoders())
+
+    async def xvfb_server_args(self) -> str:
+        args = f"-screen 0 {self.display_dimensions}x24"
+        if self.uses_framebuffer:
+            await run_blocking(os.makedirs, self.framebuffer_dir, exist_ok=True)
+            args += f" -fbdir {self.framebuffer_dir}"
+        return args
+
+    @property
+    def resource_policy(self) -> ResourcePolicy:
+        # priorities, affinity and cgroups are not available to the Cygwin processes
+        if not self.storage or platform.system() == 'Windows':
+            return ResourcePolicy()
+
+        def number(key: str, low: int, high: int) -> int:
+            try:
+                return min(high, max(low, int(self.storage.getItem(key) or 0)))
+            except ValueError:
+                return 0
+
+        io_priority = self.storage.getItem('io_priority') or 'Default'
+        try:
+            cpus = parse_cpu_list(self.storage.getItem('cpu_affinity') or '')
+        except ValueError:
+            cpus = None
+        return ResourcePolicy(nice=number('nice', 0, 19),
+                              io_priority=io_priority if io_priority in IO_PRIORITIES else 'Default',
+                              cpus=cpus,
+                              threads=number('encoder_threads', 0, 64),
+                              cpu_quota=number('cpu_quota', 0, 100 * (os.cpu_count() or 1)),
+                              memory_max=number('memory_limit', 0, 1024 * 1024))
+
+    async def apply_resource_policy(self) -> None:
+        """Applies changed resource limits to the processes that are already running. Encoders are restarted,
+        since their thread count is an FFmpeg argument."""
+        governor.configure(self.resource_policy)
+        if self.supervisor.process is not None and self.supervisor.process.returncode is None:
+            await run_blocking(governor.apply, self.supervisor.process.pid, 'supervisor', recursive=True)
+        session = self.terminal_session
+        if session is not None and session.process is not None and session.process.returncode is None:
+            await run_blocking(governor.apply, session.process.pid, os.path.basename(session.args[0]))
+        await self.restart_encoders()
+
+    @property
+    def max_fps(self) -> int:
+        if self.storage:
+            try:
+                return max(1, int(self.storage.getItem('max_fps') or 15))
+            except ValueError:
+                pass
+        return 15
+
+    @property
+    def min_fps(self) -> float:
+        if self.storage:
+            try:
+                return min(self.max_fps, max(0.1, float(self.storage.getItem('min_fps') or 1)))
+            except ValueError:
+                pass
+        return 1
+
+    @property
+    def snapshot_ttl(self) -> float:
+        if self.storage:
+            try:
+                return max(0, float(self.storage.getItem('snapshot_ttl') or 5))
+            except ValueError:
+                pass
+        return 5
+
+    def json_setting(self, key: str) -> list:
+        if self.storage:
+            value = self.storage.getItem(key)
+            if value:
+                try:
+                    return json.loads(value)
+                except ValueError:
+                    pass
+        return []
+
+    @property
+    def region_cameras(self) -> list[str]:
+        return [panel for panel in self.json_setting('region_cameras') if panel in BTOP_PANELS]
+
+    @property
+    def custom_regions(self) -> list[str]:
+        return self.json_setting('custom_regions')
+
+    @property
+    def regions(self) -> list[Dict[str, Any]]:
+        """The region cameras, btop panels followed by custom rectangles of the display."""
+        regions = [{"id": panel, "name": f"btop {panel}", "panel": panel} for panel in self.region_cameras]
+        for text in self.custom_regions:
+            region = parse_custom_region(text)
+            if region is not None and all(r['id'] != region['id'] for r in regions):
+                regions.append(region)
+        return regions
+
     @property
     def xterm_font(self) -> str:
         """For best results, ensure that BtopFontManager.fonts_loaded is awaited before calling this property."""
@@ -435,49 +1130,85 @@ class BtopCamera(ScryptedDeviceBase, VideoCamera, Settings, DeviceProvider):
 
     @property
     def fonts_supported(self) -> bool:
+        if self.fonts_supported_cache is not None:
+            return self.fonts_supported_cache
+
+        supported = False
         installation = os.environ.get('SCRYPTED_INSTALL_ENVIRONMENT')
         if installation in ('docker', 'lxc', 'lxc-docker'):
-            return True
-        if platform.system() == 'Linux':
-            return shutil.which('fc-list') is not None
-        if platform.system() == 'Darwin':
-            return os.path.exists('/opt/X11/bin/fc-list')
-        if platform.system() == 'Windows':
+            supported = True
+        elif platform.system() == 'Linux':
+            supported = shutil.which('fc-list') is not None
+        elif platform.system() == 'Darwin':
+            supported = os.path.exists('/opt/X11/bin/fc-list')
+        elif platform.system() == 'Windows':
+            # checking goes through Cygwin, see check_fonts_supported
+            return False
+
+        self.fonts_supported_cache = supported
+        return supported
+
+    async def check_fonts_supported(self) -> bool:
+        if platform.system() == 'Windows' and not self.fonts_supported:
+            # fontconfig may only become available once cygwin is installed, so a miss is not cached
             try:
-                subprocess.check_output([BtopCamera.CYGWIN_LAUNCHER, "which fc-list"]).decode().strip()
-                return True
+                await run_in_cygwin("which fc-list")
+                self.fonts_supported_cache = True
             except:
                 pass
-        return False
+        return self.fonts_supported
+
+    async def run_fontconfig(self, args: list[str]) -> str:
+        if platform.system() == 'Windows':
+            p = await asyncio.create_subprocess_shell(f'"{BtopCamera.CYGWIN_LAUNCHER}" "{shlex.join(args)}"', stdout=asyncio.subprocess.PIPE)
+        else:
+            if platform.system() == 'Darwin':
+                args = [f'/opt/X11/bin/{args[0]}'] + args[1:]
+            p = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE)
+        out, _ = await p.communicate()
+        if p.returncode != 0:
+            raise Exception(f"{args[0]} exited with code {p.returncode}")
+        return out.decode(errors='replace')
+
+    async def font_state(self) -> Dict[str, float]:
+        dirs = BtopCamera.FONT_STATE_DIRS.get(platform.system(), [])
+        if platform.system() == 'Windows':
+            # the font directories live inside cygwin, so ask cygwin's find for their modification times
+            p = await asyncio.create_subprocess_shell(f'"{BtopCamera.CYGWIN_LAUNCHER}" "find {" ".join(dirs)} -type d -printf \'%p %T@\\n\' 2>/dev/null"', stdout=asyncio.subprocess.PIPE)
+            out, _ = await p.communicate()
+            state = {}
+            for line in out.decode(errors='replace').splitlines():
+                path, _, mtime = line.rpartition(' ')
+                try:
+                    state[path] = float(mtime)
+                except ValueError:
+                    pass
+            return state
+        return await run_blocking(directory_state, dirs)
 
     def list_fonts(self) -> list[str]:
-        """For best results, ensure that BtopFontManager.fonts_loaded is awaited before calling this function."""
+        """Lists the indexed font families, monospace families first.
+
+        For best results, ensure that font_index.ensure_loaded() is awaited before calling this function."""
         if not self.fonts_supported:
             return []
 
-        if self.fonts_cache is not None:
-            return self.fonts_cache
-
-        fonts = []
-        fc_list_cmd = [BtopCamera.CYGWIN_LAUNCHER, 'fc-list : family'] if platform.system() == 'Windows' else \
-            ['fc-list' if platform.system() == 'Linux' else '/opt/X11/bin/fc-list', ':', 'family']
-        try:
-            # list font families with fc-list
-            out = subprocess.check_output(fc_list_cmd).decode().strip()
-            for line in out.splitlines():
-                font = line.strip()
-                if font:
-                    fonts.append(font)
-        except:
-            print("Could not enumerate fonts with fc-list")
-            pass
-        fonts.sort()
-        fonts = ['Default'] + fonts
-        self.fonts_cache = fonts
-        return fonts
+        monospace = self.font_index.monospace_families()
+        others = sorted(set(self.font_index.families()) - set(monospace))
+        return ['Default'] + monospace + others
 
     async def getSettings(self) -> list[Setting]:
-        settings = [
+        settings = []
+        if platform.system() != 'Windows':
+            settings.append({
+                "key": "display_engine",
+                "title": "Display Engine",
+                "description": "Xvfb + xterm runs btop in xterm on a virtual X11 display. Headless Terminal runs btop in a pseudo-terminal and renders it directly, without X11. Headless Terminal always uses the Shared encoder mode, and is required for the text frames served from the HTTP endpoint, which return 409 Conflict with Xvfb + xterm.",
+                "type": "string",
+                "value": self.display_engine,
+                "choices": BtopCamera.DISPLAY_ENGINES,
+            })
+        settings += [
             {
                 "key": "display_dimensions",
                 "title": "Virtual Display Dimensions",
@@ -499,19 +1230,173 @@ class BtopCamera(ScryptedDeviceBase, VideoCamera, Settings, DeviceProvider):
                 "type": "number",
                 "value": self.btop_preset,
             },
+            {
+                "key": "display_lifecycle",
+                "title": "Display Lifecycle",
+                "description": "Always On keeps btop running at all times. On Demand starts the display when a stream or snapshot is requested, and stops it after the idle timeout with no viewers. Warm Standby keeps the virtual display running and only starts and stops btop on demand, for faster startup.",
+                "type": "string",
+                "value": self.display_lifecycle,
+                "choices": BtopCamera.DISPLAY_LIFECYCLES,
+            },
+            {
+                "key": "idle_timeout",
+                "title": "Idle Timeout",
+                "description": "With the On Demand or Warm Standby lifecycle, how long, in seconds, the display keeps running with no viewers.",
+                "type": "number",
+                "value": self.idle_timeout,
+            },
+            {
+                "key": "encoder_mode",
+                "title": "Encoder Mode",
+                "description": "Shared runs a single H264 encode of the virtual display in this plugin and fans it out to every viewer. Per-Session lets the Rebroadcast plugin run a separate encode for each session.",
+                "type": "string",
+                "value": self.encoder_mode,
+                "choices": BtopCamera.ENCODER_MODES,
+            },
+            {
+                "key": "capture_mode",
+                "title": "Capture Mode",
+                "description": "Fixed Rate encodes every captured frame. Damage-Driven only encodes frames where the display contents changed, down to the minimum frame rate.",
+                "type": "string",
+                "value": self.capture_mode,
+                "choices": BtopCamera.CAPTURE_MODES,
+            },
+        ]
+        if platform.system() != 'Windows':
+            settings += [
+                {
+                    "key": "encoder_profile",
+                    "title": "Encoder Profile",
+                    "description": "x264 settings of the encoders. Fast is the cheapest. Screen Text and Crisp Color tune for sharp text at a capped bitrate, and Crisp Color keeps full color resolution (4:4:4), which some clients cannot decode. Long GOP uses periodic intra refresh instead of frequent keyframes for the lowest bitrate, at the cost of slower joins.",
+                    "type": "string",
+                    "value": self.encoder_profile['name'],
+                    "choices": [p['name'] for p in BtopCamera.ENCODER_PROFILES],
+                },
+                {
+                    "key": "calibrate_encoders",
+                    "title": "Calibrate Encoder Profiles",
+                    "description": f"Records {BtopCamera.CALIBRATION_SECONDS}s of the display and encodes it with every encoder profile, reporting the bitrate, encode CPU time (in percent of one core) and quality (PSNR and SSIM) of each.",
+                    "type": "button",
+                },
+                {
+                    "key": "encoder_calibration",
+                    "title": "Calibration Results",
+                    "type": "textarea",
+                    "readonly": True,
+                    "value": self.calibration_results,
+                },
+            ]
+            settings.append({
+                "key": "capture_source",
+                "title": "Capture Source",
+                "description": "How the Shared encoders read the Xvfb display. X11 Grab captures it over the X protocol. Framebuffer has Xvfb keep its screen in a memory-mapped file and reads frames from it directly, which costs less CPU at large display dimensions. If its pixel format cannot be read, X11 Grab is used until the display restarts.",
+                "type": "string",
+                "value": self.capture_source,
+                "choices": BtopCamera.CAPTURE_SOURCES,
+            })
+            policy = self.resource_policy
+            settings += [
+                {
+                    "key": "nice",
+                    "title": "Process Priority",
+                    "description": "The nice level, from 0 (normal) to 19 (lowest), of the display, btop and encoder processes. Going back to a lower level may not be permitted until the plugin restarts.",
+                    "type": "number",
+                    "value": policy.nice,
+                },
+                {
+                    "key": "io_priority",
+                    "title": "I/O Priority",
+                    "description": "The I/O scheduling class of the display, btop and encoder processes. Low is the lowest best-effort level, Idle only gets disk time no other process wants. Linux only.",
+                    "type": "string",
+                    "value": policy.io_priority,
+                    "choices": IO_PRIORITIES,
+                },
+                {
+                    "key": "cpu_affinity",
+                    "title": "CPU Affinity",
+                    "description": "The CPUs that the display, btop and encoder processes may run on, such as 0-1 or 2,3. Leave blank for all CPUs. Linux only.",
+                    "type": "string",
+                    "value": format_cpu_list(policy.cpus) if policy.cpus else '',
+                },
+                {
+                    "key": "encoder_threads",
+                    "title": "Encoder Threads",
+                    "description": "The number of threads of each x264 encode. 0 lets x264 decide, which is about 1.5 threads per CPU.",
+                    "type": "number",
+                    "value": policy.threads,
+                },
+                {
+                    "key": "cpu_quota",
+                    "title": "CPU Quota",
+                    "description": "The CPU time that the display, btop and encoder processes may use together, in percent of one CPU. 0 for no limit. Requires cgroup v2 and permission to create cgroups, which containers usually lack.",
+                    "type": "number",
+                    "value": policy.cpu_quota,
+                },
+                {
+                    "key": "memory_limit",
+                    "title": "Memory Limit",
+                    "description": "The memory, in MB, that the display, btop and encoder processes may use together. 0 for no limit. Requires cgroup v2, like the CPU quota.",
+                    "type": "number",
+                    "value": policy.memory_max,
+                },
+            ]
+        settings += [
+            {
+                "key": "max_fps",
+                "title": "Maximum Frame Rate",
+                "description": "The rate at which the virtual display is captured.",
+                "type": "number",
+                "value": self.max_fps,
+            },
+            {
+                "key": "min_fps",
+                "title": "Minimum Frame Rate",
+                "description": "In Damage-Driven capture mode, the rate at which unchanged frames are still sent to keep clients alive.",
+                "type": "number",
+                "value": self.min_fps,
+            },
+            {
+                "key": "snapshot_ttl",
+                "title": "Snapshot Cache Duration",
+                "description": "How long, in seconds, a snapshot is reused before a new one is taken from the display.",
+                "type": "number",
+                "value": self.snapshot_ttl,
+            },
+            {
+                "key": "region_cameras",
+                "title": "Panel Cameras",
+                "description": "btop panels to expose as separate cameras, cropped from the same capture of the display. Useful for small screens that only need one panel. With the Headless Terminal engine, panels are found where btop drew them. With Xvfb + xterm, they are cropped from btop's default layout, so for other presets or shown boxes use Custom Region Cameras instead.",
+                "value": self.region_cameras,
+                "choices": BTOP_PANELS,
+                "multiple": True,
+            },
+            {
+                "key": "custom_regions",
+                "title": "Custom Region Cameras",
+                "description": "Rectangles of the display to expose as separate cameras. Format: NAME: X,Y,WIDTH,HEIGHT, in pixels.",
+                "value": self.custom_regions,
+                "multiple": True,
+            },
         ]
 
-        if self.fonts_supported:
-            fontmanager = await self.getDevice('fontmanager')
-            await fontmanager.fonts_loaded
+        if await self.check_fonts_supported():
+            await self.font_index.ensure_loaded()
             settings.append({
                 "key": "xterm_font",
                 "title": "Xterm Font",
-                "description": "The Xterm font to use. Monospace fonts are recommended. Download additional fonts in the font manager page.",
+                "description": "The Xterm font to use. Monospace fonts are recommended and are listed first. Download additional fonts in the font manager page.",
                 "type": "string",
                 "value": self.xterm_font,
                 "choices": self.list_fonts(),
             })
+        if self.display_engine == 'Headless Terminal':
+            settings.append({
+                "key": "terminal_font_size",
+                "title": "Terminal Font Size",
+                "description": "The font size, in pixels, used by the Headless Terminal display engine.",
+                "type": "number",
+                "value": self.terminal_font_size,
+            })
 
         return settings
 
@@ -521,65 +1406,725 @@ class BtopCamera(ScryptedDeviceBase, VideoCamera, Settings, DeviceProvider):
             print("Another plugin requested restart...")
             await scrypted_sdk.deviceManager.requestRestart()
             return
+        if key == "calibrate_encoders":
+            if self.calibration_task is None or self.calibration_task.done():
+                self.calibration_task = asyncio.create_task(self.calibrate_encoders())
+            await self.onDeviceEvent(ScryptedInterface.Settings.value, None)
+            return
+
+        previous_regions = [region['id'] for region in self.regions]
+        if key in ('region_cameras', 'custom_regions'):
+            if not isinstance(value, list):
+                value = [value] if value else []
+            for text in value if key == 'custom_regions' else []:
+                if parse_custom_region(text) is None:
+                    print(f"Ignoring custom region {text!r}, expected NAME: X,Y,WIDTH,HEIGHT")
+            value = json.dumps(value)
 
         self.storage.setItem(key, value)
         await self.onDeviceEvent(ScryptedInterface.Settings.value, None)
-        print("Settings updated, will restart...")
-        await scrypted_sdk.deviceManager.requestRestart()
+
+        if key in ('region_cameras', 'custom_regions'):
+            print("Settings updated, updating region cameras...")
+            await self.update_region_devices(previous_regions)
+        elif key in ('btop_preset', 'xterm_font', 'terminal_font_size'):
+            print("Settings updated, restarting btop...")
+            await self.restart_client()
+        elif key in ('display_dimensions', 'virtual_display_num', 'capture_source'):
+            print("Settings updated, restarting display...")
+            await self.restart_display()
+        elif key in ('encoder_mode', 'capture_mode', 'max_fps', 'min_fps', 'encoder_profile'):
+            print("Settings updated, restarting encoders...")
+            await self.restart_encoders()
+        elif key in ('nice', 'io_priority', 'cpu_affinity', 'encoder_threads', 'cpu_quota', 'memory_limit'):
+            if key == 'cpu_affinity':
+                try:
+                    parse_cpu_list(value or '')
+                except ValueError:
+                    print(f"Ignoring CPU affinity {value!r}, expected a list such as 0-1 or 2,3")
+            print("Settings updated, applying resource limits...")
+            await self.apply_resource_policy()
+        elif key == 'snapshot_ttl':
+            self.snapshot_cache.ttl = self.snapshot_ttl
+        elif key == 'display_lifecycle':
+            self.apply_display_lifecycle()
+        elif key == 'idle_timeout':
+            pass
+        else:
+            print("Settings updated, will restart...")
+            await scrypted_sdk.deviceManager.requestRestart()
+
+    def stream_profile(self, id: str = None) -> Dict[str, Any]:
+        """Resolves a stream profile against the current display dimensions and frame rate limits."""
+        profile = next((p for p in BtopCamera.STREAM_PROFILES if p['id'] == id), BtopCamera.STREAM_PROFILES[0])
+        display_width, display_height = self.display_size
+        # dimensions must be even for yuv420p
+        width = int(display_width * profile['scale']) // 2 * 2
+        height = int(display_height * profile['scale']) // 2 * 2
+        fps = min(profile['fps'] or self.max_fps, self.max_fps)
+        keyframe_interval = profile['keyframe_interval'] * self.encoder_profile['keyframe_scale']
+        return dict(profile,
+                    width=width,
+                    height=height,
+                    scaled=profile['scale'] != 1,
+                    fps=fps,
+                    min_fps=min(self.min_fps, fps),
+                    keyframe_interval=keyframe_interval,
+                    gop=max(1, round(fps * keyframe_interval)))
 
     async def getVideoStreamOptions(self) -> list[ResponseMediaStreamOptions]:
-        return [
-            {
-                "id": "default",
-                "name": "Virtual Display",
-                "container": "x11grab",
-                "video": {
-                    "codec": "rawvideo",
-                },
+        options = []
+        for p in BtopCamera.STREAM_PROFILES:
+            profile = self.stream_profile(p['id'])
+            option = {
+                "id": profile['id'],
+                "name": profile['name'],
                 "audio": None,
                 "source": "synthetic",
                 "tool": "ffmpeg",
                 "userConfigurable": False,
+                "destinations": profile['destinations'],
             }
-        ]
+            if self.uses_stream_hub:
+                option["container"] = "mpegts"
+                option["video"] = {
+                    "codec": "h264",
+                    "width": profile['width'],
+                    "height": profile['height'],
+                    "fps": profile['fps'],
+                    "idrIntervalMillis": profile['keyframe_interval'] * 1000,
+                }
+                if profile['bitrate']:
+                    option["video"]["bitrate"] = profile['bitrate'] * 1000
+            else:
+                option["container"] = "x11grab"
+                option["video"] = {
+                    "codec": "rawvideo",
+                    "width": profile['width'],
+                    "height": profile['height'],
+                }
+            options.append(option)
+        return options
 
     async def get_cygwin_ffmpeg(self) -> str:
         assert platform.system() == 'Windows'
         await self.dependencies_installed
-        return subprocess.check_output([BtopCamera.CYGWIN_LAUNCHER, "cygpath -w $(which ffmpeg)"]).decode().strip()
+        with tracer.span('cygpath'):
+            return (await run_in_cygwin("cygpath -w $(which ffmpeg)")).decode().strip()
+
+    async def get_ffmpeg_path(self) -> str | None:
+        """Returns the FFmpeg executable able to capture from the virtual display, or None to use Scrypted's default."""
+        if platform.system() == 'Darwin':
+            if os.path.exists('/opt/homebrew/bin/ffmpeg'):
+                return '/opt/homebrew/bin/ffmpeg'
+            elif os.path.exists('/usr/local/bin/ffmpeg'):
+                return '/usr/local/bin/ffmpeg'
+        elif platform.system() == 'Windows':
+            return await self.cygwin_ffmpeg
+        return None
+
+    async def get_capture_ffmpeg_path(self) -> str:
+        return await self.get_ffmpeg_path() or await scrypted_sdk.mediaManager.getFFmpegPath()
+
+    def x11grab_input_arguments(self, profile: Dict[str, Any]) -> list[str]:
+        return [
+            "-f", "x11grab",
+            "-framerate", str(profile['fps']),
+            "-draw_mouse", "0",
+            "-i", f":{self.virtual_display_num}",
+        ]
+
+    def rawvideo_input_arguments(self, profile: Dict[str, Any], width: int, height: int, pix_fmt: str = "rgb24") -> list[str]:
+        """Input arguments for raw frames written to the encoder's stdin by a feeder."""
+        args = [
+            "-f", "rawvideo",
+            "-pix_fmt", pix_fmt,
+            "-video_size", f"{width}x{height}",
+            "-framerate", str(profile['fps']),
+        ]
+        if self.capture_mode == 'Damage-Driven':
+            # frames are only written when the contents change
+            args += ["-use_wallclock_as_timestamps", "1"]
+        args += ["-i", "pipe:0"]
+        return args
+
+    async def feed_terminal_frames(self, stdin: asyncio.StreamWriter, profile: Dict[str, Any], stats: PipelineStats = None) -> None:
+        """Writes rendered frames of the headless terminal to the encoder, skipping unchanged frames in Damage-Driven mode."""
+        loop = asyncio.get_event_loop()
+        interval = 1 / profile['fps']
+        keepalive = 1 / profile['min_fps']
+        damage_driven = self.capture_mode == 'Damage-Driven'
+        last_write = 0
+        last_version = None
+        while True:
+            started = loop.time()
+            renderer = self.terminal_renderer
+            session = self.terminal_session
+            if renderer is not None and session is not None and session.screen is not None:
+                await run_blocking(renderer.draw, renderer.snapshot(session.screen))
+                if not damage_driven or renderer.version != last_version or started - last_write >= keepalive:
+                    if stats is not None:
+                        stats.on_captured()
+                    stdin.write(renderer.frame)
+                    await stdin.drain()
+                    last_write = started
+                    last_version = renderer.version
+            await asyncio.sleep(max(0, interval - (loop.time() - started)))
+
+    def framebuffer_pix_fmt(self) -> str:
+        framebuffer = self.get_framebuffer()
+        try:
+            view = framebuffer.frame()
+        except ValueError as e:
+            # the feeder stops at the same error, and the encoders restart with x11grab
+            self.framebuffer_unusable(e)
+            view = None
+        if view is not None:
+            view.release()
+        # Xvfb uses the host's byte order, which is little endian on every supported platform
+        return framebuffer.pix_fmt or 'bgr0'
+
+    async def feed_framebuffer_frames(self, stdin: asyncio.StreamWriter, profile: Dict[str, Any], stats: PipelineStats = None) -> None:
+        """Writes frames from the Xvfb framebuffer to the encoder, skipping unchanged frames in Damage-Driven mode."""
+        loop = asyncio.get_event_loop()
+        interval = 1 / profile['fps']
+        keepalive = 1 / profile['min_fps']
+        damage_driven = self.capture_mode == 'Damage-Driven'
+        framebuffer = self.get_framebuffer()
+        size = self.display_size
+        last_write = 0
+        last_checksum = None
+        while True:
+            started = loop.time()
+            try:
+                view = framebuffer.frame()
+            except ValueError as e:
+                self.framebuffer_unusable(e)
+                return
+            if view is not None:
+                with view:
+                    # the encoder was started for the configured dimensions, the X server may still be restarting
+                    if framebuffer.size == size:
+                        checksum = await run_blocking(zlib.crc32, view) if damage_driven else None
+                        if not damage_driven or checksum != last_checksum or started - last_write >= keepalive:
+                            if stats is not None:
+                                stats.on_captured()
+                            stdin.write(view)
+                            last_write = started
+                            last_checksum = checksum
+                await stdin.drain()
+            await asyncio.sleep(max(0, interval - (loop.time() - started)))
+
+    def encoder_profile_arguments(self, encoder_profile: Dict[str, Any], bitrate: int | None = None) -> list[str]:
+        """Encoder arguments of an encoder profile, with the bitrate cap of the stream profile if it has one."""
+        args = [
+            "-c:v", "libx264" if platform.system() != "Windows" else "libopenh264",
+            "-preset", encoder_profile['preset'],
+            "-bf", "0",
+        ]
+        if encoder_profile['tune']:
+            args += ["-tune", encoder_profile['tune']]
+        if encoder_profile['crf'] is not None:
+            args += ["-crf", str(encoder_profile['crf'])]
+        if bitrate:
+            args += ["-b:v", f"{bitrate}k"]
+        maxrate = min([rate for rate in (encoder_profile['maxrate'], bitrate) if rate], default=None)
+        if maxrate:
+            args += [
+                "-maxrate", f"{maxrate}k",
+                "-bufsize", f"{maxrate * 2}k",
+            ]
+        if encoder_profile['intra_refresh']:
+            args += ["-intra-refresh", "1"]
+        if encoder_profile['pix_fmt'] == 'yuv444p':
+            args += ["-profile:v", "high444"]
+        args += ["-pix_fmt", encoder_profile['pix_fmt']]
+        threads = governor.policy.threads
+        if threads:
+            args += ["-threads", str(threads)]
+        return args
+
+    def h264_encoder_arguments(self, profile: Dict[str, Any], decimate: bool = True) -> list[str]:
+        fps = profile['fps']
+        args = self.encoder_profile_arguments(self.encoder_profile, profile['bitrate'])
+
+        filters = []
+        if profile['scaled']:
+            filters.append(f"scale={profile['width']}:{profile['height']}")
+
+        if self.capture_mode == 'Damage-Driven':
+            if decimate:
+                # mpdecimate with zero thresholds drops any frame identical to the previous
+                # one, but never more than max consecutive frames so that the minimum
+                # frame rate is honored
+                max_dropped = math.ceil(fps / profile['min_fps']) - 1
+                # max=0 would mean no limit, and with the minimum frame rate at the capture
+                # rate every frame has to be kept anyway
+                if max_dropped > 0:
+                    filters.append(f"mpdecimate=hi=0:lo=0:frac=0:max={max_dropped}")
+            args += [
+                "-vsync", "vfr",
+                "-force_key_frames", f"expr:gte(t,n_forced*{profile['keyframe_interval']})",
+            ]
+        else:
+            args += [
+                "-r", str(fps),
+            ]
+
+        if filters:
+            args += ["-vf", ",".join(filters)]
+
+        args += [
+            "-g", str(profile['gop']),
+        ]
+        return args
+
+    def get_stream_hub(self, profile: Dict[str, Any]) -> StreamHub:
+        key = f":{self.virtual_display_num}/{profile['id']}"
+        hub = self.stream_hubs.get(key)
+        if hub is None:
+            headless = self.display_engine == 'Headless Terminal'
+            framebuffer = self.uses_framebuffer
+
+            async def build_command():
+                ffmpeg = await self.get_capture_ffmpeg_path()
+                if headless:
+                    input_arguments = self.rawvideo_input_arguments(profile, *self.display_size)
+                    encoder_arguments = self.h264_encoder_arguments(profile, decimate=False)
+                elif framebuffer:
+                    input_arguments = self.rawvideo_input_arguments(profile, *self.display_size, pix_fmt=self.framebuffer_pix_fmt())
+                    encoder_arguments = self.h264_encoder_arguments(profile, decimate=False)
+                else:
+                    input_arguments = self.x11grab_input_arguments(profile)
+                    encoder_arguments = self.h264_encoder_arguments(profile)
+                args = [
+                    ffmpeg,
+                    "-hide_banner",
+                    "-loglevel", "error",
+                    *input_arguments,
+                    *encoder_arguments,
+                    "-f", "mpegts",
+                    "pipe:1",
+                ]
+                env = dict(os.environ, XAUTHORITY=BtopCamera.XAUTH)
+                return args, env
+
+            if headless:
+                hub = StreamHub(f"Headless Terminal/{profile['id']}", build_command, feeder=lambda stdin: self.feed_terminal_frames(stdin, profile, hub.stats),
+                                keyframe_interval=profile['keyframe_interval'])
+            elif framebuffer:
+                hub = StreamHub(f"Framebuffer {key}", build_command, feeder=lambda stdin: self.feed_framebuffer_frames(stdin, profile, hub.stats),
+                                keyframe_interval=profile['keyframe_interval'])
+            else:
+                hub = StreamHub(f"Display {key}", build_command, keyframe_interval=profile['keyframe_interval'])
+            self.stream_hubs[key] = hub
+        return hub
+
+    def region(self, id: str) -> Dict[str, Any] | None:
+        return next((region for region in self.regions if region['id'] == id), None)
+
+    async def update_region_devices(self, previous: list[str]) -> None:
+        """Discovers the configured region cameras and removes the ones no longer configured."""
+        current = [region['id'] for region in self.regions]
+        # the rectangle of a region may have changed, so its encoder restarts with the next viewer
+        for id in previous:
+            await self.close_region_hub(id)
+        await self.discover_devices()
+        for id in previous:
+            if id not in current:
+                self.region_devices.pop(id, None)
+                await scrypted_sdk.deviceManager.onDeviceRemoved(f"region:{id}")
+        self.snapshot_cache.clear()
+
+    async def close_region_hub(self, id: str) -> None:
+        hub = self.stream_hubs.pop(self.region_hub_key(id), None)
+        if hub is not None:
+            await hub.close()
+
+    def detected_panel_rect(self, panel: str) -> Tuple[int, int, int, int] | None:
+        """Returns the rectangle of a btop box on the headless screen, or None if it is not shown there."""
+        renderer = self.terminal_renderer
+        session = self.terminal_session
+        if self.display_engine != 'Headless Terminal' or renderer is None or session is None or session.screen is None:
+            return None
+        # the headless screen shows where btop actually drew its boxes
+        box = find_panel_boxes(session.screen.display).get(panel)
+        if box is None:
+            return None
+        column, row, columns, rows = box
+        rect = (column * renderer.cell_width, row * renderer.cell_height, columns * renderer.cell_width, rows * renderer.cell_height)
+        return clip_rect(rect, *self.display_size)
+
+    def region_rect(self, region: Dict[str, Any]) -> Tuple[int, int, int, int]:
+        """Resolves a region to a rectangle of the display, in pixels. xterm draws into the X server, so with
+        Xvfb + xterm btop panels are assumed to be in btop's default layout."""
+        display_width, display_height = self.display_size
+        panel = region.get('panel')
+        if panel is None:
+            return clip_rect(region['rect'], display_width, display_height)
+
+        rect = self.detected_panel_rect(panel)
+        if rect is not None:
+            return rect
+
+        x, y, width, height = DEFAULT_PANEL_LAYOUT[panel]
+        rect = (round(x * display_width), round(y * display_height), round(width * display_width), round(height * display_height))
+        return clip_rect(rect, display_width, display_height)
+
+    def region_profile(self, rect: Tuple[int, int, int, int]) -> Dict[str, Any]:
+        profile = BtopCamera.REGION_PROFILE
+        fps = min(profile['fps'], self.max_fps)
+        keyframe_interval = profile['keyframe_interval'] * self.encoder_profile['keyframe_scale']
+        return dict(profile,
+                    width=rect[2],
+                    height=rect[3],
+                    scaled=False,
+                    fps=fps,
+                    min_fps=min(self.min_fps, fps),
+                    keyframe_interval=keyframe_interval,
+                    gop=max(1, round(fps * keyframe_interval)))
+
+    def get_raw_capture(self) -> RawCapture:
+        """Returns the x11grab capture that region cameras crop their frames from."""
+        if self.raw_capture is None:
+            async def build_command():
+                width, height = self.display_size
+                args = [
+                    await self.get_capture_ffmpeg_path(),
+                    "-hide_banner",
+                    "-loglevel", "error",
+                    *self.x11grab_input_arguments({"fps": min(BtopCamera.REGION_PROFILE['fps'], self.max_fps)}),
+                    "-f", "rawvideo",
+                    "-pix_fmt", "rgb24",
+                    "pipe:1",
+                ]
+                env = dict(os.environ, XAUTHORITY=BtopCamera.XAUTH)
+                return args, env, (width, height)
+
+            self.raw_capture = RawCapture(f"Display :{self.virtual_display_num}/regions", build_command)
+        return self.raw_capture
+
+    async def feed_region_frames(self, stdin: asyncio.StreamWriter, pipeline: Dict[str, Any], stats: PipelineStats = None) -> None:
+        """Writes the region cropped from the display to the encoder, skipping unchanged frames in Damage-Driven mode."""
+        loop = asyncio.get_event_loop()
+        profile = pipeline['profile']
+        rect = pipeline['rect']
+        panel = pipeline['region'].get('panel')
+        last_panel_check = loop.time()
+        interval = 1 / profile['fps']
+        keepalive = 1 / profile['min_fps']
+        damage_driven = self.capture_mode == 'Damage-Driven'
+        framebuffer = self.get_framebuffer() if self.uses_framebuffer else None
+        capture = self.get_raw_capture() if self.display_engine != 'Headless Terminal' and framebuffer is None else None
+        if capture is not None:
+            capture.acquire()
+        last_write = 0
+        last_crop = None
+        try:
+            while True:
+                started = loop.time()
+                if panel is not None and started - last_panel_check >= BtopCamera.PANEL_CHECK_INTERVAL:
+                    last_panel_check = started
+                    # btop lays its boxes out again when the preset or the shown boxes change
+                    moved = self.detected_panel_rect(panel)
+                    if moved is not None and moved != rect:
+                        if moved[2:] != rect[2:]:
+                            # the encoder was started for the previous size, viewers reconnect to a new one
+                            print(f"btop {panel} panel resized to {moved[2]}x{moved[3]}, restarting its encoder")
+                            asyncio.ensure_future(self.close_region_hub(pipeline['region']['id']))
+                            return
+                        rect = pipeline['rect'] = moved
+                crop = None
+                if framebuffer is not None:
+                    try:
+                        view = framebuffer.frame()
+                    except ValueError as e:
+                        self.framebuffer_unusable(e)
+                        return
+                    if view is not None:
+                        with view:
+                            if framebuffer.size == self.display_size:
+                                crop = await run_blocking(crop_frame, view, framebuffer.stride, 4, rect)
+                elif capture is not None:
+                    if capture.frame is not None:
+                        crop = crop_frame(capture.frame, capture.frame_size[0] * 3, 3, rect)
+                else:
+                    renderer = self.terminal_renderer
+                    session = self.terminal_session
+                    if renderer is not None and session is not None and session.screen is not None:
+                        snapshot = renderer.snapshot(session.screen)
+
+                        def render_crop():
+                            with renderer.lock:
+                                renderer.draw(snapshot)
+                                return crop_frame(renderer.frame, renderer.width * 3, 3, rect)
+                        crop = await run_blocking(render_crop)
+                if crop is not None:
+                    if not damage_driven or crop != last_crop or started - last_write >= keepalive:
+                        if stats is not None:
+                            stats.on_captured()
+                        stdin.write(crop)
+                        await stdin.drain()
+                        last_write = started
+                        last_crop = crop
+                await asyncio.sleep(max(0, interval - (loop.time() - started)))
+        finally:
+            if capture is not None:
+                capture.release()
+
+    def region_hub_key(self, id: str) -> str:
+        return f":{self.virtual_display_num}/region-{id}"
+
+    def get_region_hub(self, region: Dict[str, Any]) -> StreamHub:
+        """Returns the shared encoder of a region camera. Region cameras always use Shared encoders, fed with
+        frames cropped from a single capture of the display, or from the Xvfb framebuffer."""
+        key = self.region_hub_key(region['id'])
+        hub = self.stream_hubs.get(key)
+        if hub is None:
+            # resolved again each time the encoder starts, so that it follows the panel's current position
+            pipeline = {}
+
+            async def build_command():
+                rect = self.region_rect(region)
+                profile = self.region_profile(rect)
+                pipeline.update(rect=rect, profile=profile, region=region)
+                args = [
+                    await self.get_capture_ffmpeg_path(),
+                    "-hide_banner",
+                    "-loglevel", "error",
+                    *self.rawvideo_input_arguments(profile, rect[2], rect[3], pix_fmt=self.framebuffer_pix_fmt() if self.uses_framebuffer else "rgb24"),
+                    *self.h264_encoder_arguments(profile, decimate=False),
+                    "-f", "mpegts",
+                    "pipe:1",
+                ]
+                return args, dict(os.environ)
+
+            # the keyframe interval does not depend on the region's size
+            keyframe_interval = self.region_profile((0, 0, 0, 0))['keyframe_interval']
+            hub = StreamHub(f"Region {key}", build_command, feeder=lambda stdin: self.feed_region_frames(stdin, pipeline, hub.stats),
+                            keyframe_interval=keyframe_interval)
+            self.stream_hubs[key] = hub
+        return hub
+
+    async def calibrate_encoders(self) -> None:
+        """Records a sample of the display and reports how each encoder profile does on it."""
+        try:
+            await self.acquire_display()
+            ffmpeg = await self.get_capture_ffmpeg_path()
+            profile = self.stream_profile('default')
+            fps = profile['fps']
+            if self.display_engine == 'Headless Terminal':
+                input_arguments = self.rawvideo_input_arguments(profile, *self.display_size)
+                feeder = lambda stdin: self.feed_terminal_frames(stdin, profile)
+            elif self.uses_framebuffer:
+                input_arguments = self.rawvideo_input_arguments(profile, *self.display_size, pix_fmt=self.framebuffer_pix_fmt())
+                feeder = lambda stdin: self.feed_framebuffer_frames(stdin, profile)
+            else:
+                input_arguments = self.x11grab_input_arguments(profile)
+                feeder = None
+
+            await run_blocking(os.makedirs, BtopCamera.CALIBRATION_DIR, exist_ok=True)
+            sample = os.path.join(BtopCamera.CALIBRATION_DIR, 'sample.mkv')
+            print(f"Recording {BtopCamera.CALIBRATION_SECONDS}s of the display for encoder calibration...")
+            # keep the display in use while recording
+            self.last_activity = asyncio.get_event_loop().time()
+            await record_sample(ffmpeg, input_arguments, sample, BtopCamera.CALIBRATION_SECONDS, fps,
+                                dict(os.environ, XAUTHORITY=BtopCamera.XAUTH), feeder)
+
+            base_interval = BtopCamera.STREAM_PROFILES[0]['keyframe_interval']
+            profiles = {}
+            for encoder_profile in BtopCamera.ENCODER_PROFILES:
+                keyframe_interval = base_interval * encoder_profile['keyframe_scale']
+                profiles[encoder_profile['name']] = [
+                    *self.encoder_profile_arguments(encoder_profile, profile['bitrate']),
+                    "-r", str(fps),
+                    "-g", str(max(1, round(fps * keyframe_interval))),
+                ]
+            print("Encoding the calibration sample with each encoder profile...")
+            try:
+                results = await calibrate(ffmpeg, sample, BtopCamera.CALIBRATION_SECONDS, profiles, BtopCamera.CALIBRATION_DIR)
+            finally:
+                await run_blocking(os.remove, sample)
+            report = f"{self.display_dimensions} at {fps} fps, {self.display_engine}\n{format_results(results)}"
+        except Exception as e:
+            report = f"Calibration failed: {e}"
+        print(report)
+        self.storage.setItem('encoder_calibration', report)
+        await self.onDeviceEvent(ScryptedInterface.Settings.value, None)
 
     async def getVideoStream(self, options: RequestMediaStreamOptions = None) -> scrypted_sdk.MediaObject:
-        await self.stream_initialized
+        await self.acquire_display()
+
+        profile = self.stream_profile((options or {}).get('id'))
+        stream_options = next(o for o in await self.getVideoStreamOptions() if o['id'] == profile['id'])
+
+        if self.uses_stream_hub:
+            hub = self.get_stream_hub(profile)
+            port = await hub.listen()
+            hub.warm()
+            ffmpeg_input = {
+                "url": None,
+                "inputArguments": [
+                    "-f", "mpegts",
+                    "-i", f"tcp://127.0.0.1:{port}",
+                ],
+                "mediaStreamOptions": stream_options,
+            }
+            return await scrypted_sdk.mediaManager.createFFmpegMediaObject(ffmpeg_input)
 
         ffmpeg_input = {
-            "inputArguments": [
-                "-f", "x11grab",
-                "-framerate", "15",
-                "-draw_mouse", "0",
-                "-i", f":{self.virtual_display_num}",
-            ],
+            "inputArguments": self.x11grab_input_arguments(profile),
             "env": {
                 "XAUTHORITY": BtopCamera.XAUTH,
             },
-            "h264EncoderArguments": [
-                "-c:v", "libx264" if platform.system() != "Windows" else "libopenh264",
-                "-preset", "ultrafast",
-                "-bf", "0",
-                "-r", "15",
-                "-g", "60",
-            ]
+            "h264EncoderArguments": self.h264_encoder_arguments(profile),
+            "mediaStreamOptions": stream_options,
         }
 
-        if platform.system() == 'Darwin':
-            if os.path.exists('/opt/homebrew/bin/ffmpeg'):
-                ffmpeg_input['ffmpegPath'] = '/opt/homebrew/bin/ffmpeg'
-            elif os.path.exists('/usr/local/bin/ffmpeg'):
-                ffmpeg_input['ffmpegPath'] = '/usr/local/bin/ffmpeg'
-        elif platform.system() == 'Windows':
-            ffmpeg_input['ffmpegPath'] = await self.cygwin_ffmpeg
+        ffmpeg_path = await self.get_ffmpeg_path()
+        if ffmpeg_path:
+            ffmpeg_input['ffmpegPath'] = ffmpeg_path
 
         return await scrypted_sdk.mediaManager.createFFmpegMediaObject(ffmpeg_input)
 
+    async def getPictureOptions(self) -> list[ResponsePictureOptions]:
+        width, height = self.display_size
+        return [
+            {
+                "id": "default",
+                "name": "Virtual Display",
+                "picture": {
+                    "width": width,
+                    "height": height,
+                },
+            }
+        ]
+
+    async def takePicture(self, options: RequestPictureOptions = None) -> scrypted_sdk.MediaObject:
+        picture = (options or {}).get('picture') or {}
+        width = picture.get('width')
+        height = picture.get('height')
+
+        async def refresh():
+            await self.acquire_display()
+            return await self.capture_snapshot(width, height)
+
+        data = await self.snapshot_cache.get_or_refresh((width, height), refresh)
+        return await scrypted_sdk.mediaManager.createMediaObject(data, 'image/jpeg')
+
+    async def capture_snapshot(self, width: int = None, height: int = None, rect: Tuple[int, int, int, int] = None) -> bytes:
+        """Captures a JPEG of the display, or of a rectangle of it, from the rendered frame for the headless
+        terminal, from the Xvfb framebuffer or with a one-shot x11grab."""
+        image = None
+        if self.display_engine == 'Headless Terminal':
+            renderer = self.terminal_renderer
+            session = self.terminal_session
+            if renderer is None or session is None or session.screen is None:
+                raise Exception("Headless terminal is not running.")
+            snapshot = renderer.snapshot(session.screen)
+
+            def render_image():
+                with renderer.lock:
+                    renderer.draw(snapshot)
+                    if rect:
+                        x, y, w, h = rect
+                        return renderer.image.crop((x, y, x + w, y + h))
+                    return renderer.image.copy()
+            image = await run_blocking(render_image)
+        elif self.uses_framebuffer:
+            try:
+                image = self.get_framebuffer().image(rect)
+            except ValueError as e:
+                # captured with x11grab below
+                self.framebuffer_unusable(e)
+
+        if image is not None:
+            def encode():
+                resized = image
+                if width or height:
+                    w = width or round(image.width * height / image.height)
+                    h = height or round(image.height * width / image.width)
+                    resized = image.resize((w, h))
+                out = io.BytesIO()
+                resized.save(out, format='JPEG', quality=90)
+                return out.getvalue()
+
+            return await run_blocking(encode)
+
+        args = [
+            await self.get_capture_ffmpeg_path(),
+            "-hide_banner",
+            "-loglevel", "error",
+            "-f", "x11grab",
+            "-draw_mouse", "0",
+        ]
+        if rect:
+            # grab only the rectangle rather than cropping the whole display
+            x, y, w, h = rect
+            args += ["-video_size", f"{w}x{h}", "-i", f":{self.virtual_display_num}+{x},{y}"]
+        else:
+            args += ["-i", f":{self.virtual_display_num}"]
+        args += ["-frames:v", "1"]
+        if width or height:
+            args += ["-vf", f"scale={width or -2}:{height or -2}"]
+        args += ["-c:v", "mjpeg", "-f", "image2", "pipe:1"]
+
+        p = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=dict(os.environ, XAUTHORITY=BtopCamera.XAUTH))
+        await run_blocking(governor.apply, p.pid, 'snapshot')
+        stdout, stderr = await p.communicate()
+        if p.returncode != 0 or not stdout:
+            raise Exception(f"Snapshot capture failed: {stderr.decode('utf-8', errors='replace').strip()}")
+        return stdout
+
+    async def onRequest(self, request: HttpRequest, response: HttpResponse) -> None:
+        """Serves the text on the headless terminal's screen: the whole screen at the endpoint's root, and the
+        changes to it at /stream. ?format= picks text, ansi or json, and ?interval= how often, in seconds,
+        the stream checks for changes."""
+        if self.display_engine != 'Headless Terminal':
+            # xterm draws into the X server, so there is no screen contents to read other than pixels
+            response.send("Text frames require the Headless Terminal display engine, select it under Display Engine.\n", {"code": 409})
+            return
+        url = urllib.parse.urlparse(request['url'])
+        path = url.path[len(request.get('rootPath') or ''):].strip('/')
+        query = urllib.parse.parse_qs(url.query)
+        format = query.get('format', ['text'])[0]
+        if path not in ('', 'stream') or format not in TEXT_FORMATS:
+            response.send(f"Not found. Use / or /stream, with ?format= one of {', '.join(TEXT_FORMATS)}.\n", {"code": 404})
+            return
+
+        await self.acquire_display()
+        if self.screen_cells is None:
+            self.screen_cells = ScreenCells()
+        content_type = "application/json" if format == 'json' else "text/plain; charset=utf-8"
+
+        if path == '':
+            cells = self.screen_cells.get(self.terminal_session)
+            if cells is None:
+                response.send("Headless terminal is not running.\n", {"code": 503})
+                return
+            response.send(format_screen(cells, format), {"headers": {"Content-Type": content_type}})
+            return
+
+        try:
+            interval = max(BtopCamera.MIN_TEXT_STREAM_INTERVAL, float(query.get('interval', [BtopCamera.TEXT_STREAM_INTERVAL])[0]))
+        except ValueError:
+            interval = BtopCamera.TEXT_STREAM_INTERVAL
+
+        async def stream():
+            self.text_viewers += 1
+            try:
+                async for chunk in stream_text_frames(lambda: self.terminal_session, self.screen_cells, format, interval):
+                    yield chunk
+            finally:
+                self.text_viewers -= 1
+
+        response.sendStream(stream(), {
+            "headers": {
+                "Content-Type": "text/event-stream" if format == 'json' else content_type,
+                "Cache-Control": "no-cache",
+            },
+        })
+
     async def getDevice(self, nativeId: str) -> Any:
         if nativeId == 'config':
             if not self.btop_config:
@@ -593,9 +2138,100 @@ class BtopCamera(ScryptedDeviceBase, VideoCamera, Settings, DeviceProvider):
             if not self.thememanager:
                 self.thememanager = BtopThemeManager(nativeId, self)
             return self.thememanager
+        elif nativeId == 'metrics':
+            if not self.metrics_device:
+                self.metrics_device = BtopMetrics(nativeId, self)
+            return self.metrics_device
+        elif nativeId.startswith('region:'):
+            id = nativeId[len('region:'):]
+            if id not in self.region_devices:
+                self.region_devices[id] = BtopRegionCamera(nativeId, self, id)
+            return self.region_devices[id]
         return None
 
 
+class BtopRegionCamera(ScryptedDeviceBase, VideoCamera, Camera):
+    """A camera showing one btop panel or a custom rectangle of the display, cropped from the parent's capture."""
+
+    def __init__(self, nativeId: str, parent: BtopCamera, region_id: str) -> None:
+        super().__init__(nativeId)
+        self.parent = parent
+        self.region_id = region_id
+
+    @property
+    def region(self) -> Dict[str, Any]:
+        region = self.parent.region(self.region_id)
+        if region is None:
+            raise Exception(f"Region {self.region_id} is no longer configured.")
+        return region
+
+    async def getVideoStreamOptions(self) -> list[ResponseMediaStreamOptions]:
+        profile = self.parent.region_profile(self.parent.region_rect(self.region))
+        return [
+            {
+                "id": profile['id'],
+                "name": profile['name'],
+                "audio": None,
+                "source": "synthetic",
+                "tool": "ffmpeg",
+                "userConfigurable": False,
+                "destinations": profile['destinations'],
+                "container": "mpegts",
+                "video": {
+                    "codec": "h264",
+                    "width": profile['width'],
+                    "height": profile['height'],
+                    "fps": profile['fps'],
+                    "idrIntervalMillis": profile['keyframe_interval'] * 1000,
+                },
+            }
+        ]
+
+    async def getVideoStream(self, options: RequestMediaStreamOptions = None) -> scrypted_sdk.MediaObject:
+        region = self.region
+        await self.parent.acquire_display()
+
+        stream_options = (await self.getVideoStreamOptions())[0]
+        hub = self.parent.get_region_hub(region)
+        port = await hub.listen()
+        hub.warm()
+        ffmpeg_input = {
+            "url": None,
+            "inputArguments": [
+                "-f", "mpegts",
+                "-i", f"tcp://127.0.0.1:{port}",
+            ],
+            "mediaStreamOptions": stream_options,
+        }
+        return await scrypted_sdk.mediaManager.createFFmpegMediaObject(ffmpeg_input)
+
+    async def getPictureOptions(self) -> list[ResponsePictureOptions]:
+        x, y, width, height = self.parent.region_rect(self.region)
+        return [
+            {
+                "id": "default",
+                "name": self.region['name'],
+                "picture": {
+                    "width": width,
+                    "height": height,
+                },
+            }
+        ]
+
+    async def takePicture(self, options: RequestPictureOptions = None) -> scrypted_sdk.MediaObject:
+        region = self.region
+        picture = (options or {}).get('picture') or {}
+        width = picture.get('width')
+        height = picture.get('height')
+
+        async def refresh():
+            await self.parent.acquire_display()
+            return await self.parent.capture_snapshot(width, height, self.parent.region_rect(region))
+
+        data = await self.parent.snapshot_cache.get_or_refresh((region['id'], width, height), refresh)
+        return await scrypted_sdk.mediaManager.createMediaObject(data, 'image/jpeg')
+
+
 class BtopConfig(ScryptedDeviceBase, Readme):
     def __init__(self, nativeId: str, parent: BtopCamera) -> None:
         super().__init__(nativeId)
@@ -619,33 +2255,18 @@ class BtopConfig(ScryptedDeviceBase, Readme):
 
 
 class DownloaderBase(ScryptedDeviceBase):
+    DOWNLOAD_CACHE_DIR = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'files', 'downloads')
+    MAX_PARALLEL_DOWNLOADS = 4
+
     def __init__(self, nativeId: str | None = None):
         super().__init__(nativeId)
+        self.download_cache = DownloadCache(DownloaderBase.DOWNLOAD_CACHE_DIR, DownloaderBase.MAX_PARALLEL_DOWNLOADS, log=self.print)
 
-    def downloadFile(self, url: str, filename: str):
+    async def downloadFile(self, url: str) -> str:
+        """Returns the path of the cached download of the URL. A #sha256=<hex> fragment pins the expected contents."""
         try:
-            filesPath = os.path.join(os.environ['SCRYPTED_PLUGIN_VOLUME'], 'files')
-            fullpath = os.path.join(filesPath, filename)
-            if os.path.isfile(fullpath):
-                return fullpath
-            tmp = fullpath + '.tmp'
-            self.print("Creating directory for", tmp)
-            os.makedirs(os.path.dirname(fullpath), exist_ok=True)
-            self.print("Downloading", url)
-            response = urllib.request.urlopen(url)
-            if response.getcode() is not None and response.getcode() < 200 or response.getcode() >= 300:
-                raise Exception(f"Error downloading")
-            read = 0
-            with open(tmp, "wb") as f:
-                while True:
-                    data = response.read(1024 * 1024)
-                    if not data:
-                        break
-                    read += len(data)
-                    self.print("Downloaded", read, "bytes")
-                    f.write(data)
-            os.rename(tmp, fullpath)
-            return fullpath
+            with tracer.span('download', url=url):
+                return await self.download_cache.fetch(url)
         except:
             self.print("Error downloading", url)
             import traceback
@@ -661,29 +2282,41 @@ class BtopFontManager(DownloaderBase, Settings, Readme):
     def __init__(self, nativeId: str, parent: BtopCamera):
         super().__init__(nativeId)
         self.parent = parent
-        self.fonts_loaded = asyncio.ensure_future(self.load_fonts())
+        self.fonts_loaded = asyncio.ensure_future(trace_phase('load_fonts', self.load_fonts()))
 
     async def load_fonts(self) -> None:
         if platform.system() == 'Windows':
             await self.parent.dependencies_installed
-            subprocess.Popen(f'"{BtopCamera.CYGWIN_LAUNCHER}" "mkdir -p {BtopFontManager.CYGWIN_FONT_DIR}"', shell=True).communicate()
+            await run_in_cygwin(f"mkdir -p {BtopFontManager.CYGWIN_FONT_DIR}", check=False)
         else:
             os.makedirs(BtopFontManager.LOCAL_FONT_DIR, exist_ok=True)
-        try:
-            urls = self.font_urls
-            for url in urls:
-                filename = url.split('/')[-1]
-                fullpath = self.downloadFile(url, filename)
+        installed = []
+
+        async def install(url: str) -> None:
+            try:
+                fullpath = await self.downloadFile(url)
+                filename = urllib.parse.unquote(urllib.parse.urldefrag(url)[0].split('/')[-1])
                 if platform.system() == 'Windows':
                     target = f"{BtopFontManager.CYGWIN_FONT_DIR}/{filename}"
-                    copy_file_to(fullpath, target)
+                    await copy_file_to(fullpath, target)
                 else:
                     target = os.path.join(BtopFontManager.LOCAL_FONT_DIR, filename)
-                    shutil.copyfile(fullpath, target)
+                    await run_blocking(shutil.copyfile, fullpath, target)
                 self.print("Installed", target)
-        except:
-            import traceback
-            traceback.print_exc()
+                installed.append(target)
+            except:
+                import traceback
+                traceback.print_exc()
+
+        # downloads run in parallel, bounded by the download cache
+        await asyncio.gather(*[install(url) for url in self.font_urls])
+
+        if installed:
+            if platform.system() == 'Windows':
+                # the installed paths are only meaningful inside cygwin, so enumerate again
+                await self.parent.font_index.reload()
+            else:
+                await self.parent.font_index.add_files(installed)
 
     @property
     def font_urls(self) -> list[str]:
@@ -715,6 +2348,8 @@ class BtopFontManager(DownloaderBase, Settings, Readme):
 # Font Manager
 
 List fonts to download and install in the local font directory. Fonts will be installed to `{fontdir}`.
+
+Downloads are cached in the plugin volume and revalidated on startup, so unchanged fonts are not downloaded again. To pin a font to known contents, append its SHA-256 to the URL as `#sha256=<hex>`.
 """
 
 
@@ -742,5 +2377,158 @@ class BtopThemeManager(DownloaderBase, Readme):
 """
 
 
+class BtopMetrics(ScryptedDeviceBase, HttpRequestHandler, Readme):
+    def __init__(self, nativeId: str, parent: BtopCamera) -> None:
+        super().__init__(nativeId)
+        self.parent = parent
+
+    async def collect(self) -> list:
+        """Gathers the current metrics as (name, type, help, samples) families."""
+        parent = self.parent
+        include = None
+        if not parent.uses_stream_hub:
+            # Per-Session encoders are run by the Rebroadcast plugin rather than as children of this plugin
+            display = f":{parent.virtual_display_num}"
+            include = lambda cmdline: 'x11grab' in cmdline and display in cmdline
+        processes = await run_blocking(parent.metrics.sampler.sample, include)
+
+        pipelines = []
+        for key, hub in parent.stream_hubs.items():
+            display, _, profile = key.partition('/')
+            pipelines.append(({"display": display, "profile": profile}, hub))
+
+        def per_pipeline(value: Callable[[StreamHub], Any]) -> list:
+            return [(labels, value(hub)) for labels, hub in pipelines]
+
+        def per_process(field: str) -> list:
+            return [({"process": name}, usage[field]) for name, usage in processes.items()]
+
+        return [
+            ("btop_camera_consumers", "gauge", "Viewers across all encoders, including Per-Session encoders.",
+             [({}, await parent.consumer_count())]),
+            ("btop_camera_viewers", "gauge", "Viewers connected to a shared encoder.",
+             per_pipeline(lambda hub: hub.viewer_count)),
+            ("btop_camera_captured_fps", "gauge", "Frames handed to the encoder per second. Only measured where the plugin supplies the frames.",
+             per_pipeline(lambda hub: round(hub.stats.captured_rate.rate(), 3) if hub.stats.frames_captured else None)),
+            ("btop_camera_encoded_fps", "gauge", "Frames produced by the encoder per second.",
+             per_pipeline(lambda hub: round(hub.stats.encoded_rate.rate(), 3))),
+            ("btop_camera_bitrate_bps", "gauge", "Encoder output bitrate in bits per second.",
+             per_pipeline(lambda hub: round(hub.stats.byte_rate.rate() * 8))),
+            ("btop_camera_frames_captured_total", "counter", "Frames handed to the encoder.",
+             per_pipeline(lambda hub: hub.stats.frames_captured)),
+            ("btop_camera_frames_encoded_total", "counter", "Frames produced by the encoder.",
+             per_pipeline(lambda hub: hub.stats.frames_encoded)),
+            ("btop_camera_encoded_bytes_total", "counter", "Bytes produced by the encoder.",
+             per_pipeline(lambda hub: hub.stats.bytes_encoded)),
+            ("btop_camera_encode_latency_seconds", "gauge", "Time from the most recent frame being handed to the encoder to its encoded output.",
+             per_pipeline(lambda hub: hub.stats.latency_last)),
+            ("btop_camera_encode_latency_measured_seconds_total", "counter", "Total encode latency of all measured frames.",
+             per_pipeline(lambda hub: hub.stats.latency_sum)),
+            ("btop_camera_encode_latency_measured_frames_total", "counter", "Frames whose encode latency was measured.",
+             per_pipeline(lambda hub: hub.stats.latency_count)),
+            ("btop_camera_encoder_exits_total", "counter", "Times the encoder exited.",
+             per_pipeline(lambda hub: hub.stats.encoder_exits)),
+            ("btop_camera_gop_cache_bytes", "gauge", "Encoded output kept since the most recent keyframe, for new viewers.",
+             per_pipeline(lambda hub: hub.gop_bytes)),
+            ("btop_camera_gop_replays_total", "counter", "Viewers that started from the cached output rather than waiting for a keyframe.",
+             per_pipeline(lambda hub: hub.stats.replays)),
+            ("btop_camera_keyframe_requests_total", "counter", "Encoder restarts to produce a keyframe for a new viewer.",
+             per_pipeline(lambda hub: hub.stats.keyframe_requests)),
+            ("btop_camera_process_restarts_total", "counter", "Restarts of supervised processes, by reason.",
+             [({"process": process, "reason": reason}, count) for (process, reason), count in parent.metrics.restarts.items()]),
+            ("btop_camera_process_count", "gauge", "Running processes.", per_process('count')),
+            ("btop_camera_process_cpu_percent", "gauge", "CPU usage of the processes since the previous scrape, in percent of one core.", per_process('cpu_percent')),
+            ("btop_camera_process_resident_memory_bytes", "gauge", "Resident memory of the processes.", per_process('rss_bytes')),
+            ("btop_camera_event_loop_lag_seconds", "gauge", "How late the plugin's event loop ran its most recent timer.",
+             [({}, round(parent.loop_monitor.lag_last, 6))]),
+            ("btop_camera_event_loop_lag_max_seconds", "gauge", "Longest event loop lag since the plugin started.",
+             [({}, round(parent.loop_monitor.lag_max, 6))]),
+            ("btop_camera_event_loop_stalls_total", "counter", f"Event loop stalls longer than {parent.loop_monitor.threshold}s.",
+             [({}, parent.loop_monitor.stalls)]),
+            ("btop_camera_event_loop_stalled_seconds_total", "counter", "Total duration of event loop stalls.",
+             [({}, round(parent.loop_monitor.stalled_seconds, 6))]),
+        ]
+
+    async def onRequest(self, request: HttpRequest, response: HttpResponse) -> None:
+        response.send(format_prometheus(await self.collect()), {
+            "headers": {
+                "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+            },
+        })
+
+    async def getReadmeMarkdown(self) -> str:
+        parent = self.parent
+        try:
+            endpoint = await scrypted_sdk.endpointManager.getPath(self.nativeId)
+        except:
+            endpoint = None
+
+        def fmt(value: float | None, unit: str = '') -> str:
+            return '-' if value is None else f"{value:.2f}{unit}" if isinstance(value, float) else f"{value}{unit}"
+
+        lines = [
+            "# Metrics",
+            "",
+            "Runtime metrics of the capture and encode pipeline and of the supervised processes. This page is a snapshot, refresh it to update.",
+            "",
+        ]
+        if endpoint:
+            lines += [f"Metrics are available in the Prometheus text format at `{endpoint}`.", ""]
+
+        families = {name: samples for name, _, _, samples in await self.collect()}
+        lines += [f"Total viewers: {families['btop_camera_consumers'][0][1]}", ""]
+
+        if parent.stream_hubs:
+            lines += [
+                "## Encoders",
+                "",
+                "| Encoder | Viewers | Captured fps | Encoded fps | Bitrate | Latency | Exits | Last exit |",
+                "|---|---|---|---|---|---|---|---|",
+            ]
+            for key, hub in parent.stream_hubs.items():
+                stats = hub.stats
+                captured = stats.captured_rate.rate() if stats.frames_captured else None
+                latency = stats.latency_average
+                lines.append(f"| {key} | {hub.viewer_count} | {fmt(captured)} | {fmt(stats.encoded_rate.rate())} | "
+                             f"{fmt(stats.byte_rate.rate() * 8 / 1000, ' kbps')} | {fmt(latency * 1000 if latency is not None else None, ' ms')} | "
+                             f"{stats.encoder_exits} | {stats.last_exit_reason or '-'} |")
+            lines.append("")
+
+        lines += [
+            "## Processes",
+            "",
+            "| Process | Count | CPU | Memory |",
+            "|---|---|---|---|",
+        ]
+        for (labels, count), (_, cpu), (_, rss) in zip(families['btop_camera_process_count'], families['btop_camera_process_cpu_percent'], families['btop_camera_process_resident_memory_bytes']):
+            lines.append(f"| {labels['process']} | {count} | {cpu:.1f}% | {rss / 1024 / 1024:.1f} MiB |")
+        lines.append("")
+
+        monitor = parent.loop_monitor
+        lines += [
+            "## Event loop",
+            "",
+            f"Lag: {monitor.lag_last * 1000:.1f} ms, longest {monitor.lag_max * 1000:.1f} ms. "
+            f"Stalls over {monitor.threshold * 1000:.0f} ms: {monitor.stalls}, {monitor.stalled_seconds:.2f}s in total.",
+            "",
+        ]
+
+        if parent.metrics.restarts:
+            lines += [
+                "## Restarts",
+                "",
+                "| Process | Reason | Count |",
+                "|---|---|---|",
+            ]
+            for (process, reason), count in sorted(parent.metrics.restarts.items()):
+                lines.append(f"| {process} | {reason} | {count} |")
+            lines.append("")
+            for process, detail in sorted(parent.metrics.last_crash.items()):
+                lines.append(f"Last {process} crash: {detail}")
+            lines.append("")
+
+        return "\n".join(lines)
+
+
 def create_scrypted_plugin():
     return BtopCamera()
\ No newline at end of file
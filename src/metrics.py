@@ -0,0 +1,196 @@
+import collections
+import os
+import time
+from typing import Callable, Dict, List, Tuple
+
+import psutil
+
+
+# supervised processes whose resource usage is sampled, by process name
+SAMPLED_PROCESSES = ('Xvfb', 'xterm', 'btop', 'ffmpeg')
+
+
+class RateMeter:
+    """Tracks the rate of events over a sliding window."""
+
+    def __init__(self, window: float = 10) -> None:
+        self.window = window
+        self.samples: collections.deque[Tuple[float, float]] = collections.deque()
+        self.started = time.monotonic()
+
+    def add(self, amount: float = 1) -> None:
+        self.samples.append((time.monotonic(), amount))
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        while self.samples and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        span = min(self.window, now - self.started)
+        if span <= 0:
+            return 0
+        return sum(amount for _, amount in self.samples) / span
+
+    def reset(self) -> None:
+        self.samples.clear()
+        self.started = time.monotonic()
+
+
+class PipelineStats:
+    """Capture and encode statistics for a single encoder.
+
+    Latency is measured from a frame being handed to the encoder to its encoded output arriving, so it
+    is only available when the plugin supplies the frames itself (the Headless Terminal engine, the Framebuffer
+    capture source and region cameras)."""
+
+    PENDING_CAPTURES = 64
+
+    def __init__(self) -> None:
+        self.frames_captured = 0
+        self.frames_encoded = 0
+        self.bytes_encoded = 0
+        self.encoder_starts = 0
+        self.encoder_exits = 0
+        self.last_exit_reason: str | None = None
+        self.replays = 0
+        self.keyframe_requests = 0
+
+        self.captured_rate = RateMeter()
+        self.encoded_rate = RateMeter()
+        self.byte_rate = RateMeter()
+
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.latency_last: float | None = None
+        self.pending_captures: collections.deque[float] = collections.deque(maxlen=PipelineStats.PENDING_CAPTURES)
+
+    def encoder_started(self) -> None:
+        self.encoder_starts += 1
+        self.pending_captures.clear()
+        self.captured_rate.reset()
+        self.encoded_rate.reset()
+        self.byte_rate.reset()
+
+    def encoder_exited(self, reason: str) -> None:
+        self.encoder_exits += 1
+        self.last_exit_reason = reason
+
+    def on_replayed(self) -> None:
+        self.replays += 1
+
+    def on_keyframe_requested(self) -> None:
+        self.keyframe_requests += 1
+
+    def on_captured(self) -> None:
+        self.frames_captured += 1
+        self.captured_rate.add()
+        self.pending_captures.append(time.monotonic())
+
+    def on_encoded(self, frames: int, size: int) -> None:
+        self.bytes_encoded += size
+        self.byte_rate.add(size)
+        if not frames:
+            return
+        self.frames_encoded += frames
+        self.encoded_rate.add(frames)
+        now = time.monotonic()
+        for _ in range(frames):
+            if not self.pending_captures:
+                break
+            self.latency_last = now - self.pending_captures.popleft()
+            self.latency_sum += self.latency_last
+            self.latency_count += 1
+
+    @property
+    def latency_average(self) -> float | None:
+        if not self.latency_count:
+            return None
+        return self.latency_sum / self.latency_count
+
+
+class ProcessSampler:
+    """Samples CPU and memory usage of the supervised processes.
+
+    Process handles are kept between samples, since psutil measures CPU usage since the previous call."""
+
+    def __init__(self) -> None:
+        self.processes: Dict[int, psutil.Process] = {}
+
+    @staticmethod
+    def process_name(p: psutil.Process) -> str | None:
+        name = p.name()
+        if name.endswith('.exe'):
+            name = name[:-len('.exe')]
+        for sampled in SAMPLED_PROCESSES:
+            if name == sampled or (sampled == 'ffmpeg' and name.startswith('ffmpeg')):
+                return sampled
+        return None
+
+    def sample(self, include: Callable[[List[str]], bool] | None = None) -> Dict[str, Dict[str, float]]:
+        """Returns the process count, CPU percent and RSS bytes per process name. Descendants of this
+        process are always sampled, other processes only if include accepts their command line."""
+        candidates = {}
+        try:
+            for child in psutil.Process(os.getpid()).children(recursive=True):
+                candidates[child.pid] = child
+        except psutil.NoSuchProcess:
+            pass
+        if include is not None:
+            for p in psutil.process_iter(['cmdline']):
+                try:
+                    if p.pid not in candidates and include(p.info['cmdline'] or []):
+                        candidates[p.pid] = p
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+
+        usage = {name: {'count': 0, 'cpu_percent': 0.0, 'rss_bytes': 0} for name in SAMPLED_PROCESSES}
+        seen = {}
+        for pid, candidate in candidates.items():
+            p = self.processes.get(pid)
+            try:
+                if p is None or p.create_time() != candidate.create_time():
+                    p = candidate
+                name = ProcessSampler.process_name(p)
+                if name is None:
+                    continue
+                cpu = p.cpu_percent(interval=None)
+                rss = p.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            seen[pid] = p
+            usage[name]['count'] += 1
+            usage[name]['cpu_percent'] += cpu
+            usage[name]['rss_bytes'] += rss
+        self.processes = seen
+        return usage
+
+
+class Metrics:
+    """Registry of the plugin's runtime metrics, rendered in the Prometheus text exposition format."""
+
+    def __init__(self) -> None:
+        self.restarts: Dict[Tuple[str, str], int] = collections.defaultdict(int)
+        self.last_crash: Dict[str, str] = {}
+        self.sampler = ProcessSampler()
+
+    def record_restart(self, process: str, reason: str, detail: str | None = None) -> None:
+        """Counts a restart of a supervised process. reason should be low-cardinality, detail is free-form."""
+        self.restarts[(process, reason)] += 1
+        if reason != 'requested':
+            self.last_crash[process] = detail or reason
+
+
+def format_prometheus(families: List[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]) -> str:
+    """Formats (name, type, help, [(labels, value)]) metric families in the Prometheus text format."""
+    def escape(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ','.join(f'{key}="{escape(str(label))}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return '\n'.join(lines) + '\n'
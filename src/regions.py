@@ -0,0 +1,148 @@
+import asyncio
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from blocking import run_blocking
+from resources import governor
+
+
+# btop boxes that can be shown as region cameras
+BTOP_PANELS = ['cpu', 'mem', 'net', 'proc']
+
+# fractions (x, y, width, height) of the display covered by each box in btop's default layout, in which cpu
+# spans the top third, mem and net share the left 45% below it and proc takes the rest
+DEFAULT_PANEL_LAYOUT = {
+    'cpu': (0, 0, 1, 0.32),
+    'mem': (0, 0.32, 0.45, 0.408),
+    'net': (0, 0.728, 0.45, 0.272),
+    'proc': (0.45, 0.32, 0.55, 0.68),
+}
+
+# box titles are drawn in the top border as ┐¹cpu┌, two cells to the right of the corner
+PANEL_TITLE = re.compile(r'┐[¹²³⁴⁵]?(' + '|'.join(BTOP_PANELS) + r')┌')
+TOP_LEFT = '╭┌'
+TOP_RIGHT = '╮┐'
+BOTTOM_LEFT = '╰└'
+BOTTOM_RIGHT = '╯┘'
+
+MIN_REGION_SIZE = 16
+
+Rect = Tuple[int, int, int, int]
+
+
+def find_panel_boxes(lines: List[str]) -> Dict[str, Rect]:
+    """Locates btop's boxes on a terminal screen, returning (column, row, columns, rows) per box name."""
+    boxes = {}
+    for row, line in enumerate(lines):
+        for match in PANEL_TITLE.finditer(line):
+            name = match.group(1)
+            left = match.start() - 2
+            if name in boxes or left < 0 or line[left] not in TOP_LEFT:
+                continue
+            # the left border runs down to the bottom corner, a box below starts after it
+            bottom = next((r for r in range(row + 1, len(lines)) if left < len(lines[r]) and lines[r][left] in BOTTOM_LEFT), None)
+            if bottom is None:
+                continue
+            # titles are also bracketed by corner characters, so the right corner must line up with the bottom one
+            right = next((c for c in range(match.end(), len(line))
+                          if line[c] in TOP_RIGHT and c < len(lines[bottom]) and lines[bottom][c] in BOTTOM_RIGHT
+                          and c < len(lines[row + 1]) and lines[row + 1][c] == '│'), None)
+            if right is None:
+                continue
+            boxes[name] = (left, row, right - left + 1, bottom - row + 1)
+    return boxes
+
+
+def parse_custom_region(text: str) -> Dict[str, Any] | None:
+    """Parses a custom region in the form "Name: x,y,width,height", in display pixels."""
+    name, _, rect = text.rpartition(':')
+    name = name.strip()
+    try:
+        x, y, width, height = [int(part) for part in rect.split(',')]
+    except ValueError:
+        return None
+    slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+    if not slug or width <= 0 or height <= 0:
+        return None
+    return {"id": f"custom-{slug}", "name": name, "rect": (x, y, width, height)}
+
+
+def clip_rect(rect: Rect, width: int, height: int) -> Rect:
+    """Clips the rectangle to the display, with even offsets and dimensions as yuv420p requires."""
+    x, y, w, h = rect
+    x = max(0, min(x, width - MIN_REGION_SIZE)) // 2 * 2
+    y = max(0, min(y, height - MIN_REGION_SIZE)) // 2 * 2
+    w = max(MIN_REGION_SIZE, min(w, width - x)) // 2 * 2
+    h = max(MIN_REGION_SIZE, min(h, height - y)) // 2 * 2
+    return (x, y, w, h)
+
+
+def crop_frame(frame: bytes | memoryview, stride: int, pixel_size: int, rect: Rect) -> bytes:
+    """Copies a rectangle out of a packed frame with the given bytes per row and per pixel."""
+    x, y, w, h = rect
+    start = x * pixel_size
+    end = start + w * pixel_size
+    return b''.join(frame[row * stride + start:row * stride + end] for row in range(y, y + h))
+
+
+class RawCapture:
+    """A single raw RGB capture of the display, shared by the encoders of the region cameras.
+
+    Each encoder crops its region out of the most recent frame, so the display is only grabbed once however
+    many regions are streamed. The capture runs for as long as at least one encoder has acquired it."""
+
+    def __init__(self, name: str, build_command: Callable[[], Awaitable[Tuple[List[str], Dict[str, str], Tuple[int, int]]]]) -> None:
+        """build_command returns the FFmpeg arguments, environment and frame dimensions of the capture."""
+        self.name = name
+        self.build_command = build_command
+        self.users = 0
+        self.task: asyncio.Task | None = None
+        self.frame: bytes | None = None
+        self.frame_size = (0, 0)
+        self.version = 0
+
+    def acquire(self) -> None:
+        self.users += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run(), name=f"{self.name}: capture")
+
+    def release(self) -> None:
+        self.users -= 1
+        if self.users <= 0 and self.task is not None:
+            self.users = 0
+            self.task.cancel()
+            self.task = None
+            self.frame = None
+
+    async def run(self) -> None:
+        while True:
+            args, env, (width, height) = await self.build_command()
+            print(f"{self.name}: starting capture")
+            p = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env)
+            await run_blocking(governor.apply, p.pid, self.name)
+
+            async def stream_stderr():
+                async for line in p.stderr:
+                    print(f"{self.name}:", line.decode('utf-8', errors='replace').rstrip())
+
+            stderr_task = asyncio.create_task(stream_stderr())
+            try:
+                while True:
+                    frame = await p.stdout.readexactly(width * height * 3)
+                    self.frame = frame
+                    self.frame_size = (width, height)
+                    self.version += 1
+            except asyncio.IncompleteReadError:
+                pass
+            finally:
+                if p.returncode is None:
+                    try:
+                        p.kill()
+                    except ProcessLookupError:
+                        pass
+                await p.wait()
+                stderr_task.cancel()
+                self.frame = None
+
+            print(f"{self.name}: capture exited with code {p.returncode}, restarting in 1s...")
+            await asyncio.sleep(1)
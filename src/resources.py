@@ -0,0 +1,222 @@
+import os
+import platform
+import threading
+from typing import Dict, List
+
+import psutil
+
+
+# where cgroup v2 is mounted, and the group that the plugin's processes are moved into for quotas
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_NAME = 'scrypted-btop-camera'
+CPU_PERIOD = 100000
+
+IO_PRIORITIES = ["Default", "Low", "Idle"]
+
+LINUX = platform.system() == 'Linux'
+
+
+def parse_cpu_list(text: str) -> List[int] | None:
+    """Parses a CPU list such as "0-3,6", as taken by taskset. Returns None for an empty list, meaning every CPU."""
+    cpus = set()
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if first < 0 or last < first:
+            raise ValueError(f"invalid CPU range {part}")
+        cpus.update(range(first, last + 1))
+    return sorted(cpus) or None
+
+
+def format_cpu_list(cpus: List[int]) -> str:
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+
+class ResourcePolicy:
+    """Limits on the display and encoder processes. The defaults leave processes as they were started.
+
+    cpu_quota is in percent of one CPU and memory_max in MB, both 0 for no limit. threads is the number of
+    encoder threads, 0 to let the encoder decide, and is passed to FFmpeg rather than applied to processes."""
+
+    def __init__(self, nice: int = 0, io_priority: str = 'Default', cpus: List[int] | None = None, threads: int = 0,
+                 cpu_quota: int = 0, memory_max: int = 0) -> None:
+        self.nice = nice
+        self.io_priority = io_priority
+        self.cpus = cpus
+        self.threads = threads
+        self.cpu_quota = cpu_quota
+        self.memory_max = memory_max
+
+    @property
+    def uses_cgroup(self) -> bool:
+        return bool(self.cpu_quota or self.memory_max)
+
+    @property
+    def is_default(self) -> bool:
+        return self.nice == 0 and self.io_priority == 'Default' and self.cpus is None and not self.uses_cgroup
+
+
+class ResourceGovernor:
+    """Applies the resource policy to the processes that the plugin launches.
+
+    Priorities and CPU affinity are per thread on Linux, so they are set on every thread of a process, and
+    threads it starts later inherit them. Quotas are enforced by moving processes into a cgroup v2 group next
+    to the plugin's own, since a group holding processes cannot have child groups with controllers. The
+    effective limits of each process are logged whenever they change."""
+
+    def __init__(self) -> None:
+        self.policy = ResourcePolicy()
+        # whether a policy was ever applied, after which the defaults have to be restored explicitly
+        self.applied = False
+        self.cgroup: str | None = None
+        self.cgroup_configured = False
+        self.cgroup_error: str | None = None
+        self.reported: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def configure(self, policy: ResourcePolicy) -> None:
+        with self.lock:
+            self.policy = policy
+            self.cgroup_configured = False
+
+    def setup_cgroup(self) -> str:
+        if not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+            raise Exception("cgroup v2 is not available")
+        with open('/proc/self/cgroup') as f:
+            own = next((line[3:].strip() for line in f if line.startswith('0::')), None)
+        if own is None:
+            raise Exception("the plugin is not in a cgroup v2 group")
+        parent = os.path.join(CGROUP_ROOT, os.path.dirname(own).lstrip('/') if own != '/' else '')
+        path = os.path.join(parent, CGROUP_NAME)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(parent, 'cgroup.subtree_control')) as f:
+            enabled = f.read().split()
+        missing = [controller for controller in ('cpu', 'memory') if controller not in enabled]
+        if missing:
+            with open(os.path.join(parent, 'cgroup.subtree_control'), 'w') as f:
+                f.write(' '.join(f"+{controller}" for controller in missing))
+
+        cpu_max = f"{self.policy.cpu_quota * CPU_PERIOD // 100} {CPU_PERIOD}" if self.policy.cpu_quota else f"max {CPU_PERIOD}"
+        memory_max = str(self.policy.memory_max * 1024 * 1024) if self.policy.memory_max else 'max'
+        with open(os.path.join(path, 'cpu.max'), 'w') as f:
+            f.write(cpu_max)
+        with open(os.path.join(path, 'memory.max'), 'w') as f:
+            f.write(memory_max)
+        return path
+
+    def apply(self, pid: int, name: str, recursive: bool = False) -> None:
+        """Applies the policy to the process, and to its descendants if recursive. Failures are logged, and
+        the process keeps running without the limits that could not be set."""
+        with self.lock:
+            policy = self.policy
+            if policy.is_default and not self.applied:
+                return
+            self.applied = True
+
+            if (policy.uses_cgroup or self.cgroup is not None) and not self.cgroup_configured:
+                self.cgroup_configured = True
+                self.cgroup_error = None
+                try:
+                    self.cgroup = self.setup_cgroup()
+                except Exception as e:
+                    self.cgroup = None
+                    self.cgroup_error = f"cgroup ({e})"
+            errors = [self.cgroup_error] if self.cgroup_error and policy.uses_cgroup else []
+
+            try:
+                root = psutil.Process(pid)
+                processes = [root] + (root.children(recursive=True) if recursive else [])
+            except psutil.Error:
+                # already gone
+                return
+            for p in processes:
+                process_errors = list(errors)
+                try:
+                    label = f"{name}/{p.name()}" if p.pid != pid else name
+                except psutil.Error:
+                    continue
+                self.limit(p, policy, process_errors)
+                self.report(p, label, process_errors)
+
+    def limit(self, p: psutil.Process, policy: ResourcePolicy, errors: List[str]) -> None:
+        if self.cgroup is not None:
+            try:
+                with open(os.path.join(self.cgroup, 'cgroup.procs'), 'w') as f:
+                    f.write(str(p.pid))
+            except OSError as e:
+                errors.append(f"cgroup ({e.strerror})")
+
+        try:
+            targets = [psutil.Process(thread.id) for thread in p.threads()] if LINUX else [p]
+        except psutil.Error:
+            targets = [p]
+        failed = set()
+        for target in targets:
+            if not target.is_running():
+                # a thread that exited meanwhile
+                continue
+            try:
+                if target.nice() != policy.nice:
+                    target.nice(policy.nice)
+            except psutil.Error:
+                failed.add(f"nice {policy.nice} (not permitted)")
+            if not LINUX:
+                continue
+            try:
+                if policy.io_priority == 'Idle':
+                    target.ionice(psutil.IOPRIO_CLASS_IDLE)
+                elif policy.io_priority == 'Low':
+                    target.ionice(psutil.IOPRIO_CLASS_BE, 7)
+                else:
+                    target.ionice(psutil.IOPRIO_CLASS_NONE)
+            except psutil.Error:
+                failed.add(f"I/O priority {policy.io_priority} (not permitted)")
+            try:
+                target.cpu_affinity(policy.cpus or [])
+            except (psutil.Error, ValueError) as e:
+                failed.add(f"CPU affinity ({e})")
+        errors += sorted(failed)
+
+    def effective_limits(self, p: psutil.Process) -> str:
+        parts = [f"nice {p.nice()}"]
+        if LINUX:
+            io = p.ionice()
+            parts.append({psutil.IOPRIO_CLASS_IDLE: "I/O idle", psutil.IOPRIO_CLASS_BE: f"I/O best effort {io.value}",
+                          psutil.IOPRIO_CLASS_RT: f"I/O realtime {io.value}"}.get(io.ioclass, "I/O default"))
+            parts.append(f"CPUs {format_cpu_list(p.cpu_affinity())}")
+            with open(f"/proc/{p.pid}/cgroup") as f:
+                group = next((line[3:].strip() for line in f if line.startswith('0::')), None)
+            if group is not None and os.path.basename(group) == CGROUP_NAME:
+                limits = []
+                for file in ('cpu.max', 'memory.max'):
+                    try:
+                        with open(os.path.join(CGROUP_ROOT, group.lstrip('/'), file)) as f:
+                            limits.append(f"{file} {f.read().strip()}")
+                    except OSError:
+                        pass
+                parts.append(f"cgroup {group} ({', '.join(limits)})")
+        return ", ".join(parts)
+
+    def report(self, p: psutil.Process, name: str, errors: List[str]) -> None:
+        try:
+            line = self.effective_limits(p)
+        except (psutil.Error, OSError):
+            return
+        if errors:
+            line += f"; could not set {', '.join(errors)}"
+        # encoders restart often, so only changes are logged
+        if self.reported.get(name) != line:
+            self.reported[name] = line
+            print(f"Resource limits of {name} (pid {p.pid}): {line}")
+
+
+governor = ResourceGovernor()
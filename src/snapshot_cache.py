@@ -0,0 +1,66 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SnapshotCache:
+    """In-memory cache of encoded snapshots, keyed by requested size.
+
+    Entries expire after the TTL, and the least recently used entries are evicted once the total
+    size exceeds the cap. Concurrent requests for the same key share a single refresh."""
+
+    def __init__(self, ttl: float, max_bytes: int) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, Tuple[float, bytes]] = OrderedDict()
+        self.pending: Dict[Hashable, asyncio.Future] = {}
+        self.size = 0
+
+    def get(self, key: Hashable) -> bytes | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        timestamp, data = entry
+        if time.monotonic() - timestamp > self.ttl:
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return data
+
+    def put(self, key: Hashable, data: bytes) -> None:
+        self.remove(key)
+        if len(data) > self.max_bytes:
+            return
+        self.entries[key] = (time.monotonic(), data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+
+    def remove(self, key: Hashable) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    async def get_or_refresh(self, key: Hashable, refresh: Callable[[], Awaitable[bytes]]) -> bytes:
+        data = self.get(key)
+        if data is not None:
+            return data
+
+        pending = self.pending.get(key)
+        if pending is None:
+            async def run_refresh():
+                try:
+                    data = await refresh()
+                    self.put(key, data)
+                    return data
+                finally:
+                    self.pending.pop(key, None)
+            pending = asyncio.ensure_future(run_refresh())
+            self.pending[key] = pending
+        return await asyncio.shield(pending)
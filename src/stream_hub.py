@@ -0,0 +1,367 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from blocking import run_blocking
+from metrics import PipelineStats
+from resources import governor
+from tracing import tracer
+
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+# PIDs below this are reserved for tables such as the SDT
+TS_FIRST_STREAM_PID = 0x20
+
+
+def ts_pid(packet: bytes) -> int:
+    return ((packet[1] & 0x1f) << 8) | packet[2]
+
+
+def ts_is_payload_start(packet: bytes) -> bool:
+    return bool(packet[1] & 0x40)
+
+
+def ts_is_random_access(packet: bytes) -> bool:
+    """Returns True if the packet carries the MPEG-TS random access indicator, which FFmpeg sets on keyframes."""
+    adaptation_field_control = (packet[3] >> 4) & 0x3
+    if not adaptation_field_control & 0x2:
+        return False
+    return packet[4] > 0 and bool(packet[5] & 0x40)
+
+
+def ts_pat_pmt_pid(packet: bytes) -> int | None:
+    """Parses a PAT packet and returns the PID of the first program's PMT."""
+    offset = 4
+    adaptation_field_control = (packet[3] >> 4) & 0x3
+    if adaptation_field_control & 0x2:
+        offset += 1 + packet[4]
+    if not packet[1] & 0x40:
+        # not the start of a section
+        return None
+    offset += 1 + packet[offset]
+    section_length = ((packet[offset + 1] & 0x0f) << 8) | packet[offset + 2]
+    # program loop starts after the 8 byte section header and excludes the 4 byte CRC
+    end = min(offset + 3 + section_length - 4, TS_PACKET_SIZE)
+    i = offset + 8
+    while i + 4 <= end:
+        program_number = (packet[i] << 8) | packet[i + 1]
+        pid = ((packet[i + 2] & 0x1f) << 8) | packet[i + 3]
+        if program_number != 0:
+            return pid
+        i += 4
+    return None
+
+
+class StreamSubscriber:
+    """A single viewer connected to a StreamHub. Receives MPEG-TS data starting at a keyframe."""
+
+    QUEUE_SIZE = 256
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.queue: asyncio.Queue[bytes | None] = asyncio.Queue(maxsize=StreamSubscriber.QUEUE_SIZE)
+        self.synced = False
+
+    def push(self, data: bytes) -> None:
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # slow consumer, drop what is queued and resync on the next keyframe
+            # rather than stalling every other viewer
+            self.drain_queue()
+            self.synced = False
+
+    def drain_queue(self) -> None:
+        while not self.queue.empty():
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+
+    def close(self) -> None:
+        self.drain_queue()
+        self.queue.put_nowait(None)
+
+
+class StreamHub:
+    """Runs a single FFmpeg capture/encode and fans its MPEG-TS output out to every connected subscriber.
+
+    Subscribers connect over a local TCP socket. The encoder is started when the first subscriber
+    connects and is torn down once the last one leaves and the linger period elapses. If a feeder
+    is provided, it is given the encoder's stdin to write raw input frames to.
+
+    The output since the most recent keyframe is kept, within byte and duration limits, and replayed to
+    each new subscriber so that it can show a picture right away instead of waiting for the next keyframe.
+    When there is nothing to replay, and no one else is watching, the encoder is restarted to produce a
+    keyframe immediately. keyframe_interval is the encoder's keyframe interval in seconds, which the cache
+    has to cover to hold a whole GOP."""
+
+    READ_SIZE = TS_PACKET_SIZE * 64
+    GOP_CACHE_BYTES = 4 * 1024 * 1024
+    # beyond the keyframe interval, for keyframes that come late such as with Damage-Driven capture
+    GOP_CACHE_MARGIN = 5
+
+    def __init__(self, name: str, build_command: Callable[[], Awaitable[Tuple[List[str], Dict[str, str]]]], linger: float = 10,
+                 feeder: Callable[[asyncio.StreamWriter], Awaitable[None]] | None = None, keyframe_interval: float = 10) -> None:
+        self.name = name
+        self.build_command = build_command
+        self.linger = linger
+        self.feeder = feeder
+        self.gop_cache_seconds = keyframe_interval + StreamHub.GOP_CACHE_MARGIN
+
+        self.subscribers: List[StreamSubscriber] = []
+        self.server: asyncio.Server | None = None
+        self.port: int | None = None
+        self.encoder_task: asyncio.Task | None = None
+        self.process: asyncio.subprocess.Process | None = None
+        self.stop_handle: asyncio.TimerHandle | None = None
+
+        self.pat: bytes | None = None
+        self.pmt: bytes | None = None
+        self.pmt_pid: int | None = None
+
+        # the output since the most recent keyframe, empty when it exceeded the limits
+        self.gop: List[bytes] = []
+        self.gop_bytes = 0
+        self.gop_started = 0
+        self.restart_requested = False
+
+        self.stats = PipelineStats()
+        self.startup_span = None
+
+    @property
+    def viewer_count(self) -> int:
+        return len(self.subscribers)
+
+    async def listen(self) -> int:
+        """Starts the local TCP server that subscribers connect to, returning its port."""
+        if self.server is None:
+            self.server = await asyncio.start_server(self.on_subscriber, '127.0.0.1', 0)
+            self.port = self.server.sockets[0].getsockname()[1]
+            print(f"{self.name}: stream hub listening on port {self.port}")
+        return self.port
+
+    def warm(self) -> None:
+        """Starts the encoder ahead of the first subscriber connecting, so that it will be ready sooner."""
+        self.ensure_encoder()
+        if not self.subscribers:
+            self.schedule_stop()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            self.port = None
+        for subscriber in list(self.subscribers):
+            subscriber.close()
+        await self.stop_encoder()
+
+    async def on_subscriber(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscriber = StreamSubscriber(writer)
+        if self.gop and self.pat and self.pmt:
+            subscriber.synced = True
+            subscriber.push(self.pat + self.pmt + b''.join(self.gop))
+            self.stats.on_replayed()
+        else:
+            self.request_keyframe()
+        self.subscribers.append(subscriber)
+        self.cancel_stop()
+        self.ensure_encoder()
+        print(f"{self.name}: viewer connected ({self.viewer_count} total{', replayed from the last keyframe' if subscriber.synced else ''})")
+
+        async def watch_reader():
+            # consumers never send anything, so EOF means they hung up
+            try:
+                await reader.read()
+            except:
+                pass
+            subscriber.close()
+
+        watcher = asyncio.create_task(watch_reader())
+        try:
+            while True:
+                data = await subscriber.queue.get()
+                if data is None:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except:
+            pass
+        finally:
+            watcher.cancel()
+            try:
+                writer.close()
+            except:
+                pass
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            print(f"{self.name}: viewer disconnected ({self.viewer_count} remaining)")
+            if not self.subscribers:
+                self.schedule_stop()
+
+    def schedule_stop(self) -> None:
+        self.cancel_stop()
+        loop = asyncio.get_event_loop()
+        self.stop_handle = loop.call_later(self.linger, lambda: asyncio.ensure_future(self.stop_encoder()))
+
+    def cancel_stop(self) -> None:
+        if self.stop_handle is not None:
+            self.stop_handle.cancel()
+            self.stop_handle = None
+
+    def request_keyframe(self) -> None:
+        """Restarts a running encoder so that it starts over with a keyframe. Skipped while the encoder is
+        still starting, since its first frame is a keyframe anyway, and while anyone is watching it."""
+        if self.process is None or self.startup_span is not None or self.restart_requested:
+            return
+        if any(subscriber.synced for subscriber in self.subscribers):
+            return
+        print(f"{self.name}: no keyframe to replay, restarting encoder")
+        self.restart_requested = True
+        self.stats.on_keyframe_requested()
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+
+    def ensure_encoder(self) -> None:
+        if self.encoder_task is None or self.encoder_task.done():
+            self.encoder_task = asyncio.create_task(self.run_encoder(), name=f"{self.name}: encoder")
+
+    async def stop_encoder(self) -> None:
+        self.cancel_stop()
+        if self.subscribers:
+            return
+        task = self.encoder_task
+        self.encoder_task = None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def run_encoder(self) -> None:
+        while True:
+            args, env = await self.build_command()
+            print(f"{self.name}: starting encoder")
+            self.pat = self.pmt = self.pmt_pid = None
+            self.reset_gop()
+            for subscriber in self.subscribers:
+                subscriber.synced = False
+
+            stdin = asyncio.subprocess.PIPE if self.feeder else asyncio.subprocess.DEVNULL
+            self.process = await asyncio.create_subprocess_exec(*args, stdin=stdin, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env)
+            await run_blocking(governor.apply, self.process.pid, self.name)
+            self.stats.encoder_started()
+            self.startup_span = tracer.begin(f"{self.name}: encoder startup")
+
+            async def stream_stderr(p):
+                async for line in p.stderr:
+                    print(f"{self.name}:", line.decode('utf-8', errors='replace').rstrip())
+
+            async def feed(p):
+                try:
+                    await self.feeder(p.stdin)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                except Exception as e:
+                    print(f"{self.name}: feeding the encoder failed: {e}")
+                finally:
+                    p.stdin.close()
+
+            stderr_task = asyncio.create_task(stream_stderr(self.process))
+            feeder_task = asyncio.create_task(feed(self.process)) if self.feeder else None
+            try:
+                await self.read_output(self.process)
+                await self.process.wait()
+            finally:
+                if self.process.returncode is None:
+                    try:
+                        self.process.kill()
+                    except ProcessLookupError:
+                        pass
+                    await self.process.wait()
+                stderr_task.cancel()
+                if feeder_task is not None:
+                    feeder_task.cancel()
+                self.stats.encoder_exited("keyframe requested" if self.restart_requested else f"exit code {self.process.returncode}")
+                self.process = None
+                self.reset_gop()
+
+            if self.restart_requested:
+                self.restart_requested = False
+                continue
+            if not self.subscribers:
+                print(f"{self.name}: encoder exited with no viewers")
+                return
+            print(f"{self.name}: encoder exited, restarting in 1s...")
+            await asyncio.sleep(1)
+
+    async def read_output(self, p: asyncio.subprocess.Process) -> None:
+        pending = b''
+        while True:
+            data = await p.stdout.read(StreamHub.READ_SIZE)
+            if not data:
+                return
+            data = pending + data
+
+            # resynchronize on the sync byte if the stream was ever misaligned
+            start = 0
+            while start < len(data) and data[start] != TS_SYNC_BYTE:
+                start += 1
+            usable = (len(data) - start) // TS_PACKET_SIZE * TS_PACKET_SIZE
+            pending = data[start + usable:]
+            if usable:
+                self.distribute(data[start:start + usable])
+
+    def reset_gop(self) -> None:
+        self.gop = []
+        self.gop_bytes = 0
+
+    def cache_gop(self, chunk: bytes, keyframe_offset: int | None) -> None:
+        loop = asyncio.get_event_loop()
+        if keyframe_offset is not None:
+            self.reset_gop()
+            self.gop_started = loop.time()
+            chunk = chunk[keyframe_offset:]
+        elif not self.gop:
+            return
+        self.gop.append(chunk)
+        self.gop_bytes += len(chunk)
+        if self.gop_bytes > StreamHub.GOP_CACHE_BYTES or loop.time() - self.gop_started > self.gop_cache_seconds:
+            # too long to be worth replaying, wait for the next keyframe
+            self.reset_gop()
+
+    def distribute(self, chunk: bytes) -> None:
+        keyframe_offset = None
+        frames = 0
+        for offset in range(0, len(chunk), TS_PACKET_SIZE):
+            packet = chunk[offset:offset + TS_PACKET_SIZE]
+            pid = ts_pid(packet)
+            if pid == 0:
+                self.pat = packet
+                pmt_pid = ts_pat_pmt_pid(packet)
+                if pmt_pid is not None:
+                    self.pmt_pid = pmt_pid
+            elif pid == self.pmt_pid:
+                self.pmt = packet
+            else:
+                # the only elementary stream is video, and FFmpeg starts a new PES packet for every frame
+                if pid >= TS_FIRST_STREAM_PID and ts_is_payload_start(packet):
+                    frames += 1
+                if keyframe_offset is None and ts_is_random_access(packet):
+                    keyframe_offset = offset
+        self.stats.on_encoded(frames, len(chunk))
+        if frames and self.startup_span is not None:
+            self.startup_span.end()
+            self.startup_span = None
+            tracer.milestone('first frame', encoder=self.name)
+        self.cache_gop(chunk, keyframe_offset)
+
+        for subscriber in self.subscribers:
+            if subscriber.synced:
+                subscriber.push(chunk)
+            elif keyframe_offset is not None and self.pat and self.pmt:
+                subscriber.synced = True
+                subscriber.push(self.pat + self.pmt + chunk[keyframe_offset:])
@@ -0,0 +1,569 @@
+"""Supervisor daemon that runs the plugin's long-lived child processes, and the plugin's client for it.
+
+A single daemon is started per plugin instance, in its own session so that it outlives signals aimed at the
+plugin. It is controlled with JSON lines over its stdin and stdout: the plugin sends requests (spawn, stop,
+status and cleanup), and the daemon answers them and reports the output and exits of its children. The plugin
+holds the write end of the daemon's stdin open for as long as it lives, so EOF means the plugin died, and the
+daemon then kills every child before exiting. On Windows, a monitor file that the plugin keeps touching is
+checked as well. Every process is also recorded in a registry file, from which the next instance cleans up
+should the daemon itself be killed."""
+
+import asyncio
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+import psutil
+
+from blocking import run_blocking
+from resources import governor
+from tracing import tracer
+
+
+WINDOWS = platform.system() == "Windows"
+MONITOR_INTERVAL = 3
+MONITOR_MISSES = 3
+REGISTRY_FILE = 'processes.json'
+REGISTRY_VERSION = 1
+
+
+def kill_tree(pid: int, kill_proc: str | None, create_time: float | None = None) -> None:
+    """Kills the process group started for the command, falling back to walking the process tree.
+
+    create_time is the start time of the command's process, for callers that may run after it was reaped.
+    The process tree is then only walked if the pid still belongs to that process, since it may have been
+    reused. The process group is killed either way: a pid still in use as a group id is not handed out."""
+    try:
+        p = psutil.Process(pid)
+        if create_time is not None and abs(p.create_time() - create_time) >= ProcessRegistry.CREATE_TIME_TOLERANCE:
+            # reaped, and the pid now belongs to an unrelated process
+            children = []
+        else:
+            children = p.children(recursive=True) + [p]
+    except psutil.NoSuchProcess:
+        # the command already exited, but members of its process group may remain
+        children = []
+
+    # kill the monitored process first, so that wrappers such as xvfb-run cannot respawn it
+    for child in children:
+        try:
+            if kill_proc and (child.name() == kill_proc or child.name() == f"{kill_proc}.exe"):
+                child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+    if not WINDOWS:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+            return
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+def process_identity(p: psutil.Process) -> Dict[str, Any]:
+    return {
+        "pid": p.pid,
+        "create_time": p.create_time(),
+        "cmdline": p.cmdline(),
+        "pgid": None if WINDOWS else os.getpgid(p.pid),
+    }
+
+
+class ProcessRegistry:
+    """Record of the processes started by supervisors, so that a later plugin instance can clean up after one
+    that died without stopping them.
+
+    Each entry records the identity of a process (its start time, command line and process group along with
+    its pid) and of the supervisor that owns it. Entries whose supervisor is no longer running are stale, and
+    their processes are only killed if they still match the recorded identity, so that a reused pid is never
+    mistaken for a leftover process."""
+
+    # create times are derived from the boot time and clock ticks, so allow for rounding
+    CREATE_TIME_TOLERANCE = 0.5
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.owner = process_identity(psutil.Process(os.getpid()))
+        self.lock = threading.Lock()
+
+    def read(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') == REGISTRY_VERSION:
+                return data['processes']
+        except (OSError, ValueError, KeyError):
+            pass
+        return []
+
+    def write(self, entries: List[Dict[str, Any]]) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({"version": REGISTRY_VERSION, "processes": entries}, f, indent=2)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def matches(identity: Dict[str, Any], p: psutil.Process) -> bool:
+        try:
+            return abs(p.create_time() - identity['create_time']) < ProcessRegistry.CREATE_TIME_TOLERANCE and \
+                p.cmdline() == identity['cmdline']
+        except psutil.Error:
+            return False
+
+    def owned(self, entry: Dict[str, Any]) -> bool:
+        return entry['owner']['pid'] == self.owner['pid'] and entry['owner']['create_time'] == self.owner['create_time']
+
+    def add(self, name: str, pid: int) -> None:
+        try:
+            identity = process_identity(psutil.Process(pid))
+        except psutil.Error:
+            # already gone
+            return
+        with self.lock:
+            entries = [entry for entry in self.read() if entry['pid'] != pid]
+            entries.append({"name": name, "owner": self.owner, **identity})
+            self.write(entries)
+
+    def remove(self, pid: int) -> None:
+        with self.lock:
+            entries = self.read()
+            remaining = [entry for entry in entries if not (entry['pid'] == pid and self.owned(entry))]
+            if len(remaining) != len(entries):
+                self.write(remaining)
+
+    def clean(self) -> List[Dict[str, Any]]:
+        """Kills the processes of all stale entries in a single pass, and drops the entries. Returns the name,
+        pid and whether anything was killed for each stale entry."""
+        with self.lock:
+            entries = self.read()
+            live = []
+            stale = []
+            for entry in entries:
+                if self.owned(entry):
+                    live.append(entry)
+                    continue
+                try:
+                    owner_alive = ProcessRegistry.matches(entry['owner'], psutil.Process(entry['owner']['pid']))
+                except psutil.Error:
+                    owner_alive = False
+                (live if owner_alive else stale).append(entry)
+            if not stale:
+                return []
+
+            # a single scan of all processes serves every entry whose group outlived its leader
+            groups: Dict[int, List[psutil.Process]] = {}
+            if not WINDOWS:
+                for p in psutil.process_iter():
+                    try:
+                        groups.setdefault(os.getpgid(p.pid), []).append(p)
+                    except (OSError, psutil.Error):
+                        pass
+
+            results = []
+            for entry in stale:
+                killed = False
+                try:
+                    leader = psutil.Process(entry['pid'])
+                    reused = not ProcessRegistry.matches(entry, leader)
+                except psutil.NoSuchProcess:
+                    leader = None
+                    reused = False
+                except psutil.Error:
+                    leader = None
+                    reused = True
+
+                if leader is not None and not reused:
+                    kill_tree(entry['pid'], entry['name'], entry['create_time'])
+                    killed = True
+                elif not reused and entry.get('pgid') is not None:
+                    # the leader is gone but members of its group, such as an Xvfb started by xvfb-run, may
+                    # remain. Had the pid been reused as a new group leader, it would have been alive above.
+                    for member in groups.get(entry['pgid'], []):
+                        try:
+                            if member.create_time() >= entry['create_time'] - ProcessRegistry.CREATE_TIME_TOLERANCE:
+                                member.kill()
+                                killed = True
+                        except psutil.Error:
+                            pass
+                results.append({"name": entry['name'], "pid": entry['pid'], "killed": killed})
+
+            self.write(live)
+            return results
+
+
+class Child:
+    def __init__(self, name: str, cmd: str, env: Dict[str, str], restart_delay: float | None) -> None:
+        self.name = name
+        self.cmd = cmd
+        self.env = env
+        self.restart_delay = restart_delay
+        self.process: subprocess.Popen | None = None
+        self.started = 0.0
+        # start time of the process, which tells it apart from a later process given the same pid
+        self.create_time = 0.0
+        self.restarts = 0
+        # set once the child should no longer be running, which also cuts short a pending restart
+        self.stopped = threading.Event()
+
+
+class Daemon:
+    def __init__(self, state_dir: str, monitor_file: str | None) -> None:
+        self.state_dir = state_dir
+        self.monitor_file = monitor_file
+        self.children: Dict[str, Child] = {}
+        self.registry = ProcessRegistry(os.path.join(state_dir, REGISTRY_FILE))
+        self.lock = threading.Lock()
+        self.output_lock = threading.Lock()
+
+    def send(self, message: Dict[str, Any]) -> None:
+        line = json.dumps(message) + '\n'
+        with self.output_lock:
+            try:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                # the plugin is gone, which the stdin reader will notice
+                pass
+
+    def log(self, *args: Any) -> None:
+        try:
+            print(*args, file=sys.stderr, flush=True)
+        except (OSError, ValueError):
+            pass
+
+    def launch(self, child: Child) -> None:
+        child.process = subprocess.Popen(child.cmd, env=dict(os.environ, **child.env), shell=not WINDOWS,
+                                         stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         start_new_session=not WINDOWS)
+        child.started = time.time()
+        try:
+            child.create_time = psutil.Process(child.process.pid).create_time()
+        except psutil.Error:
+            # unknown, so the pid is never taken to still be this process
+            child.create_time = 0.0
+        self.registry.add(child.name, child.process.pid)
+        threading.Thread(target=self.forward_output, args=(child, child.process), daemon=True).start()
+        threading.Thread(target=self.supervise, args=(child, child.process), daemon=True).start()
+
+    def forward_output(self, child: Child, process: subprocess.Popen) -> None:
+        for line in iter(process.stdout.readline, b''):
+            self.send({"event": "log", "name": child.name, "line": line.decode(errors='replace').rstrip()})
+
+    def supervise(self, child: Child, process: subprocess.Popen) -> None:
+        returncode = process.wait()
+        # the command's process group may outlive it, such as an Xvfb left behind by xvfb-run. The process
+        # has been reaped, so its pid may already belong to another process.
+        kill_tree(process.pid, child.name, child.create_time)
+        self.registry.remove(process.pid)
+        restarting = child.restart_delay is not None and not child.stopped.is_set()
+        if not restarting:
+            # forgotten before the exit is reported, so that the plugin can spawn it again right away
+            self.forget(child)
+        self.send({
+            "event": "exit",
+            "name": child.name,
+            "returncode": returncode,
+            "stopped": child.stopped.is_set(),
+            "restarting": restarting,
+            "uptime": round(time.time() - child.started, 3),
+        })
+        if not restarting:
+            return
+        if not child.stopped.wait(child.restart_delay):
+            with self.lock:
+                if self.children.get(child.name) is child and not child.stopped.is_set():
+                    child.restarts += 1
+                    self.launch(child)
+                    return
+        self.forget(child)
+
+    def forget(self, child: Child) -> None:
+        with self.lock:
+            if self.children.get(child.name) is child:
+                del self.children[child.name]
+
+    def spawn(self, name: str, cmd: str, env: Dict[str, str] = {}, restart_delay: float | None = None) -> Dict[str, Any]:
+        with self.lock:
+            if name in self.children:
+                raise Exception(f"{name} is already running")
+            child = Child(name, cmd, env, restart_delay)
+            self.children[name] = child
+            self.launch(child)
+            return {"pid": child.process.pid}
+
+    def stop(self, name: str) -> Dict[str, Any]:
+        with self.lock:
+            child = self.children.get(name)
+        if child is None:
+            return {"stopped": False}
+        child.stopped.set()
+        process = child.process
+        # supervise() may reap the process meanwhile
+        kill_tree(process.pid, child.name, child.create_time)
+        process.wait()
+        return {"stopped": True}
+
+    def status(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            children = list(self.children.values())
+        return [{
+            "name": child.name,
+            "pid": child.process.pid,
+            "running": child.process.poll() is None,
+            "restarts": child.restarts,
+            "uptime": round(time.time() - child.started, 3),
+            "cmd": child.cmd,
+        } for child in children]
+
+    def cleanup(self) -> List[Dict[str, Any]]:
+        """Kills processes left behind by supervisors that are no longer running."""
+        results = self.registry.clean()
+        # pidfiles of versions before the registry carry no identity to check, so they are only dropped
+        for name in ('Xvfb', 'xterm', 'cygserver', 'ffmpeg', 'None'):
+            try:
+                os.remove(os.path.join(self.state_dir, f"{name}.pid"))
+            except OSError:
+                pass
+        return results
+
+    def shutdown(self, reason: str) -> None:
+        self.log(f"Supervisor: plugin {reason}, stopping {len(self.children)} processes")
+        with self.lock:
+            children = list(self.children.values())
+        for child in children:
+            child.stopped.set()
+            try:
+                kill_tree(child.process.pid, child.name, child.create_time)
+                child.process.wait()
+            except:
+                pass
+            self.registry.remove(child.process.pid)
+
+    def handle(self, request: Dict[str, Any]) -> None:
+        op = request.pop('op', None)
+        id = request.pop('id', None)
+        try:
+            if op == 'spawn':
+                result = self.spawn(**request)
+            elif op == 'stop':
+                result = self.stop(**request)
+            elif op == 'status':
+                result = self.status()
+            elif op == 'cleanup':
+                result = self.cleanup()
+            else:
+                raise Exception(f"unknown request {op}")
+            self.send({"id": id, "result": result})
+        except Exception as e:
+            self.send({"id": id, "error": str(e)})
+
+    def watch_monitor_file(self) -> None:
+        misses = 0
+        while True:
+            time.sleep(MONITOR_INTERVAL)
+            if os.path.exists(self.monitor_file):
+                misses = 0
+                try:
+                    os.remove(self.monitor_file)
+                except OSError:
+                    pass
+                continue
+            misses += 1
+            if misses > MONITOR_MISSES:
+                self.shutdown("monitor file expired")
+                os._exit(0)
+
+    def run(self) -> None:
+        if self.monitor_file:
+            threading.Thread(target=self.watch_monitor_file, daemon=True).start()
+        while True:
+            try:
+                line = sys.stdin.readline()
+            except (OSError, ValueError):
+                break
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+            except ValueError:
+                continue
+            # stopping waits for the process to exit, so requests are handled off the reading thread
+            threading.Thread(target=self.handle, args=(request,), daemon=True).start()
+        self.shutdown("exited")
+
+
+class Supervisor:
+    """Plugin side of the supervisor daemon. The daemon is started on first use, and started again if it
+    dies, in which case the processes it was running are cleaned up and those with a restart policy respawned."""
+
+    def __init__(self, script: str, state_dir: str, monitor_file: str | None = None, launcher: str | None = None) -> None:
+        """launcher, if set, is the Cygwin launcher that commands are run through."""
+        self.script = script
+        self.state_dir = state_dir
+        self.monitor_file = monitor_file
+        self.launcher = launcher
+        self.process: asyncio.subprocess.Process | None = None
+        self.started: asyncio.Future | None = None
+        self.next_id = 0
+        self.requests: Dict[int, asyncio.Future] = {}
+        # waiters for the exit of processes started with run()
+        self.exits: Dict[str, asyncio.Future] = {}
+        # spawn arguments and exit callbacks of processes started with keep_running()
+        self.kept: Dict[str, Dict[str, Any]] = {}
+        self.exit_callbacks: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+        # whether any process was spawned, and may need cleaning up should the daemon die
+        self.spawned = False
+
+    def ensure_started(self) -> asyncio.Future:
+        if self.started is None:
+            self.started = asyncio.ensure_future(self.start())
+        return self.started
+
+    async def start(self) -> None:
+        with tracer.span('supervisor'):
+            os.makedirs(self.state_dir, exist_ok=True)
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, self.script, self.state_dir, self.monitor_file or 'None',
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                start_new_session=True, limit=1024 * 1024)
+            # applied before anything is spawned, so that every child inherits the limits
+            await run_blocking(governor.apply, self.process.pid, 'supervisor')
+            asyncio.ensure_future(self.read_messages(self.process))
+            asyncio.ensure_future(self.read_errors(self.process))
+
+            if self.spawned:
+                # the processes of a supervisor that died are left without anyone watching them
+                await self.send('cleanup')
+                for args in self.kept.values():
+                    await self.send('spawn', **args)
+
+    async def send(self, op: str, **args: Any) -> Any:
+        self.next_id += 1
+        id = self.next_id
+        future = asyncio.get_event_loop().create_future()
+        self.requests[id] = future
+        self.process.stdin.write((json.dumps({"id": id, "op": op, **args}) + '\n').encode())
+        await self.process.stdin.drain()
+        return await future
+
+    async def request(self, op: str, **args: Any) -> Any:
+        await self.ensure_started()
+        return await self.send(op, **args)
+
+    async def read_messages(self, process: asyncio.subprocess.Process) -> None:
+        async for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if 'id' in message:
+                future = self.requests.pop(message['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(Exception(message['error']))
+                else:
+                    future.set_result(message['result'])
+            elif message.get('event') == 'log':
+                print(f"{message['name']}: {message['line']}")
+            elif message.get('event') == 'exit':
+                self.on_exit(message)
+        await process.wait()
+        print(f"Supervisor exited with code {process.returncode}")
+        self.started = None
+        for future in self.requests.values():
+            if not future.done():
+                future.set_exception(Exception("supervisor exited"))
+        self.requests.clear()
+        for name in list(self.exits):
+            self.on_exit({"event": "exit", "name": name, "returncode": None, "stopped": False, "restarting": False, "uptime": None})
+        if self.kept:
+            asyncio.ensure_future(self.ensure_started())
+
+    async def read_errors(self, process: asyncio.subprocess.Process) -> None:
+        async for line in process.stderr:
+            print(line.decode(errors='replace').rstrip())
+
+    def on_exit(self, message: Dict[str, Any]) -> None:
+        name = message['name']
+        callback = self.exit_callbacks.get(name)
+        if callback is not None:
+            callback(message)
+        if not message.get('restarting'):
+            future = self.exits.pop(name, None)
+            if future is not None and not future.done():
+                future.set_result(message)
+
+    def command(self, cmd: str) -> str:
+        if self.launcher:
+            return f"\"{self.launcher}\" \"{cmd}\""
+        return cmd
+
+    async def run(self, name: str, cmd: str, env: Dict[str, str] = {}, stop: asyncio.Event | None = None) -> Dict[str, Any]:
+        """Runs the command until it exits, or until stop is set, and returns its exit event. name is that of
+        the process to kill first when stopping it, so that wrappers such as xvfb-run cannot respawn it."""
+        exited = asyncio.get_event_loop().create_future()
+        self.exits[name] = exited
+        try:
+            await self.request('spawn', name=name, cmd=self.command(cmd), env=env)
+        except:
+            self.exits.pop(name, None)
+            raise
+        self.spawned = True
+
+        if stop is not None:
+            stop_task = asyncio.ensure_future(stop.wait())
+            await asyncio.wait([exited, stop_task], return_when=asyncio.FIRST_COMPLETED)
+            stop_task.cancel()
+            if not exited.done():
+                try:
+                    await self.request('stop', name=name)
+                except:
+                    pass
+        return await exited
+
+    async def keep_running(self, name: str, cmd: str, env: Dict[str, str] = {}, restart_delay: float = 5,
+                           on_exit: Callable[[Dict[str, Any]], None] | None = None) -> None:
+        """Starts the command and has the supervisor restart it after restart_delay whenever it exits."""
+        args = {"name": name, "cmd": self.command(cmd), "env": env, "restart_delay": restart_delay}
+        self.kept[name] = args
+        if on_exit is not None:
+            self.exit_callbacks[name] = on_exit
+        await self.request('spawn', **args)
+        self.spawned = True
+
+    async def status(self) -> List[Dict[str, Any]]:
+        return await self.request('status')
+
+    async def cleanup(self) -> List[Dict[str, Any]]:
+        """Kills processes left behind by a previous plugin instance, returning the name, pid and whether anything
+        was killed for each process it had registered."""
+        return await self.request('cleanup')
+
+
+if __name__ == "__main__":
+    state_dir = sys.argv[1].strip()
+    monitor_file = sys.argv[2].strip()
+    if monitor_file == 'None':
+        monitor_file = None
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    os.makedirs(state_dir, exist_ok=True)
+    Daemon(state_dir, monitor_file).run()
@@ -0,0 +1,270 @@
+import asyncio
+import os
+import shutil
+import struct
+import subprocess
+import threading
+from typing import Dict, List, Tuple
+
+import pyte
+from PIL import Image, ImageDraw, ImageFont
+
+from blocking import run_blocking
+from resources import governor
+
+
+# xterm's default 16 color palette, keyed by pyte's color names
+PALETTE = {
+    'black': (0, 0, 0),
+    'red': (205, 0, 0),
+    'green': (0, 205, 0),
+    'brown': (205, 205, 0),
+    'blue': (0, 0, 238),
+    'magenta': (205, 0, 205),
+    'cyan': (0, 205, 205),
+    'white': (229, 229, 229),
+    'brightblack': (127, 127, 127),
+    'brightred': (255, 0, 0),
+    'brightgreen': (0, 255, 0),
+    'brightbrown': (255, 255, 0),
+    'brightblue': (92, 92, 255),
+    'brightmagenta': (255, 0, 255),
+    'brightcyan': (0, 255, 255),
+    'brightwhite': (255, 255, 255),
+}
+DEFAULT_FG = (229, 229, 229)
+DEFAULT_BG = (0, 0, 0)
+
+FALLBACK_FONTS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSansMono.ttf',
+    '/usr/share/fonts/TTF/DejaVuSansMono.ttf',
+    '/System/Library/Fonts/Menlo.ttc',
+    '/System/Library/Fonts/Monaco.ttf',
+]
+
+
+def resolve_font_file(family: str = None) -> str | None:
+    """Finds a font file for the given family with fc-match, falling back to well-known monospace fonts."""
+    fc_match = shutil.which('fc-match') or ('/opt/X11/bin/fc-match' if os.path.exists('/opt/X11/bin/fc-match') else None)
+    if fc_match:
+        pattern = f"{family}:spacing=mono" if family and family != 'Default' else 'monospace'
+        try:
+            path = subprocess.check_output([fc_match, '-f', '%{file}', pattern]).decode().strip()
+            if path and os.path.exists(path):
+                return path
+        except:
+            pass
+    for path in FALLBACK_FONTS:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def resolve_color(color: str, default: Tuple[int, int, int], bold: bool = False) -> Tuple[int, int, int]:
+    if color == 'default':
+        return default
+    if bold and color in PALETTE and not color.startswith('bright'):
+        color = 'bright' + color
+    rgb = PALETTE.get(color)
+    if rgb is not None:
+        return rgb
+    try:
+        return (int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16))
+    except ValueError:
+        return default
+
+
+class TerminalRenderer:
+    """Rasterizes a pyte screen into an RGB frame, redrawing only the cells that changed.
+
+    The screen is fed on the event loop, so its dirty lines are read there with snapshot(), and drawn into the
+    frame with draw(), which may run on a worker thread. The lock is held while the image and frame change."""
+
+    GLYPH_CACHE_SIZE = 4096
+
+    def __init__(self, width: int, height: int, font_file: str | None, font_size: int) -> None:
+        self.width = width
+        self.height = height
+        if font_file:
+            self.font = ImageFont.truetype(font_file, font_size)
+        else:
+            self.font = ImageFont.load_default()
+
+        left, top, right, bottom = self.font.getbbox('M')
+        self.cell_width = max(1, int(round(self.font.getlength('M'))) if hasattr(self.font, 'getlength') else right - left)
+        if hasattr(self.font, 'getmetrics'):
+            ascent, descent = self.font.getmetrics()
+            self.cell_height = max(1, ascent + descent)
+        else:
+            self.cell_height = max(1, bottom - top)
+
+        self.columns = max(1, width // self.cell_width)
+        self.lines = max(1, height // self.cell_height)
+
+        self.image = Image.new('RGB', (width, height), DEFAULT_BG)
+        self.cells: List[List[Tuple | None]] = [[None] * self.columns for _ in range(self.lines)]
+        self.glyphs: Dict[Tuple, Image.Image] = {}
+        self.frame: bytes | None = None
+        # incremented whenever the frame changes, so that multiple consumers can each detect changes
+        self.version = 0
+        self.lock = threading.RLock()
+        # numbers the snapshots, so that a line is never drawn over with an older snapshot of it
+        self.snapshots = 0
+        self.drawn: List[int] = [0] * self.lines
+
+    def glyph(self, data: str, fg: Tuple[int, int, int], bg: Tuple[int, int, int], underscore: bool) -> Image.Image:
+        key = (data, fg, bg, underscore)
+        tile = self.glyphs.get(key)
+        if tile is None:
+            if len(self.glyphs) >= TerminalRenderer.GLYPH_CACHE_SIZE:
+                self.glyphs.clear()
+            tile = Image.new('RGB', (self.cell_width, self.cell_height), bg)
+            if data.strip():
+                ImageDraw.Draw(tile).text((0, 0), data, font=self.font, fill=fg)
+            if underscore:
+                ImageDraw.Draw(tile).line([(0, self.cell_height - 1), (self.cell_width, self.cell_height - 1)], fill=fg)
+            self.glyphs[key] = tile
+        return tile
+
+    def snapshot(self, screen: pyte.Screen) -> Tuple[int, Dict[int, List[Tuple]]]:
+        """Returns the cells of the dirty lines of the screen, by line, and clears them."""
+        self.snapshots += 1
+        lines = {}
+        for y in screen.dirty:
+            if y >= self.lines:
+                continue
+            row = screen.buffer[y]
+            cells = []
+            for x in range(self.columns):
+                char = row[x]
+                fg = resolve_color(char.fg, DEFAULT_FG, char.bold)
+                bg = resolve_color(char.bg, DEFAULT_BG)
+                if char.reverse:
+                    fg, bg = bg, fg
+                cells.append((char.data, fg, bg, char.underscore))
+            lines[y] = cells
+        screen.dirty.clear()
+        return self.snapshots, lines
+
+    def draw(self, snapshot: Tuple[int, Dict[int, List[Tuple]]]) -> bool:
+        """Draws lines of cells taken with snapshot() into the frame. Returns True if any pixels changed."""
+        number, lines = snapshot
+        with self.lock:
+            changed = False
+            for y, cells in sorted(lines.items()):
+                if number < self.drawn[y]:
+                    # another consumer drew a newer snapshot of the line meanwhile
+                    continue
+                self.drawn[y] = number
+                previous = self.cells[y]
+                for x, cell in enumerate(cells):
+                    if previous[x] == cell:
+                        continue
+                    previous[x] = cell
+                    self.image.paste(self.glyph(*cell), (x * self.cell_width, y * self.cell_height))
+                    changed = True
+            if changed or self.frame is None:
+                self.frame = self.image.tobytes()
+                self.version += 1
+            return changed
+
+    def render(self, screen: pyte.Screen) -> bool:
+        """Draws the dirty lines of the screen into the frame. Returns True if any pixels changed."""
+        return self.draw(self.snapshot(screen))
+
+
+class TerminalScreen(pyte.Screen):
+    """A pyte screen that answers terminal queries (such as device attributes) back to the program."""
+
+    def __init__(self, columns: int, lines: int, master_fd: int) -> None:
+        super().__init__(columns, lines)
+        self.master_fd = master_fd
+
+    def write_process_input(self, data: str) -> None:
+        try:
+            os.write(self.master_fd, data.encode())
+        except OSError:
+            pass
+
+
+class TerminalSession:
+    """Runs a program under a pseudo-terminal and keeps a pyte screen of its output up to date."""
+
+    def __init__(self, args: List[str], columns: int, lines: int, env: Dict[str, str] = {}) -> None:
+        self.args = args
+        self.columns = columns
+        self.lines = lines
+        self.env = env
+        self.process: asyncio.subprocess.Process | None = None
+        self.master_fd: int | None = None
+        self.screen: TerminalScreen | None = None
+        self.stream: pyte.ByteStream | None = None
+        self.updated = asyncio.Event()
+        # incremented whenever the program writes to the terminal, so that readers of the screen can detect changes
+        self.version = 0
+        self.stopped = False
+
+    def stop(self) -> None:
+        """Kills the program. run() returns shortly after, with stopped set."""
+        self.stopped = True
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+    async def run(self) -> None:
+        """Starts the program and returns once it exits."""
+        import fcntl
+        import termios
+
+        master_fd, slave_fd = os.openpty()
+        fcntl.ioctl(slave_fd, termios.TIOCSWINSZ, struct.pack('HHHH', self.lines, self.columns, 0, 0))
+        os.set_blocking(master_fd, False)
+
+        self.master_fd = master_fd
+        self.screen = TerminalScreen(self.columns, self.lines, master_fd)
+        self.stream = pyte.ByteStream(self.screen)
+
+        def set_controlling_terminal():
+            fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+        env = dict(os.environ, TERM='xterm-256color', COLORTERM='truecolor', COLUMNS=str(self.columns), LINES=str(self.lines), **self.env)
+        loop = asyncio.get_event_loop()
+        eof = asyncio.Event()
+
+        def on_output():
+            try:
+                data = os.read(master_fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                loop.remove_reader(master_fd)
+                eof.set()
+                return
+            self.stream.feed(data)
+            self.version += 1
+            self.updated.set()
+
+        try:
+            self.process = await asyncio.create_subprocess_exec(*self.args, stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, env=env, start_new_session=True, preexec_fn=set_controlling_terminal)
+            await run_blocking(governor.apply, self.process.pid, os.path.basename(self.args[0]))
+            os.close(slave_fd)
+            slave_fd = None
+            loop.add_reader(master_fd, on_output)
+            await asyncio.gather(eof.wait(), self.process.wait())
+        finally:
+            loop.remove_reader(master_fd)
+            if slave_fd is not None:
+                os.close(slave_fd)
+            if self.process is not None and self.process.returncode is None:
+                try:
+                    self.process.kill()
+                except ProcessLookupError:
+                    pass
+                await self.process.wait()
+            os.close(master_fd)
+            self.master_fd = None
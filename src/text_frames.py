@@ -0,0 +1,171 @@
+import asyncio
+import json
+from typing import Any, AsyncGenerator, Callable, Dict, List, Tuple
+
+from terminal_engine import DEFAULT_BG, DEFAULT_FG, resolve_color
+
+
+TEXT_FORMATS = ['text', 'ansi', 'json']
+# unchanged cells between two changed runs of a line, up to which both are sent as a single segment
+MERGE_GAP = 4
+KEEPALIVE_INTERVAL = 15
+
+# (data, fg, bg, bold, italics, underscore), with colors resolved as the renderer draws them
+Cell = Tuple[str, Tuple[int, int, int], Tuple[int, int, int], bool, bool, bool]
+
+
+def screen_cells(screen: Any) -> List[List[Cell]]:
+    rows = []
+    for y in range(screen.lines):
+        line = screen.buffer[y]
+        row = []
+        for x in range(screen.columns):
+            char = line[x]
+            fg = resolve_color(char.fg, DEFAULT_FG, char.bold)
+            bg = resolve_color(char.bg, DEFAULT_BG)
+            if char.reverse:
+                fg, bg = bg, fg
+            row.append((char.data, fg, bg, char.bold, char.italics, char.underscore))
+        rows.append(row)
+    return rows
+
+
+def changed_segments(old: List[Cell], new: List[Cell]) -> List[Tuple[int, int]]:
+    """Returns the (start, end) column ranges of a line that differ, merging ranges separated by small gaps."""
+    segments = []
+    for x, (a, b) in enumerate(zip(old, new)):
+        if a == b:
+            continue
+        if segments and x - segments[-1][1] <= MERGE_GAP:
+            segments[-1][1] = x + 1
+        else:
+            segments.append([x, x + 1])
+    return [(start, end) for start, end in segments]
+
+
+def hex_color(rgb: Tuple[int, int, int]) -> str:
+    return '#%02x%02x%02x' % rgb
+
+
+def json_spans(row: List[Cell], start: int, end: int) -> List[Dict[str, Any]]:
+    """Groups cells with the same attributes into spans of text. Attributes that are off are left out."""
+    spans = []
+    style = None
+    for data, *attributes in row[start:end]:
+        if spans and attributes == style:
+            spans[-1]['text'] += data
+            continue
+        style = attributes
+        fg, bg, bold, italics, underscore = attributes
+        span = {"text": data, "fg": hex_color(fg), "bg": hex_color(bg)}
+        if bold:
+            span['bold'] = True
+        if italics:
+            span['italic'] = True
+        if underscore:
+            span['underline'] = True
+        spans.append(span)
+    return spans
+
+
+def sgr(fg: Tuple[int, int, int], bg: Tuple[int, int, int], bold: bool, italics: bool, underscore: bool) -> str:
+    codes = ['0', '38;2;%d;%d;%d' % fg, '48;2;%d;%d;%d' % bg]
+    if bold:
+        codes.append('1')
+    if italics:
+        codes.append('3')
+    if underscore:
+        codes.append('4')
+    return f"\x1b[{';'.join(codes)}m"
+
+
+def ansi_segment(row: List[Cell], start: int, end: int) -> str:
+    out = []
+    style = None
+    for data, *attributes in row[start:end]:
+        if attributes != style:
+            style = attributes
+            out.append(sgr(*attributes))
+        out.append(data)
+    out.append('\x1b[0m')
+    return ''.join(out)
+
+
+def format_screen(cells: List[List[Cell]], format: str) -> str:
+    """Formats a whole screen as plain text, ANSI-colored text or JSON spans."""
+    if format == 'json':
+        return json.dumps({
+            "columns": len(cells[0]) if cells else 0,
+            "lines": len(cells),
+            "rows": [json_spans(row, 0, len(row)) for row in cells],
+        }, ensure_ascii=False)
+    if format == 'ansi':
+        return '\n'.join(ansi_segment(row, 0, len(row)) for row in cells) + '\n'
+    return '\n'.join(''.join(cell[0] for cell in row).rstrip() for row in cells) + '\n'
+
+
+class ScreenCells:
+    """The cells of a terminal session's screen, shared by every text client. The screen is only read
+    again once the program has written to the terminal since the previous read."""
+
+    def __init__(self) -> None:
+        self.session = None
+        self.version = None
+        self.cells: List[List[Cell]] | None = None
+
+    def get(self, session: Any) -> List[List[Cell]] | None:
+        if session is None or session.screen is None:
+            return None
+        if session is not self.session or session.version != self.version:
+            self.session = session
+            self.version = session.version
+            self.cells = screen_cells(session.screen)
+        return self.cells
+
+
+async def stream_text_frames(get_session: Callable[[], Any], screen_cells: ScreenCells, format: str, interval: float) -> AsyncGenerator[bytes, None]:
+    """Streams the screen and then only the segments of lines that changed, checking every interval.
+
+    The json format is sent as server-sent events: a screen event with the whole screen, again whenever
+    btop restarts, and delta events with the changed segments. The ansi and text formats are sent as a
+    plain chunked stream of escapes that redraw the changed segments in place, for a terminal to show, with
+    colors only in the ansi format."""
+    loop = asyncio.get_event_loop()
+    sse = format == 'json'
+    segment = ansi_segment if format == 'ansi' else lambda row, start, end: ''.join(cell[0] for cell in row[start:end])
+    session_sent = None
+    sent: List[List[Cell]] | None = None
+    last_write = loop.time()
+    while True:
+        session = get_session()
+        cells = screen_cells.get(session)
+        chunk = None
+        if cells is not None and (session is not session_sent or sent is None or len(cells) != len(sent) or len(cells[0]) != len(sent[0])):
+            if sse:
+                chunk = f"event: screen\ndata: {format_screen(cells, 'json')}\n\n"
+            else:
+                # clear the screen and draw every line from the top left
+                chunk = '\x1b[2J' + ''.join(f"\x1b[{y + 1};1H{segment(row, 0, len(row))}" for y, row in enumerate(cells))
+        elif cells is not None and cells is not sent:
+            changes = []
+            for y, (old, new) in enumerate(zip(sent, cells)):
+                for start, end in changed_segments(old, new):
+                    changes.append((y, start, end, new))
+            if changes and sse:
+                chunk = "event: delta\ndata: " + json.dumps({
+                    "changes": [{"y": y, "x": start, "spans": json_spans(row, start, end)} for y, start, end, row in changes],
+                }, ensure_ascii=False) + "\n\n"
+            elif changes:
+                chunk = ''.join(f"\x1b[{y + 1};{start + 1}H{segment(row, start, end)}" for y, start, end, row in changes)
+        if cells is not None:
+            session_sent = session
+            sent = cells
+
+        now = loop.time()
+        if chunk is None and sse and now - last_write >= KEEPALIVE_INTERVAL:
+            # a comment, which keeps proxies from closing an idle connection
+            chunk = ": keepalive\n\n"
+        if chunk is not None:
+            last_write = now
+            yield chunk.encode()
+        await asyncio.sleep(interval)
@@ -0,0 +1,159 @@
+import asyncio
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List
+
+
+class Span:
+    """A timed phase, recorded as a Chrome trace complete event once ended."""
+
+    def __init__(self, tracer: 'Tracer', name: str, args: Dict[str, Any]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.track = tracer.current_track()
+        self.start = time.perf_counter()
+        self.duration: float | None = None
+
+    def end(self, **args: Any) -> None:
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self.start
+        self.args.update(args)
+        self.tracer.record(self)
+
+
+class Tracer:
+    """Collects spans of the plugin's startup phases and subprocess launches.
+
+    Spans are grouped into tracks by the asyncio task (or thread) that started them, so that phases running
+    concurrently are shown side by side. The timeline can be written in the Chrome trace event format, which
+    chrome://tracing and Perfetto load directly."""
+
+    MAX_EVENTS = 10000
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.tracks: Dict[Any, int] = {}
+        self.track_names: Dict[int, str] = {}
+        self.phases: Dict[str, float] = {}
+        self.milestones: Dict[str, float] = {}
+        self.milestone_events: Dict[str, asyncio.Event] = {}
+        self.lock = threading.Lock()
+
+    def current_track(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = task if task is not None else threading.get_ident()
+        with self.lock:
+            if len(self.events) >= Tracer.MAX_EVENTS:
+                # nothing more will be recorded, so stop keeping track of tasks
+                return 0
+            track = self.tracks.get(key)
+            if track is None:
+                track = len(self.tracks) + 1
+                self.tracks[key] = track
+                self.track_names[track] = task.get_name() if task is not None else threading.current_thread().name
+        return track
+
+    def timestamp(self, t: float) -> float:
+        return round((t - self.origin) * 1e6, 1)
+
+    def begin(self, name: str, **args: Any) -> Span:
+        """Starts a span that is ended explicitly, for phases that do not fit in a single block."""
+        return Span(self, name, args)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[Span]:
+        span = Span(self, name, args)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(error=repr(e))
+            raise
+        span.end()
+
+    def instant(self, name: str, **args: Any) -> float:
+        """Records a point in time, such as a first frame, returning the seconds since the tracer started."""
+        now = time.perf_counter()
+        self.append({
+            "name": name,
+            "ph": "i",
+            "s": "g",
+            "ts": self.timestamp(now),
+            "pid": os.getpid(),
+            "tid": self.current_track(),
+            "args": args,
+        })
+        return now - self.origin
+
+    def milestone(self, name: str, **args: Any) -> None:
+        """Records the first time a point such as the first frame is reached. Later calls are ignored."""
+        if name in self.milestones:
+            return
+        self.milestones[name] = self.instant(name, **args)
+        event = self.milestone_events.get(name)
+        if event is not None:
+            event.set()
+
+    async def wait_milestone(self, name: str) -> float:
+        """Waits for a milestone, returning the seconds from the tracer starting until it was reached."""
+        if name not in self.milestones:
+            event = self.milestone_events.setdefault(name, asyncio.Event())
+            await event.wait()
+        return self.milestones[name]
+
+    def record(self, span: Span) -> None:
+        # the first completion of each phase is what the startup summary reports
+        self.phases.setdefault(span.name, span.duration)
+        self.append({
+            "name": span.name,
+            "ph": "X",
+            "ts": self.timestamp(span.start),
+            "dur": round(span.duration * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": span.track,
+            "args": span.args,
+        })
+
+    def append(self, event: Dict[str, Any]) -> None:
+        with self.lock:
+            if len(self.events) < Tracer.MAX_EVENTS:
+                self.events.append(event)
+
+    def write(self, path: str) -> None:
+        with self.lock:
+            events = list(self.events)
+            track_names = dict(self.track_names)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": track, "args": {"name": name}}
+                    for track, name in track_names.items()]
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+            os.replace(tmp, path)
+        except OSError:
+            print("Could not write trace to", path)
+
+    def summary(self, phases: List[str]) -> str:
+        parts = [f"{name} {self.phases[name]:.2f}s" for name in phases if name in self.phases]
+        return ", ".join(parts)
+
+
+tracer = Tracer()
+
+
+async def trace_phase(name: str, awaitable: Any, **args: Any) -> Any:
+    """Awaits a phase within a span. Meant to be the whole of a task, which is named after the phase."""
+    task = asyncio.current_task()
+    if task is not None:
+        task.set_name(name)
+    with tracer.span(name, **args):
+        return await awaitable
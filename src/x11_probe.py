@@ -0,0 +1,133 @@
+import asyncio
+import os
+import struct
+from typing import List, Tuple
+
+from blocking import run_blocking
+
+
+X11_SOCKET_DIR = '/tmp/.X11-unix'
+
+X_GET_WINDOW_ATTRIBUTES = 3
+X_QUERY_TREE = 15
+MAP_STATE_VIEWABLE = 2
+
+
+def x11_socket_path(display_num: int) -> str:
+    return os.path.join(X11_SOCKET_DIR, f"X{display_num}")
+
+
+def pad4(n: int) -> int:
+    return (4 - n % 4) % 4
+
+
+def read_xauthority(path: str, display_num: int) -> Tuple[bytes, bytes]:
+    """Returns the (protocol name, cookie) entry for the display from an Xauthority file."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return b'', b''
+
+    offset = 0
+
+    def read_counted():
+        nonlocal offset
+        length, = struct.unpack_from('>H', data, offset)
+        value = data[offset + 2:offset + 2 + length]
+        offset += 2 + length
+        return value
+
+    try:
+        while offset < len(data):
+            offset += 2  # family
+            read_counted()  # address
+            number = read_counted()
+            name = read_counted()
+            cookie = read_counted()
+            if not number or number == str(display_num).encode():
+                return name, cookie
+    except struct.error:
+        pass
+    return b'', b''
+
+
+class X11Connection:
+    """A minimal X11 client, just enough to check that the server accepts connections and to inspect top-level windows."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, root: int) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.root = root
+
+    @staticmethod
+    async def connect(display_num: int, xauthority: str) -> 'X11Connection':
+        reader, writer = await asyncio.open_unix_connection(x11_socket_path(display_num))
+        try:
+            name, cookie = await run_blocking(read_xauthority, xauthority, display_num)
+            writer.write(struct.pack('<cxHHHHxx', b'l', 11, 0, len(name), len(cookie)) +
+                         name + b'\0' * pad4(len(name)) +
+                         cookie + b'\0' * pad4(len(cookie)))
+            header = await reader.readexactly(8)
+            status = header[0]
+            additional, = struct.unpack_from('<H', header, 6)
+            body = await reader.readexactly(additional * 4)
+            if status != 1:
+                reason = body[:header[1]].decode(errors='replace')
+                raise ConnectionRefusedError(f"X server refused connection: {reason}")
+
+            vendor_length, = struct.unpack_from('<H', body, 16)
+            format_count = body[21]
+            screens_offset = 32 + vendor_length + pad4(vendor_length) + format_count * 8
+            root, = struct.unpack_from('<I', body, screens_offset)
+            return X11Connection(reader, writer, root)
+        except:
+            writer.close()
+            raise
+
+    def close(self) -> None:
+        self.writer.close()
+
+    async def request(self, opcode: int, window: int) -> bytes | None:
+        """Sends a request taking a single window argument and returns the reply, or None on error."""
+        self.writer.write(struct.pack('<BxHI', opcode, 2, window))
+        while True:
+            header = await self.reader.readexactly(32)
+            if header[0] == 0:
+                return None
+            if header[0] == 1:
+                length, = struct.unpack_from('<I', header, 4)
+                return header + await self.reader.readexactly(length * 4)
+            # an event, which is not expected since none are selected
+
+    async def top_level_windows(self) -> List[int]:
+        reply = await self.request(X_QUERY_TREE, self.root)
+        if reply is None:
+            return []
+        count, = struct.unpack_from('<H', reply, 16)
+        return list(struct.unpack_from(f'<{count}I', reply, 32))
+
+    async def is_viewable(self, window: int) -> bool:
+        reply = await self.request(X_GET_WINDOW_ATTRIBUTES, window)
+        return reply is not None and reply[26] == MAP_STATE_VIEWABLE
+
+
+async def probe_display(display_num: int, xauthority: str, require_window: bool = True) -> bool:
+    """Returns True if the X server accepts a connection and, if required, a top-level window is mapped."""
+    if not os.path.exists(x11_socket_path(display_num)):
+        return False
+    try:
+        connection = await asyncio.wait_for(X11Connection.connect(display_num, xauthority), 2)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, struct.error):
+        return False
+    try:
+        if not require_window:
+            return True
+        for window in await asyncio.wait_for(connection.top_level_windows(), 2):
+            if await asyncio.wait_for(connection.is_viewable(window), 2):
+                return True
+        return False
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, struct.error):
+        return False
+    finally:
+        connection.close()